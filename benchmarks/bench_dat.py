@@ -0,0 +1,79 @@
+#
+# Benchmark of the cost of parsing the node.dat files of data sets as the data_loader does for each of them.
+#
+# Directories of synthetic node.dat files are written, each with 207 nodes of between one and five features,
+# some of them <undefined>, as ced2graph writes them.  The nodes of every directory are then parsed
+#   1) the way CEBAFGraph originally did, iterating over the rows of a DataFrame and evaluating each feature
+#   2) by data_loader.dat.read_node_dat, which converts all the features of a file at once
+#
+# Usage: python3 benchmarks/bench_dat.py [directories]
+
+import os
+import sys
+import time
+import tempfile
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data_loader.dat import read_node_dat
+
+node_count = 207
+directories = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+
+# Write the node.dat files of count directories beneath path
+def make_data_sets(path, count):
+    rng = numpy.random.default_rng(0)
+    widths = rng.integers(1, 6, size=node_count)
+    for i in range(count):
+        os.makedirs(os.path.join(path, str(i)))
+        lines = ["\t".join(['NODE', 'NAME', 'TYPE', 'VALUES']) + "\n"]
+        for node_id, width in enumerate(widths):
+            values = [repr(float(value)) for value in rng.normal(size=width).round(4)]
+            values[0] = str(int(rng.integers(0, 100)))
+            values = ['<undefined>' if rng.random() < 0.02 else value for value in values]
+            lines.append(f"{node_id}\tNODE{node_id:04d} \t {node_id % 9} \t {','.join(values)}\n")
+        with open(os.path.join(path, str(i), 'node.dat'), 'w') as f:
+            f.write(''.join(lines))
+
+
+# The original parsing of CEBAFGraph._parse_node_and_link, returning the node_id, name, type and features of each node
+def original_nodes(file_name):
+    nodes = []
+    df = pandas.read_csv(file_name, sep='\t')
+    for _, row in df.iterrows():
+        attr = []
+        for v in row['VALUES'].strip().split(','):
+            try:
+                attr.append(eval(v))
+            except Exception:
+                attr.append(numpy.nan)
+        nodes.append((row['NODE'], row['NAME'].strip(), row['TYPE'], attr))
+    return nodes
+
+
+def vectorized_nodes(file_name):
+    data = read_node_dat(file_name)
+    return list(zip(data.node_id.tolist(), data.name, data.node_type.tolist(), data.attributes()))
+
+
+def timed(parse, files) -> tuple:
+    start = time.perf_counter()
+    parsed = [parse(file_name) for file_name in files]
+    return time.perf_counter() - start, parsed
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as path:
+        make_data_sets(path, directories)
+        files = [os.path.join(path, str(i), 'node.dat') for i in range(directories)]
+        original, expected = timed(original_nodes, files)
+        vectorized, parsed = timed(vectorized_nodes, files)
+        # The features are the same, NaN for NaN
+        assert numpy.array_equal(numpy.concatenate([attr for nodes in expected for *_, attr in nodes]),
+                                 numpy.concatenate([attr for nodes in parsed for *_, attr in nodes]), equal_nan=True)
+        assert [node[:3] for nodes in expected for node in nodes] == [node[:3] for nodes in parsed for node in nodes]
+    print(f"{'directories':>12} {'nodes':>6} {'original':>14} {'vectorized':>14}")
+    print(f'{directories:>12} {node_count:>6} {original / directories * 1000:>9.3f}ms/ds '
+          f'{vectorized / directories * 1000:>9.3f}ms/ds')
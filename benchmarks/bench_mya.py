@@ -0,0 +1,86 @@
+#
+# Benchmark of the cost of decoding responses from the Mya web server.
+#
+# Responses are built from the recorded mysampler response in tests/mysampler.json,
+# both as recorded and scaled up to the number of steps that long date ranges produce.
+# Each response is decoded
+#   1) the way get_data_for_pvs originally did, re-parsing the body for every channel and datum
+#   2) by parsing the body once (mya.samples_from_response)
+#   3) incrementally from a stream of chunks (mya.ResponseDecoder)
+#
+# Usage: python3 benchmarks/bench_mya.py
+
+import os
+import sys
+import json
+import timeit
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import modules.mya as mya
+
+recorded_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'mysampler.json')
+
+
+# A minimal stand-in for a requests.Response whose json() parses the body anew on every call
+class RecordedResponse:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+# The decoding loop of the original get_data_for_pvs which calls response.json() per channel and per datum
+def original_decode(response):
+    data = {}
+    for channel in response.json()['channels'].keys():
+        for datum in response.json()['channels'][channel]['data']:
+            if datum['d'] not in data.keys():
+                data[datum['d']] = []
+            if 'v' not in datum:
+                data[datum['d']].append({channel: '<undefined>'})
+            else:
+                data[datum['d']].append({channel: datum['v']})
+    return data
+
+
+# Return a response body with the recorded channels extended to steps hourly samples each
+def scaled_body(recorded: dict, steps: int) -> bytes:
+    dates = pandas.date_range('2021-01-01', periods=steps, freq='1h').strftime('%Y-%m-%dT%H:%M:%S')
+    channels = {}
+    for channel, content in recorded['channels'].items():
+        values = [datum.get('v') for datum in content['data']]
+        data = []
+        for i, date in enumerate(dates):
+            value = values[i % len(values)]
+            data.append({'d': date, 'v': value} if value is not None else {'d': date})
+        channels[channel] = {'metadata': content['metadata'], 'data': data}
+    return json.dumps({'channels': channels}).encode('utf-8')
+
+
+def best_of(func, repeat=3) -> float:
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+if __name__ == "__main__":
+    with open(recorded_file, 'rb') as handle:
+        recorded_body = handle.read()
+    recorded = json.loads(recorded_body)
+    channels = len(recorded['channels'])
+
+    bodies = [('recorded', recorded_body)]
+    for steps in [1000, 10000, 100000]:
+        bodies.append((f'{steps} steps', scaled_body(recorded, steps)))
+
+    print(f"{'response':>14} {'channels':>9} {'MB':>7} {'original':>10} {'parse once':>11} {'streamed':>10}")
+    for name, body in bodies:
+        # The original decoding is quadratic in the number of samples, so only time it where that is bearable
+        if len(body) < 1000000:
+            original = f'{best_of(lambda: original_decode(RecordedResponse(body))):.3f}s'
+        else:
+            original = 'skipped'
+        parsed = best_of(lambda: mya.samples_from_response(json.loads(body)))
+        chunks = [body[i:i + mya.stream_chunk_size] for i in range(0, len(body), mya.stream_chunk_size)]
+        streamed = best_of(lambda: mya.ResponseDecoder().decode(chunks))
+        print(f'{name:>14} {channels:>9} {len(body) / 1e6:>7.2f} {original:>10} {parsed:>10.3f}s {streamed:>9.3f}s')
@@ -0,0 +1,78 @@
+#
+# Benchmark of the cost of extracting node attributes at each timestamp written to disk.
+#
+# A list of 200 nodes, each with CED properties and several epics fields, is given synthetic samples,
+# both with and without a modifier of one of the fields.  The attributes of every node are then extracted for each timestamp
+#   1) the way epics_attribute_values originally did, rebuilding each PV name, looking up its value
+#      and evaluating any modifier with the value substituted into it
+#   2) by way of the plan compiled by Node.attribute_plan, in which modifiers are already applied
+#
+# Usage: python3 benchmarks/bench_node.py
+
+import os
+import sys
+import timeit
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import modules.mya as mya
+import modules.node as node
+from modules.filter import macro_substitute
+
+node_count = 200
+timestamps = 1000
+fields = ['.BDL', '.S', 'GSET', 'PSET', 'XPSET8']
+
+
+# Return a list of nodes with samples for timestamps hourly steps
+def make_nodes(modified: bool) -> list:
+    rng = numpy.random.default_rng(0)
+    times = mya.epoch_ms('2021-01-01') + numpy.arange(timestamps) * 3600000
+    nodes = []
+    for i in range(node_count):
+        element = {'type': 'QB', 'name': f'MQB{i:04d}',
+                   'properties': {'EPICSName': f'MQB{i:04d}', 'S': str(i * 1.5), 'L': '0.3'}}
+        item = node.SetPointNode(element, list(fields), mya.Sampler('2021-01-01', '2021-02-12'),
+                                 {f'MQB{i:04d}.BDL': '$(MQB{:04d}.BDL) * 2'.format(i)} if modified else {})
+        values = rng.normal(size=(timestamps, len(fields))).round(3)
+        values[rng.random(values.shape) < 0.01] = numpy.nan
+        item.sampler.set_data(mya.Samples(times, item.pv_list(), values))
+        nodes.append(item)
+    return nodes
+
+
+# The original epics_attribute_values
+def original_attribute_values(item, index):
+    samples = item.samples()
+    attribute_values = []
+    for field in item.epics_fields:
+        pv_name = item.pv_name(item.epics_name(), field)
+        if samples.has(pv_name):
+            attribute_values.append(original_modified_epics_value(item, pv_name, samples.text(index, pv_name)))
+    return item.ced_attribute_values() + attribute_values
+
+
+# The original modified_epics_value
+def original_modified_epics_value(item, pv_name, pv_value):
+    if pv_name in item.modifiers.keys() and pv_value != '<undefined>':
+        expr = macro_substitute(pv_name, pv_value, item.modifiers[pv_name])
+        return str(eval(expr))
+    else:
+        return str(pv_value)
+
+
+def best_of(func, repeat=3) -> float:
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+if __name__ == "__main__":
+    print(f"{'nodes':>6} {'fields':>7} {'modifiers':>10} {'timestamps':>11} {'original':>14} {'planned':>14}")
+    for modified in [False, True]:
+        nodes = make_nodes(modified)
+        for index in range(timestamps):
+            assert [original_attribute_values(item, index) for item in nodes] == \
+                   [item.attribute_values(index) for item in nodes]
+        original = best_of(lambda: [original_attribute_values(item, i) for i in range(timestamps) for item in nodes])
+        planned = best_of(lambda: [item.attribute_values(i) for i in range(timestamps) for item in nodes])
+        print(f'{node_count:>6} {len(fields):>7} {int(modified):>10} {timestamps:>11} '
+              f'{original / timestamps * 1000:>9.3f}ms/ts {planned / timestamps * 1000:>9.3f}ms/ts')
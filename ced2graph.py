@@ -16,13 +16,14 @@ import sys
 import logging
 import datetime
 import pytz
+import numpy
 from modules.ced import *
 import modules.ced as ced
 import modules.mya as mya
+import modules.cache as cache
 import modules.hgb as hgb
 import modules.node as node
 from modules.util import progressBar
-from modules.filter import FilterException
 from data_loader.data_loader import CEBAFGraphLoader
 
 from pprint import pprint
@@ -44,6 +45,14 @@ tree_file = 'tree.json'
 nodes_file = 'nodes.json'
 globals_file = 'global.json'
 
+# The subdirectory of the output directory in which the progress of a run is saved as it is made so that an
+# interrupted run can be resumed, and the names of the files saved there in addition to the sampled data.
+checkpoint_dir = 'checkpoint'
+checkpoint_config_file = 'config.json'
+checkpoint_config_copy = 'config.yaml'
+checkpoint_inventory_file = 'inventory.json'
+checkpoint_manifest_file = 'manifest.json'
+
 # the list of nodes that will be used to output graph data
 node_list = []
 
@@ -54,6 +63,9 @@ hgb.order_types_by = 'config'  # 'config' or 'node'
 # the global data that will be used for filtering
 global_data = []
 
+# The result of applying the filter to global_data, as returned by Filter.mask, once it is known
+filtered = None
+
 # CED Type hierarchy tree for using to match specific retrieved types
 # to the possibly more generic (i.e. parent) type names encountered in the config dictionary.
 # For example to determine that an element whose type is QB is also a "Quad" and a "Magnet"
@@ -73,8 +85,17 @@ def make_cli_parser() -> argparse.ArgumentParser:
                         help="Name of a yaml formatted config file")
     parser.add_argument("-m", type=str, dest='mya_deployment',
                         help="Mya deployment to query (history|ops)")
+    parser.add_argument("-w", type=int, dest='workers',
+                        help="Number of concurrent requests to make to the Mya archiver")
+    parser.add_argument("--cache-dir", type=str, dest='cache_dir',
+                        help="Directory in which to cache archiver data between runs")
     parser.add_argument("-d", type=str, dest='output_dir', default='.',
                         help="Directory where generated graph file hierarchy will be written")
+    parser.add_argument("--resume", type=str, dest='resume_dir',
+                        help="Resume an interrupted run that was writing to directory, fetching only what is missing")
+    parser.add_argument("--append", type=str, dest='append_dir',
+                        help="Append the data sets for dates newer than or missing from those already written to "
+                             "directory by an earlier run, using its configuration")
     parser.add_argument("--read-json", type=str, dest='read_json_from_dir',
                         help=f"Read {tree_file}, {nodes_file}, {globals_file} from directory instead of CED and Mya")
     parser.add_argument("--no-save-json", action='store_true',
@@ -92,12 +113,35 @@ def initialize_modules(config: dict):
 
     if 'workspace' in config['ced']:
         ced.workspace = config['ced']['workspace']
+    if 'cache_ttl' in config['ced']:
+        ced.ttl = config['ced']['cache_ttl']
 
     # Class attributes of the mya module
     if 'deployment' in config['mya']:
         mya.deployment = config['mya']['deployment']
     if 'throttle' in config['mya']:
         mya.throttle = config['mya']['throttle']
+    if 'workers' in config['mya']:
+        mya.workers = config['mya']['workers']
+    if 'points_per_request' in config['mya']:
+        mya.points_per_request = config['mya']['points_per_request']
+    if 'retries' in config['mya']:
+        mya.retries = config['mya']['retries']
+    if 'backoff' in config['mya']:
+        mya.backoff = config['mya']['backoff']
+    if 'setpoint_mode' in config['mya']:
+        mya.setpoint_mode = config['mya']['setpoint_mode']
+    if 'events_ratio' in config['mya']:
+        mya.events_ratio = config['mya']['events_ratio']
+    if 'coalesce_steps' in config['mya']:
+        mya.coalesce_steps = config['mya']['coalesce_steps']
+    if 'cache' in config['mya'] and config['mya']['cache']:
+        mya.cache = cache.ArchiveCache(config['mya']['cache']['directory'], config['mya']['cache'].get('size'))
+        # CED responses are kept in the same directory
+        ced.cache = cache.CedCache(config['mya']['cache']['directory'], config['mya']['cache'].get('size'))
+
+    # The output compression is checked before any time-consuming work
+    hgb.compression(config['output'])
 
     # Class attributes of the node module
     node.default_attributes = config['nodes']['default_attributes']
@@ -105,14 +149,41 @@ def initialize_modules(config: dict):
         node.master = config['nodes']['master']
 
 
+# Return the date range to fetch when appending to the output of the run described by manifest.  Unless they
+# are given, it begins with the last data set written, ends now and has the interval of the run.
+def append_dates(config: dict, manifest: dict, begin=None, end=None, interval=None) -> dict:
+    if interval is None:
+        dates = config['mya']['dates']
+        ranges = dates if isinstance(dates, list) else [dates] if isinstance(dates, dict) else []
+        interval = ranges[-1].get('interval') if ranges else None
+        if interval is None:
+            sys.exit('The interval of the data sets to append must be given with -i')
+    if begin is None:
+        if not manifest['dates']:
+            sys.exit('No data sets were written to the output, so the beginning of those to append must be given with -b')
+        begin = manifest['dates'][-1]
+    if end is None:
+        end = datetime.datetime.now(pytz.timezone('America/New_York')).strftime('%Y-%m-%d %H:%M:%S')
+    return {'begin': begin, 'end': end, 'interval': interval}
+
+
 
 if __name__ == "__main__":
     try:
         # Access the command line arguments
         args = make_cli_parser().parse_args()
 
+        if args.resume_dir and args.read_json_from_dir:
+            sys.exit('The --resume and --read-json options may not be used together')
+        if args.append_dir and (args.resume_dir or args.read_json_from_dir):
+            sys.exit('The --append option may not be used with --resume or --read-json')
+
         # If defaulting to '.' try to make a subdir
-        if args.output_dir == '.':
+        if args.resume_dir:
+            output_dir = args.resume_dir
+        elif args.append_dir:
+            output_dir = args.append_dir
+        elif args.output_dir == '.':
             output_dir = hgb.dir_from_date('.', datetime.datetime.now(pytz.timezone('America/New_York')))
             os.makedirs(output_dir)
         else:
@@ -130,9 +201,39 @@ if __name__ == "__main__":
             filemode='w'  # Fresh file every run.
         )
 
-        # Read configuration yaml file
-        stream = open(args.config_file, 'r')
-        config = yaml.load(stream, Loader=yaml.CLoader)
+        # Unless the data is being read from json files, the progress of the run is saved in a checkpoint
+        checkpoint = None
+        if not args.read_json_from_dir:
+            checkpoint_path = os.path.join(output_dir, checkpoint_dir)
+            if args.resume_dir and not os.path.isdir(checkpoint_path):
+                sys.exit('No interrupted run to resume in ' + output_dir)
+            if not args.resume_dir and os.path.isdir(checkpoint_path):
+                sys.exit('An interrupted run was writing to ' + output_dir + '. Use --resume to resume it.')
+            checkpoint = cache.Checkpoint(checkpoint_path)
+
+        # When appending, the manifest of what was already written to the output.  A resumed run that was
+        # appending finds it in the checkpoint.
+        manifest = None
+        if args.append_dir:
+            manifest = hgb.read_manifest(output_dir)
+            if manifest is None:
+                sys.exit('No manifest of a completed run to append to in ' + output_dir)
+        elif args.resume_dir:
+            manifest = checkpoint.load_json(checkpoint_manifest_file)
+
+        # Read configuration yaml file.  A resumed run uses the configuration saved by the interrupted one
+        # and an appending run the configuration of the run it appends to.
+        if args.resume_dir:
+            config = checkpoint.load_json(checkpoint_config_file)
+            if config is None:
+                sys.exit('No interrupted run to resume in ' + output_dir)
+        elif args.append_dir:
+            config = manifest['config']
+            if config['output'].get('structure') == 'columnar':
+                sys.exit('Data sets cannot be appended to a columnar store')
+        else:
+            stream = open(args.config_file, 'r')
+            config = yaml.load(stream, Loader=yaml.CLoader)
 
         # pprint(config['nodes'])
         # info = node.TypeInfo(config)
@@ -141,18 +242,37 @@ if __name__ == "__main__":
         # hgb.write_meta_dat('.', config, [])
         # sys.exit(1)
 
-        # Override config with Command line options
-        if args.begin:
-            config['mya']['dates']['begin'] = args.begin
-        if args.end:
-            config['mya']['dates']['end'] = args.end
-        if args.interval:
-            config['mya']['dates']['interval'] = args.interval
-        if args.mya_deployment:
-            config['mya']['deployment'] = args.mya_deployment
+        # Override config with Command line options.  Those that govern which data is fetched can't
+        # be changed when resuming.
+        if not args.resume_dir:
+            if args.append_dir:
+                config['mya']['dates'] = append_dates(config, manifest, args.begin, args.end, args.interval)
+            else:
+                if args.begin:
+                    config['mya']['dates']['begin'] = args.begin
+                if args.end:
+                    config['mya']['dates']['end'] = args.end
+                if args.interval:
+                    config['mya']['dates']['interval'] = args.interval
+            if args.mya_deployment:
+                config['mya']['deployment'] = args.mya_deployment
+            if checkpoint:
+                checkpoint.save_json(checkpoint_config_file, config)
+                if manifest:
+                    checkpoint.save_json(checkpoint_manifest_file, manifest)
+                else:
+                    # The copy of the config file saved with the output is the one read by this run even if resumed
+                    shutil.copyfile(args.config_file, os.path.join(checkpoint.directory, checkpoint_config_copy))
+        if args.workers:
+            config['mya']['workers'] = args.workers
+        if args.cache_dir:
+            if not config['mya'].get('cache'):
+                config['mya']['cache'] = {}
+            config['mya']['cache']['directory'] = args.cache_dir
 
         # Module-level configuration
         initialize_modules(config)
+        mya.checkpoint = checkpoint
 
         # The conditional block below chooses between two methods of populating the node list
         # 1) Reading saved data or
@@ -172,43 +292,38 @@ if __name__ == "__main__":
                                             args.config_file)
         else:
             # Use CED and MYA to build nodes list
-            # Begin by fetching the desired CED elements
+            # Begin by fetching the desired CED elements unless they were saved by an interrupted run
             # TODO - feedback to user b/c this can also take a while
-            inventory = Inventory(
-                config['ced']['zone'],
-                config['ced']['types'],
-                config['ced']['properties'],
-                config['ced']['expressions']
-            )
-            elements = inventory.elements()
+            elements = checkpoint.load_json(checkpoint_inventory_file)
+            if elements is None:
+                inventory = Inventory(
+                    config['ced']['zone'],
+                    config['ced']['types'],
+                    config['ced']['properties'],
+                    config['ced']['expressions']
+                )
+                elements = inventory.elements()
+                checkpoint.save_json(checkpoint_inventory_file, elements)
+            saved_tree = checkpoint.load_json(tree_file)
+            if saved_tree:
+                tree.tree = saved_tree
 
             # The dates for fetching
             dates = mya.date_ranges(config)
 
-            # pprint(mya.deployment)
-            # sys.exit(1)
-
-            # Retrieve the global PV list
-            sys.stdout.write("Fetching Global Data: ")
+            # The global PV list
             global_sampler = mya.Sampler(dates, config['mya']['global'])
-            global_data = global_sampler.data(with_spin=True)
-            sys.stdout.write("\n")
 
-            # Apply the filter condition to the global data to check whether any
-            # data will remain afterwards to work with.
-            filter = node.makeFilter(config['nodes']['filter'])
-            hasFilteredData = False
-            for data in global_data:
-                try:
-                    if filter.passes(data):
-                        hasFilteredData = True
-                        break
-                except FilterException as err:
-                    # The details of RuntimeErrors are stored in the args attribute, which is a list.
-                    logging.info(data['date'] + ' ' + err.args[0])
-            if not hasFilteredData:
-                raise RuntimeError("No post-filter data available. See warnings.log file.\n"
-                                   + "Verify correct mya instance and config filter expression")
+            candidates = []
+            for element in elements:
+                item = node.List.make_node(element, tree, config, dates)
+                # If no node was created, it means that there was not type match.  This could happen if
+                # the CED query was something broad like "BeamElem", but the config file only indicates the
+                # desired EPICS fields for specific sub-types (Magnet, BPM, etc.)
+                if item:
+                    item.prepare_sampler()
+                    candidates.append(item)
+            checkpoint.save_json(tree_file, tree.tree)
 
             # It's important to preserve the order of the elements in the nodeList.
             # We are going to assign each node a node_id property that corresponds to its
@@ -221,30 +336,93 @@ if __name__ == "__main__":
                 master_node.node_id = node_id
                 node_list.append(master_node)
                 node_id += 1
-                # pprint(vars(master_node))
-                # pprint(global_data)
-                # sys.exit(1)
-
-            for element in progressBar(elements, prefix='Fetching Node Data:', suffix='', length=60):
-                # Wrap node creating in a try-catch block so that we can simply log problematic nodes
-                # without killing the entire effort.
-                try:
-                    item = node.List.make_node(element, tree, config, dates)
-
-                    # If no node was created, it means that there was not type match.  This could happen if
-                    # the CED query was something broad like "BeamElem", but the config file only indicates the
-                    # desired EPICS fields for specific sub-types (Magnet, BPM, etc.)
-                    if item:
-                        # Load the data now so that we can give user a progressbar
-                        item.pv_data()
-                        # Assign id values based on order of encounter
-                        item.node_id = node_id
-                        node_list.append(item)
-                        node_id += 1
-                except mya.MyaException as err:
+
+            # Candidates whose data cannot be fetched are dropped from the list and the rest renumbered once
+            # their data has arrived
+            for item in candidates:
+                # Assign id values based on order of encounter
+                item.node_id = node_id
+                node_list.append(item)
+                node_id += 1
+
+            # Data sets are only appended to output whose graph is the same, which is known before any data is fetched
+            if manifest:
+                node.List.populate_links(node_list)
+                mismatch = hgb.manifest_mismatch(manifest, node_list, node.List.topology(node_list, config))
+                if mismatch:
+                    shutil.rmtree(checkpoint.directory)
+                    sys.exit(f"Unable to append to {output_dir} because {mismatch} since it was written")
+
+            # The global data and the data for every node are fetched together so that their PVs can be
+            # packed into as few requests as possible and PVs they share are only fetched once.  The global sampler
+            # comes first in the list so that its data can be checked against the filter without waiting for all
+            # the node data.  With filter_first, the global data is instead fetched on its own so that the node
+            # data need only be fetched for the times that pass the filter.
+            filter_first = config['mya'].get('filter_first', False)
+            if filter_first:
+                planner = mya.Planner([global_sampler])
+            else:
+                planner = mya.Planner([global_sampler] + [item.sampler for item in candidates])
+            fetched = planner.fetch()
+
+            sys.stdout.write("Fetching Global Data: ")
+            sys.stdout.flush()
+            sampler, err = next(fetched)
+            if err:
+                raise err
+            global_data = global_sampler.data()
+            sys.stdout.write("\n")
+
+            # Apply the filter condition to the global data to check whether any
+            # data will remain afterwards to work with.  The result is kept for writing the data sets.
+            filtered = node.makeFilter(config['nodes']['filter']).mask(global_data)
+            if manifest:
+                # Only the data sets that have not already been written are appended
+                new = ~numpy.isin(mya.to_epoch_ms([data['date'] for data in global_data]), manifest['times'])
+                filtered = (filtered[0] & new, {i: err for i, err in filtered[1].items() if new[i]})
+                if not filtered[0].any():
+                    print("No new data sets to append to " + output_dir)
+                    shutil.rmtree(checkpoint.directory)
+                    exit(0)
+            if not filtered[0].any():
+                for i, err in filtered[1].items():
+                    # The details of RuntimeErrors are stored in the args attribute, which is a list.
+                    logging.info(global_data[i]['date'] + ' ' + err.args[0])
+                raise RuntimeError("No post-filter data available. See warnings.log file.\n"
+                                   + "Verify correct mya instance and config filter expression")
+            if filter_first:
+                node_dates = global_sampler.dates_at(global_sampler.samples().times[filtered[0]])
+                for item in candidates:
+                    item.sampler.dates = node_dates
+                print(planner.report())
+                planner = mya.Planner([item.sampler for item in candidates])
+                fetched = planner.fetch()
+
+            # Nodes are delivered in their original order as soon as their data has arrived so that we can
+            # give the user a progressbar.  Problematic nodes are simply reported without killing the entire effort.
+            # Where asking again might succeed, the checkpoint is kept so that the run can be resumed to try them.
+            failed = set()
+            failures = 0    # The number of them that might be fetched by asking again
+            for (sampler, err), item in zip(progressBar(fetched, prefix='Fetching Node Data:', suffix='',
+                                                        length=60, total=len(candidates)), candidates):
+                if err:
                     print(err)
-            # Link each SetPointNode to its downstream nodes up to and including the next SetPoint.
-            node.List.populate_links(node_list)
+                    failed.add(item)
+                    if isinstance(err, mya.MyaServerException):
+                        failures += 1
+            print(planner.report())
+            if failed:
+                node_list = [item for item in node_list if item not in failed]
+                for node_id, item in enumerate(node_list):
+                    item.node_id = node_id
+                for item in failed:
+                    item.node_id = None
+                if manifest:
+                    if failures:
+                        print(f"Data for {failures} nodes could not be fetched.  Use --resume {output_dir} to try them again.")
+                    else:
+                        shutil.rmtree(checkpoint.directory)
+                    sys.exit(f"Unable to append to {output_dir} because data for {len(failed)} nodes could not be fetched")
 
         # Throw an exception if we have an empty node_list at this point to guard against having been provided
         # empty date ranges
@@ -254,19 +432,36 @@ if __name__ == "__main__":
         # Link each SetPointNode to its downstream nodes up to and including the next SetPoint.
         node.List.populate_links(node_list)
 
-        # At this point we've got all the data necessary to start writing out data sets
-        node.List.write_data_sets(global_data, node_list, config, output_dir)
+        topology = node.List.topology(node_list, config)
 
-        # Make graph files using the data_loader tools from Song Wang
-        loader = CEBAFGraphLoader(data_path=output_dir, directed=True)
-        loader.load_graph()
-        loader.make_pickles()
-
-        if not args.no_save_json:
+        # At this point we've got all the data necessary to start writing out data sets
+        written = node.List.write_data_sets(global_data, node_list, config, output_dir, filtered)
+        dates = [global_data[i]['date'] for i in written]
+        hgb.write_manifest(output_dir, config, node_list, topology, dates,
+                           mya.to_epoch_ms([data['date'] for data in global_data])[written], manifest)
+
+        # Make graph files using the data_loader tools from Song Wang.  A columnar store is read directly
+        # by data_loader.columnar instead.  When appending, only the graphs of the new data sets are made.
+        if written and config['output'].get('structure') != 'columnar':
+            time_steps = hgb.paths_from_dates('', dates, config['output']) if manifest else None
+            loader = CEBAFGraphLoader(data_path=output_dir, directed=True, time_steps=time_steps)
+            loader.load_graph()
+            loader.make_pickles()
+
+        # The json files describe the data fetched by the run that wrote the output, so they are left as they are
+        # when appending to it.
+        if not args.no_save_json and not manifest:
             # Copy the config file we just used to the top level output directory so it can be
-            # referenced as part of the data set.
+            # referenced as part of the data set.  A resumed run used the one saved by the interrupted run, or if
+            # that run saved no copy, the configuration it saved.
             config_file = os.path.basename(args.config_file)
-            shutil.copyfile(config_file, os.path.join(output_dir, 'config.yaml'))
+            if args.resume_dir:
+                config_file = os.path.join(checkpoint.directory, checkpoint_config_copy)
+            if args.resume_dir and not os.path.exists(config_file):
+                with open(os.path.join(output_dir, 'config.yaml'), 'w') as f:
+                    yaml.dump(config, f, sort_keys=False)
+            else:
+                shutil.copyfile(config_file, os.path.join(output_dir, 'config.yaml'))
 
             # Save the tree, nodes, and global data list to a file for later reuse
             indent = 2
@@ -289,12 +484,23 @@ if __name__ == "__main__":
             json.dump(tree.tree, f, indent=indent)
             f.close()
 
+        # The checkpoint is no longer needed unless there are nodes whose data might be fetched by trying again
+        if checkpoint:
+            if failures:
+                print(f"Data for {failures} nodes could not be fetched.  Use --resume {output_dir} to try them again.")
+            else:
+                shutil.rmtree(checkpoint.directory)
+
         exit(0)
 
     except json.JSONDecodeError as err:
         print(err)
         print("Oops!  Invalid JSON response. Check request parameters and try again.")
+        if mya.checkpoint:
+            print(f"Progress has been saved.  Use --resume {output_dir} to continue.")
         exit(1)
     except RuntimeError as err:
         print("Exception: ", err)
+        if mya.checkpoint:
+            print(f"Progress has been saved.  Use --resume {output_dir} to continue.")
         exit(1)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class CEBAFColumnarLoader(object):
+    '''
+    the class for the columnar store that ced2graph writes when output.structure is columnar.
+    Its arrays are memory-mapped, so any slice of time can be read without reading the rest.
+    '''
+    # the arrays of the store, which are described in modules/columnar.py
+    array_names = ['times', 'features', 'mask', 'globals', 'edge_index', 'edge_type', 'edge_weight']
+
+    def __init__(self, data_path='./20221114_072052'):
+        '''data_path is the store or the output directory that contains it'''
+        if not os.path.exists(os.path.join(data_path, 'dataset.json')):
+            data_path = os.path.join(data_path, 'columnar')
+        self.data_path = data_path
+        with open(os.path.join(data_path, 'dataset.json')) as f:
+            self.description = json.load(f)
+        for name in self.array_names:
+            setattr(self, name, np.load(os.path.join(data_path, name + '.npy'), mmap_mode='r'))
+
+    def time_slice(self, start=None, end=None):
+        '''
+        the slice of the timestamps from start to end, both included.
+        They are given either as epoch milliseconds or as local dates such as '2022-11-14 07:00:00'.
+        A local date that occurs twice as DST ends is the first of them as start and the second as end.
+        '''
+        first = 0 if start is None else int(np.searchsorted(self.times, self._epoch_ms(start, True), side='left'))
+        last = len(self) if end is None else int(np.searchsorted(self.times, self._epoch_ms(end, False), side='right'))
+        return slice(first, last)
+
+    def _epoch_ms(self, date, start):
+        '''the epoch milliseconds of a start or end given either way, local dates being in the timezone of the store'''
+        if isinstance(date, (int, np.integer)):
+            return int(date)
+        local = pd.Timestamp(date).tz_localize(self.description.get('timezone', 'America/New_York'), ambiguous=start,
+                                               nonexistent='shift_forward' if start else 'shift_backward')
+        return local.value // 1000000
+
+    def __getitem__(self, idx):
+        '''the feature matrix of the nodes at a timestamp or the feature tensor of a slice of them'''
+        return self.features[idx]
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return 'CEBAF columnar graph loader, %d graphs in total' % len(self)
+
+    @property
+    def nodes(self):
+        return self.description['nodes']
+
+    @property
+    def dates(self):
+        return self.description['dates']
+
+    @property
+    def num_graphs(self):
+        return len(self.times)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+import io
+import os
+import re
+import gzip
+import numpy as np
+import pandas as pd
+
+# zstandard is optional.  It is only needed for graphs written with zstd output compression.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def open_text(path):
+    '''
+    open the text file at path for reading or, if there is none,
+    the file of the same name compressed by ced2graph with gzip (.gz) or zstd (.zst)
+    '''
+    if os.path.exists(path):
+        return open(path)
+    if os.path.exists(path + '.gz'):
+        return gzip.open(path + '.gz', 'rt')
+    if os.path.exists(path + '.zst'):
+        if zstandard is None:
+            raise RuntimeError('The zstandard package is required to read ' + path + '.zst')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path + '.zst', 'rb')))
+    raise FileNotFoundError(path)
+
+
+def to_float(tokens):
+    '''
+    convert the text of feature values to float64 all at once. <undefined> and anything else that is not
+    a number becomes NaN, as do infinite values, which were never read as numbers either
+    '''
+    tokens = np.array(tokens, dtype=str)
+    tokens[tokens == '<undefined>'] = 'nan'
+    try:
+        values = tokens.astype(np.float64)
+    except ValueError:
+        values = pd.to_numeric(pd.Series(tokens), errors='coerce').to_numpy(dtype=np.float64)
+    values[np.isinf(values)] = np.nan
+    return values
+
+
+def to_integral(tokens):
+    '''which of the text of feature values is written as an integer, as eval read it into an int'''
+    integer = re.compile(r'[-+]?\d+')
+    return np.array([integer.fullmatch(token.strip()) is not None for token in tokens], dtype=bool)
+
+
+class NodeData(object):
+    '''
+    the nodes of a node.dat file as arrays. Nodes have different numbers of features, so the features of
+    all of them are kept in one flat array, with those of node i at values[offsets[i]:offsets[i + 1]].
+    integral marks the values that were written as integers
+    '''
+    def __init__(self, node_id, name, node_type, values, offsets, integral=None):
+        self.node_id = node_id
+        self.name = name
+        self.node_type = node_type
+        self.values = values
+        self.offsets = offsets
+        self.integral = np.zeros(len(values), dtype=bool) if integral is None else integral
+
+    def attributes(self):
+        '''the list of the features of each node, with those written as integers as ints'''
+        values = self.values.tolist()
+        for i in np.flatnonzero(self.integral).tolist():
+            values[i] = int(values[i])
+        offsets = self.offsets.tolist()
+        return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def padded(self):
+        '''the (N, F) matrix of the features of the N nodes, padded with NaN to the F features of the widest'''
+        counts = np.diff(self.offsets)
+        matrix = np.full((len(counts), counts.max(initial=0)), np.nan)
+        matrix[np.arange(matrix.shape[1]) < counts[:, None]] = self.values
+        return matrix
+
+    def set_attributes(self, i, attr):
+        '''replace the features of node i'''
+        start, end = self.offsets[i], self.offsets[i + 1]
+        self.values = np.concatenate([self.values[:start], np.asarray(attr, dtype=np.float64), self.values[end:]])
+        self.integral = np.concatenate([self.integral[:start],
+                                        np.array([isinstance(value, (int, np.integer)) for value in attr], dtype=bool),
+                                        self.integral[end:]])
+        self.offsets = self.offsets.copy()
+        self.offsets[i + 1:] += len(attr) - (end - start)
+
+    def __len__(self):
+        return len(self.node_id)
+
+
+def read_node_dat(path):
+    '''read the nodes of a node.dat file written by ced2graph into a NodeData'''
+    with open_text(path) as f:
+        # each line after the header is NODE, NAME, TYPE and the comma-separated VALUES, separated by tabs
+        rows = [line.split('\t') for line in f.read().splitlines()[1:] if line]
+    node_id, name, node_type, features = zip(*rows) if rows else ([], [], [], [])
+    features = [feature.strip() for feature in features]
+    counts = np.array([feature.count(',') + 1 if feature else 0 for feature in features], dtype=np.int64)
+    tokens = ','.join(feature for feature in features if feature).split(',') if counts.any() else []
+    return NodeData(
+        np.array([int(value) for value in node_id], dtype=np.int64),
+        [value.strip() for value in name],
+        np.array([int(value) for value in node_type], dtype=np.int64),
+        to_float(tokens),
+        np.concatenate([[0], np.cumsum(counts)]),
+        to_integral(tokens),
+    )
+
+
+def read_link_dat(path):
+    '''
+    read the edges of a link.dat file as a (2, E) edge index and the type and weight of each edge.
+    The weights are int64 if every one is written as an integer and otherwise float64
+    '''
+    with open_text(path) as f:
+        df = pd.read_csv(f, sep='\t')
+    weight = df['LINK_WEIGHT']
+    return (df[['START', 'END']].to_numpy(dtype=np.int64).T,
+            df['LINK_TYPE'].to_numpy(dtype=np.int64),
+            weight.to_numpy(dtype=np.int64 if pd.api.types.is_integer_dtype(weight) else np.float64))
+
+
+def edge_order(edge_index, node_id, directed=False):
+    '''
+    the edges of edge_index as a (2, E) index of the positions of the nodes in node_id rather than their ids,
+    along with the position in edge_index of the edge whose type and weight each has. They are the edges networkx
+    gives a graph built by adding the nodes and then the edges in order, listed in the order it lists them: by
+    source, then by the order they were added. As in networkx, there is only one edge between the same nodes, in
+    the place of the first added between them but with the type and weight of the last. An undirected edge is
+    listed in both directions, as it is when such a graph is converted to a directed one.
+    '''
+    sorter = np.argsort(node_id, kind='stable')
+    positions = sorter[np.searchsorted(node_id, edge_index, sorter=sorter)].reshape(2, -1)
+    # an undirected edge joins the same nodes whichever way round they are given
+    pairs = positions if directed else np.sort(positions, axis=0)
+    if pairs.shape[1]:
+        _, first = np.unique(pairs, axis=1, return_index=True)
+        _, last = np.unique(pairs[:, ::-1], axis=1, return_index=True)
+        last = pairs.shape[1] - 1 - last
+    else:
+        first = last = np.zeros(0, dtype=np.int64)
+    added = np.argsort(first, kind='stable')
+    positions, first, edges = positions[:, first[added]], first[added], last[added]
+    if not directed:
+        reverse = positions[0] != positions[1]
+        positions = np.concatenate([positions, positions[::-1, reverse]], axis=1)
+        first = np.concatenate([first, first[reverse]])
+        edges = np.concatenate([edges, edges[reverse]])
+    order = np.lexsort((first, positions[0]))
+    return positions[:, order], edges[order]
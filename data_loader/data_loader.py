@@ -11,15 +11,17 @@ from data_loader.data_utils import CEBAFGraph
 
 
 class CEBAFGraphLoader(object):
-    def __init__(self, start_datehour=None, end_datehour=None, data_path='./20221114_072052', directed=False):
+    def __init__(self, start_datehour=None, end_datehour=None, data_path='./20221114_072052', directed=False,
+                 time_steps=None):
         '''
         init the loader with the time range, from start_datehour to end_datehour,
-        both included. data_path is the directory storing the graphs
+        both included. data_path is the directory storing the graphs.
+        time_steps optionally limits the graphs to those in the given directories relative to data_path.
         '''
         self.start = start_datehour
         self.end = end_datehour
         self.data_path = data_path
-        self.time_steps = self._create_file_paths()
+        self.time_steps = self._create_file_paths() if time_steps is None else list(time_steps)
         self.file_names = ['node.dat', 'link.dat', 'info.dat', 'meta.dat']
         self.pickle_name = 'graph.pkl'
         self.datetime2id = {}
@@ -43,7 +45,9 @@ class CEBAFGraphLoader(object):
         time_stamps=[]
         for dir_name in os.listdir(self.data_path):
             full_dir_name = os.path.join(self.data_path, dir_name)
-            if (os.path.isdir(full_dir_name)):      # excludes config.yaml or other top-level files
+            # excludes config.yaml or other top-level files and directories that are not graphs, such as
+            # a columnar store or the checkpoint of a run.  The files of a graph may be compressed.
+            if any(os.path.isfile(os.path.join(full_dir_name, 'node.dat' + suffix)) for suffix in ['', '.gz', '.zst']):
                 time_stamps.append(dir_name)
         return time_stamps
 
@@ -7,11 +7,33 @@ import torch
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
-from torch_geometric.utils.convert import from_networkx
+from torch_geometric.data import Data
+from data_loader.dat import open_text, read_node_dat, read_link_dat, edge_order
+
+# the tensors of the edges of each distinct topology, which the graphs of every timestamp of a run share
+# rather than each having copies of their own
+_topologies = {}
+
+
+def topology_tensors(node_id, edge_index, edge_type, edge_weight, directed=False):
+    '''
+    the edge_index, edge_type and weight tensors of a topology, in the order and dtypes that from_networkx gave
+    them. Each row of link.dat was read as a whole, so the edge types were float64 like the weights unless every
+    weight was an integer
+    '''
+    key = (node_id.tobytes(), edge_index.tobytes(), edge_type.tobytes(), edge_weight.tobytes(), directed)
+    if key not in _topologies:
+        positions, edges = edge_order(edge_index, node_id, directed)
+        _topologies[key] = (torch.from_numpy(positions), torch.from_numpy(edge_type[edges].astype(edge_weight.dtype)),
+                            torch.from_numpy(edge_weight[edges]))
+    return _topologies[key]
 
 
 class CEBAFGraph(object):
-    '''the class for a single cebaf graph, it stores the graph in a nx.Graph() object'''
+    '''
+    the class for a single cebaf graph, it stores the nodes and edges as arrays, from which
+    a nx.Graph() object is built if it is needed
+    '''
     def __init__(self, node, link, info, meta, dt, directed=False):
         '''init a cebaf graph'''
         self.total_num = None
@@ -19,58 +41,57 @@ class CEBAFGraph(object):
         self._parse_meta(meta)
         self._parse_info(info)
         self.directed=directed
-        self.graph = self._parse_node_and_link(node, link)
+        self._graph = None
+        self._parse_node_and_link(node, link)
         self.time = dt
 
         # also return a pd.Series
-        d = {}
-        for n in self.graph.nodes():
-            d[self.graph.nodes()[n]['name']] = self.graph.nodes()[n]['attr']
+        d = dict(zip(self.nodes.name, self.nodes.attributes()))
         self.df = pd.DataFrame(data=[[self.time] + list(d.values())],  columns=['timestamp']+list(d.keys()))
 
     def _parse_meta(self, meta):
         '''parse meta data, contains total # of nodes, and # of node from each type'''
         pattern = re.compile('\d+')
-        with open(meta) as f:
+        with open_text(meta) as f:
             for idx, line in enumerate(f):
                 if idx == 0:
-                    self.total_num = eval(pattern.findall(line)[0])
+                    self.total_num = int(pattern.findall(line)[0])
                 else:
-                    class_num = eval(pattern.findall(line)[-1])
+                    class_num = int(pattern.findall(line)[-1])
                     self.node_type[idx-1] = {'num': class_num}
     
     def _parse_info(self, info):
         '''parse info, contains the name for the node type, and the name for attrs'''
         pattern = re.compile('\s+')
-        with open(info) as f:
+        with open_text(info) as f:
             for idx, line in enumerate(f):
                 if idx == 0: continue
                 t, n, l = pattern.split(line.strip())
-                self.node_type[eval(t)]['name'] = n
-                self.node_type[eval(t)]['labels'] = l.split(',')
+                self.node_type[int(t)]['name'] = n
+                self.node_type[int(t)]['labels'] = l.split(',')
 
     def _parse_node_and_link(self, node, link):
-        '''parse node and link list, store the information in a nx.Graph'''
-        if self.directed:
-            g=nx.DiGraph()
-        else:
-            g = nx.Graph()
-        df = pd.read_csv(node, sep='\t')
-        edge_type = []
-        for _, row in df.iterrows():
-            attr = []
-            for v in row['VALUES'].strip().split(','):
-                try:
-                    attr.append(eval(v))
-                except Exception:
-                    attr.append(np.nan)
-            g.add_node(row['NODE'], name=row['NAME'].strip(), node_type=row['TYPE'], attr=attr)
-
-        df = pd.read_csv(link, sep='\t')
-        for _, row in df.iterrows():
-            g.add_edge(row['START'], row['END'], edge_type=row['LINK_TYPE'], weight=row['LINK_WEIGHT'])
-
-        return g
+        '''parse node and link list into arrays'''
+        # the nodes are read into arrays all at once, with <undefined> features as NaN
+        self.nodes = read_node_dat(node)
+        # the edges are kept as arrays: a (2, E) edge index and the type and weight of each edge
+        self.edge_index, self.edge_type, self.edge_weight = read_link_dat(link)
+
+    @property
+    def graph(self):
+        '''the nx.Graph of the nodes and edges, which is built the first time it is needed'''
+        if self._graph is None:
+            if self.directed:
+                g=nx.DiGraph()
+            else:
+                g = nx.Graph()
+            g.add_nodes_from((node_id, {'name': name, 'node_type': node_type, 'attr': attr}) for node_id, name, node_type, attr
+                             in zip(self.nodes.node_id.tolist(), self.nodes.name, self.nodes.node_type.tolist(),
+                                    self.nodes.attributes()))
+            g.add_edges_from((start, end, {'edge_type': edge_type, 'weight': weight}) for start, end, edge_type, weight
+                             in zip(*self.edge_index.tolist(), self.edge_type.tolist(), self.edge_weight.tolist()))
+            self._graph = g
+        return self._graph
 
     def draw_graph(self):
         pos = nx.circular_layout(self.graph, scale=2)
@@ -92,26 +113,39 @@ class CEBAFGraph(object):
                                    edge_color=np.array(cmap.colors[idx]).reshape(1, -1))
 
     def _to_pyg(self):
-        # first convert to standard data
-        data = from_networkx(self.graph)
-        # data = data.to_heterogeneous()
-        for i in range(len(data.attr)):
-            data.attr[i] = torch.nan_to_num(torch.tensor(data.attr[i]))
-        return data
+        '''build the Data of the graph straight from its arrays, with the attributes and dtypes from_networkx gave it'''
+        edge_index, edge_type, weight = topology_tensors(self.nodes.node_id, self.edge_index, self.edge_type,
+                                                         self.edge_weight, self.directed)
+        return Data(edge_index=edge_index, name=list(self.nodes.name), node_type=torch.from_numpy(self.nodes.node_type),
+                    attr=self._attr(), edge_type=edge_type, weight=weight, num_nodes=len(self.nodes))
+
+    def _attr(self):
+        '''
+        the features of the nodes with NaN as 0 as from_networkx gave them: a single (N, F) tensor if all N nodes
+        have F features and otherwise a tensor for each node. A tensor is int64 if its features were all written
+        as integers and otherwise float32
+        '''
+        values = np.nan_to_num(self.nodes.values)
+        integral = self.nodes.integral
+        counts = np.diff(self.nodes.offsets)
+        dtype = torch.get_default_dtype()
+        if len(counts) and (counts == counts[0]).all():
+            return torch.from_numpy(values.reshape(len(counts), counts[0])).to(
+                torch.int64 if values.size and integral.all() else dtype)
+        starts = self.nodes.offsets[:-1].tolist()
+        return [torch.from_numpy(row).to(torch.int64 if count and integral[start:start + count].all() else dtype)
+                for row, start, count in zip(np.split(values, starts[1:]), starts, counts.tolist())]
 
     def _to_tensor(self):
         # flatten the graph to a huge vector
-        vec = []
-        node_attrs = nx.get_node_attributes(self.graph, 'attr')
-        for attr in node_attrs.values():
-            vec.extend(attr)
-        vec = np.nan_to_num(np.array(vec))
-        return torch.tensor(vec, dtype=torch.float32)
+        return torch.tensor(np.nan_to_num(self.nodes.values), dtype=torch.float32)
 
     def change_node_attr(self, node, new_attr):
-        node_attr = self.graph.nodes[node]
-        node_attr['attr'] = new_attr
-        nx.set_node_attributes(self.graph, {node: node_attr})
+        self.nodes.set_attributes(int(np.flatnonzero(self.nodes.node_id == node)[0]), new_attr)
+        if self._graph is not None:
+            node_attr = self._graph.nodes[node]
+            node_attr['attr'] = new_attr
+            nx.set_node_attributes(self._graph, {node: node_attr})
 
     def __repr__(self):
         return 'CEBAF graph at %s with %d nodes and %d node types' % (
@@ -120,7 +154,7 @@ class CEBAFGraph(object):
 
     @property
     def num_nodes(self):
-        return self.graph.number_of_nodes()
+        return len(self.nodes)
  
     @property
     def num_edges(self):
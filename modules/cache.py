@@ -0,0 +1,296 @@
+# Module of classes for keeping data fetched from web services on local disk so that
+# later runs need not fetch it again.
+
+import os
+import io
+import json
+import time
+import hashlib
+import itertools
+import tempfile
+import threading
+import contextlib
+import numpy
+
+# fcntl is unavailable on Windows, where locking between processes is simply skipped.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Default maximum size in megabytes of a cache directory.
+max_size = 2048
+
+
+# Return a (times, values) tuple of the samples in a list of (times, values) parts, each sorted by time,
+# as a single pair of arrays sorted by time.  Where parts have samples at the same time, the last one's value is kept.
+def consolidate(parts: list) -> tuple:
+    if not parts:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.float64)
+    if len(parts) == 1:
+        return parts[0]
+    # Reversed, the first occurrence of each time, which is the one numpy.unique finds, is the last one provided
+    times, first = numpy.unique(numpy.concatenate([times for times, values in reversed(parts)]), return_index=True)
+    return times, numpy.concatenate([values for times, values in reversed(parts)])[first]
+
+
+class Store:
+    """Class to keep files in a directory with size-based LRU eviction, safe for concurrent use by several runs"""
+
+    # Name of the file used to serialize writes between processes sharing the directory.
+    lock_file = 'cache.lock'
+
+    # Instantiate the object
+    #   directory is where the cached files are kept.  It is created if necessary.
+    #   size is the maximum size of the directory in megabytes before least recently used files are evicted.
+    def __init__(self, directory: str, size: int = None):
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = (size if size is not None else max_size) * 1024 * 1024
+        self._thread_lock = threading.Lock()
+
+    # Return the file path for a key.  Keys can be any tuple of values; they are hashed to
+    # make file names that are safe regardless of the characters used in PV names, etc.
+    def path(self, key: tuple, suffix: str = '') -> str:
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + suffix)
+
+    # Hold an exclusive lock on the directory for the duration of a with block.
+    # Readers never need the lock because files are always replaced atomically.
+    @contextlib.contextmanager
+    def locked(self):
+        with self._thread_lock:
+            with open(os.path.join(self.directory, self.lock_file), 'a') as handle:
+                if fcntl:
+                    fcntl.flock(handle, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(handle, fcntl.LOCK_UN)
+
+    # Return the contents of the file for key or None if it is not cached.
+    # Reading a file marks it as recently used.
+    def read(self, key: tuple, suffix: str = ''):
+        path = self.path(key, suffix)
+        try:
+            with open(path, 'rb') as handle:
+                contents = handle.read()
+            os.utime(path)
+            return contents
+        except FileNotFoundError:
+            return None
+
+    # Replace the file for key with contents.
+    def write(self, key: tuple, contents: bytes, suffix: str = ''):
+        self._replace(self.path(key, suffix), contents)
+
+    # Replace the file at path with contents.  The file is written under a temporary name and then
+    # renamed so that a concurrent reader sees either the old or the new file, never a partial one.
+    def _replace(self, path: str, contents: bytes):
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                temp_file.write(contents)
+            os.replace(temp_path, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+
+    # Remove the least recently used files until the directory is no larger than its maximum size.
+    # The files of subdirectories, such as those of ArchiveCache, are evicted individually.
+    def evict(self):
+        with self.locked():
+            entries = []
+            total = 0
+            for entry in itertools.chain(os.scandir(self.directory), *(
+                    os.scandir(entry.path) for entry in os.scandir(self.directory) if entry.is_dir())):
+                if entry.is_file() and entry.name != self.lock_file:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                # Leftover temporary files from an interrupted write are only removed once they are stale
+                if path.endswith('.tmp') and time.time() - mtime < 3600:
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                total -= size
+
+
+class ArchiveCache(Store):
+    """Class to cache values sampled from the Mya archiver keyed by PV, deployment and sampling interval"""
+
+    # Bumped whenever the format of the cached files changes so that old files are simply never read.
+    version = 3
+
+    # The number of segments a pv may have before they are compacted into one.  See merge.
+    max_segments = 16
+
+    # Used with the time and process id to give the segments written by a process distinct names in order
+    _sequence = itertools.count()
+
+    def key(self, pv: str, deployment: str, interval_ms: int) -> tuple:
+        return ('mya', self.version, pv, deployment, interval_ms)
+
+    # Return the paths of the segment files of a pv, oldest first
+    def segments(self, pv: str, deployment: str, interval_ms: int) -> list:
+        directory = self.path(self.key(pv, deployment, interval_ms))
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith('.npz'))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, name) for name in names]
+
+    # Return a (times, values) tuple of the cached samples of a pv, where times is a sorted array
+    # of epoch milliseconds and values is the corresponding float64 array in which NaN is <undefined>.
+    # Reading the segments of a pv marks them as recently used.
+    def load(self, pv: str, deployment: str, interval_ms: int) -> tuple:
+        parts = []
+        for path in self.segments(pv, deployment, interval_ms):
+            try:
+                with numpy.load(path) as data:
+                    parts.append((data['times'], data['values']))
+                os.utime(path)
+            except FileNotFoundError:
+                continue    # Compacted or evicted since the segments were listed
+        return consolidate(parts)
+
+    # Add samples of a pv to the cache.  Newly provided values replace any cached for the same times.
+    # Rather than rewriting everything cached for the pv, the samples are saved as a segment file of their own
+    # in the pv's directory, so that concurrent merges need not wait on each other.  Once the pv has more than
+    # max_segments segments, they are compacted into one.
+    def merge(self, pv: str, deployment: str, interval_ms: int, times, values):
+        times = numpy.asarray(times, dtype=numpy.int64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if not len(times):
+            return
+        directory = self.path(self.key(pv, deployment, interval_ms))
+        os.makedirs(directory, exist_ok=True)
+        buffer = io.BytesIO()
+        numpy.savez(buffer, times=times, values=values)
+        name = f'{time.time_ns():020d}.{os.getpid()}.{next(self._sequence):06d}.npz'
+        self._replace(os.path.join(directory, name), buffer.getvalue())
+        if len(self.segments(pv, deployment, interval_ms)) > self.max_segments:
+            self.compact(pv, deployment, interval_ms)
+
+    # Replace the segments of a pv with a single one holding all of their samples
+    def compact(self, pv: str, deployment: str, interval_ms: int):
+        with self.locked():
+            paths = self.segments(pv, deployment, interval_ms)
+            if len(paths) <= 1:
+                return
+            parts = []
+            for path in paths:
+                with contextlib.suppress(FileNotFoundError), numpy.load(path) as data:
+                    parts.append((data['times'], data['values']))
+            times, values = consolidate(parts)
+            buffer = io.BytesIO()
+            numpy.savez(buffer, times=times, values=values)
+            # The compacted segment takes the place of the newest one, so segments written since still follow it
+            self._replace(paths[-1], buffer.getvalue())
+            for path in paths[:-1]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+
+class CedCache(Store):
+    """Class to cache the responses of the CED Web API"""
+
+    # Bumped whenever the format of the cached files changes so that old files are simply never read.
+    version = 1
+
+    def key(self, *parts) -> tuple:
+        return ('ced', self.version) + parts
+
+    # Return the object cached for key or None if there is none.  If ttl is provided, objects cached
+    # more than ttl seconds ago are treated as if they were not cached.
+    def load(self, key: tuple, ttl: float = None):
+        entry = self.entry(key)
+        if entry is None or (ttl is not None and time.time() - entry['saved'] > ttl):
+            return None
+        return entry['data']
+
+    # Return what is cached for key however long ago it was saved, as a dictionary of the time it was saved,
+    # the object and the validators saved with it, or None if there is nothing.
+    def entry(self, key: tuple):
+        contents = self.read(key, '.json')
+        if contents is None:
+            return None
+        entry = json.loads(contents)
+        entry.setdefault('validators', {})
+        return entry
+
+    # Cache an object that can be represented as json under key, along with the validators of the response it
+    # came from, such as its ETag, by which the server can later be asked whether it has changed.
+    def save(self, key: tuple, obj, validators: dict = None):
+        entry = {'saved': time.time(), 'data': obj, 'validators': validators or {}}
+        self.write(key, json.dumps(entry).encode('utf-8'), '.json')
+
+
+class Checkpoint(Store):
+    """Class to save the values sampled during a run as they arrive so that an interrupted run can be resumed"""
+
+    # Instantiate the object
+    #   directory is where the checkpoint is kept.  Samples saved there by an earlier attempt at the run are loaded.
+    #
+    # The methods for samples are the same as those of ArchiveCache, but rather than rewriting the file of a pv
+    # every time more of its samples arrive, each batch is saved to a file of its own.  A checkpoint is never
+    # evicted; it is meant to be removed once the run is complete.
+    def __init__(self, directory: str):
+        super().__init__(directory)
+        self._samples = {}
+        self._samples_lock = threading.Lock()
+        batches = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                with numpy.load(entry.path) as data:
+                    key = (str(data['pv']), str(data['deployment']), int(data['interval_ms']))
+                    saved = int(data['saved']) if 'saved' in data else 0
+                    batches.append((saved, entry.name, key, data['times'], data['values']))
+        # The batches are kept in the order they were saved so that the latest samples of a pv win
+        for saved, name, key, times, values in sorted(batches, key=lambda batch: batch[:2]):
+            self._samples.setdefault(key, []).append((times, values))
+
+    # Return a (times, values) tuple of the saved samples of a pv as described for ArchiveCache.load.
+    def load(self, pv: str, deployment: str, interval_ms: int) -> tuple:
+        with self._samples_lock:
+            parts = self._samples.get((pv, deployment, interval_ms))
+            if not parts:
+                return consolidate([])
+            if len(parts) > 1:
+                # Consolidate the batches so that they need not be sorted again on the next load.
+                # Where batches overlap, the samples of the latest are kept.
+                parts[:] = [consolidate(parts)]
+            return parts[0]
+
+    # Save samples of a pv
+    def merge(self, pv: str, deployment: str, interval_ms: int, times, values):
+        times = numpy.asarray(times, dtype=numpy.int64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if not len(times):
+            return
+        buffer = io.BytesIO()
+        numpy.savez(buffer, times=times, values=values, pv=pv, deployment=deployment, interval_ms=interval_ms,
+                    saved=time.time_ns())
+        # A repeated request for the same samples replaces the earlier file rather than adding another
+        self.write(('checkpoint', pv, deployment, interval_ms, int(times[0]), len(times)), buffer.getvalue(), '.npz')
+        with self._samples_lock:
+            self._samples.setdefault((pv, deployment, interval_ms), []).append((times, values))
+
+    # Save an object as a json file of the given name in the checkpoint directory.
+    # Values json does not support, such as the dates yaml may read from a config file, are saved as strings.
+    def save_json(self, name: str, obj):
+        self._replace(os.path.join(self.directory, name), json.dumps(obj, default=str).encode('utf-8'))
+
+    # Return the object saved by save_json under name or None if there is no such file.
+    def load_json(self, name: str):
+        try:
+            with open(os.path.join(self.directory, name), 'r') as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return None
@@ -2,7 +2,9 @@
 # Module of classes for interacting with CED Web API to fetch data.
 
 import json
+import time
 import requests
+import modules.util as util
 
 # The module-wide base URL for CED web API.
 # It can be changed to instead query the LED, UED, etc. alternatives
@@ -20,6 +22,52 @@ workspace = None
 #   S: necessary to calculate distances between elements
 properties = ['S', 'EPICSName']
 
+# An optional cache.CedCache in which responses of the CED web API are kept between runs.
+cache = None
+
+# The number of seconds for which cached responses remain valid.  Responses for a history workspace
+# never change, so they remain valid for as long as they are cached.
+ttl = 3600
+
+# The number of times to retry a request that failed for a transient reason such as a dropped connection,
+# and the number of seconds to wait before the first retry.  The wait doubles with every retry.
+retries = 4
+backoff = 2
+
+# The errors of requests that failed for a transient reason
+transient = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError)
+
+# The headers of a response that identify the version of what it returned, each with the header of a request
+# that asks for the response only if it has changed since that version.
+validator_headers = {'ETag': 'If-None-Match', 'Last-Modified': 'If-Modified-Since'}
+
+# Return the key identifying cached responses for the specified query parameters along with the
+# number of seconds for which such responses are valid (None for ever).
+def cache_key(*params) -> tuple:
+    key = cache.key(*params, history, workspace)
+    return key, (None if history and workspace else ttl)
+
+# Return the data cached under key if it was saved less than valid_for seconds ago (None for ever).  Otherwise
+# it is fetched by calling get with the headers of a request and read from the response by calling read, and then
+# cached.  If the cached data has expired but was saved with validators, the request is conditional on it having
+# changed, and when the server answers 304 Not Modified the cached data is used again without being downloaded.
+# Requests that fail for transient reasons are repeated as described for util.retry.
+def cached_fetch(key: tuple, valid_for, get, read):
+    entry = cache.entry(key)
+    if entry is not None and (valid_for is None or time.time() - entry['saved'] <= valid_for):
+        return entry['data']
+    validators = entry['validators'] if entry is not None else {}
+    headers = {validator_headers[name]: value for name, value in validators.items() if name in validator_headers}
+    response = util.retry(lambda: get(headers), retries, backoff, transient)
+    if entry is not None and response.status_code == 304:
+        data = entry['data']
+    else:
+        data = read(response)
+        validators = {name: response.headers[name] for name in validator_headers if name in response.headers}
+    cache.save(key, data, validators)
+    return data
+
+
 class Inventory:
     """Class to query the CED Web API and retrieve a list of elements by zone and type"""
 
@@ -62,12 +110,32 @@ class Inventory:
             query['wrkspc'] = workspace
         return query
 
+    # Make a request to the CED Web API with any extra headers, raising an HTTPError if the server says to
+    # try again later
+    def get(self, headers: dict = None):
+        # Set verify to False because of jlab MITM interference
+        response = requests.get(self.url, self.queryParams(), headers=headers, verify=False)
+        if response.status_code in util.transient_status:
+            response.raise_for_status()
+        return response
+
     # Query CED Web API and return the resulting array of elements.
+    # Requests that fail for transient reasons are repeated as described for util.retry.
+    # Elements are taken from the cache if possible, as described for cached_fetch, and saved to it otherwise.
     # Throws if server response cannot be parsed as json.
     def elements(self) -> dict:
+        if cache is not None:
+            key, valid_for = cache_key(self.url, self.zone, self.types, sorted(self.properties), self.expressions)
+            return cached_fetch(key, valid_for, self.get, self.read_elements)
+        return self.fetch_elements()
+
+    # Query CED Web API and return the resulting array of elements.
+    def fetch_elements(self) -> dict:
+        return self.read_elements(util.retry(self.get, retries, backoff, transient))
+
+    # Return the array of elements in a response of the CED Web API
+    def read_elements(self, response) -> dict:
         try:
-            # Set verify to False because of jlab MITM interference
-            response = requests.get(self.url, self.queryParams(), verify=False)
             data_dictionary = response.json()
             if data_dictionary['stat'] == 'ok':
                 return data_dictionary['Inventory']['elements']
@@ -93,11 +161,40 @@ class TypeTree:
     def __init__(self):
         self.tree = {}
 
-    # Retrieve Type tree data from the server and store it in self.tree
+    # The type hierarchy as a dictionary of nested dictionaries.
+    # Assigning it, whether from the server or from a saved file, discards the index built from the previous one.
+    @property
+    def tree(self) -> dict:
+        return self._tree
+
+    @tree.setter
+    def tree(self, tree: dict):
+        self._tree = tree
+        self._lineages = None   # Lineage of each type keyed by its upper-cased name.  See _index.
+        self._ancestors = None  # Set of the upper-cased names in each lineage
+        self._matches = {}      # Memo of match() results
+
+    # Retrieve Type tree data from the cache, as described for cached_fetch, or the server and store it in self.tree
     def _populate_tree(self):
+        if cache is not None:
+            key, valid_for = cache_key(self.url)
+            self.tree = cached_fetch(key, valid_for, self.get, lambda response: response.json())
+        else:
+            self.tree = self._fetch_tree()
+
+    # Make a request for the type tree with any extra headers, raising an HTTPError if the server says to
+    # try again later
+    def get(self, headers: dict = None):
         # Set verify to False because of jlab MITM interference w/SSL
-        response = requests.get(self.url, verify=False)
-        self.tree = response.json()
+        response = requests.get(self.url, headers=headers, verify=False)
+        if response.status_code in util.transient_status:
+            response.raise_for_status()
+        return response
+
+    # Retrieve Type tree data from the server.
+    # Requests that fail for transient reasons are repeated as described for util.retry.
+    def _fetch_tree(self) -> dict:
+        return util.retry(self.get, retries, backoff, transient).json()
 
     # Receive notification of access to self.tree so that it can be populated
     # if necessary
@@ -105,6 +202,28 @@ class TypeTree:
         if not self.tree:
             self._populate_tree()
 
+    # Build the index of the lineage of every type in the tree if it has not been built already.
+    # Should a name appear more than once in the tree, its first appearance in depth-first order is
+    # the one indexed, as it is the one a search of the tree finds.
+    def _index(self):
+        self._notify_access()
+        if self._lineages is None:
+            lineages = {}
+            stack = [(iter(self.tree.items()), [])]
+            while stack:
+                items, parents = stack[-1]
+                item = next(items, None)
+                if item is None:
+                    stack.pop()
+                    continue
+                key, value = item
+                lineage = parents + [key]
+                lineages.setdefault(key.upper(), lineage)
+                if isinstance(value, dict):
+                    stack.append((iter(value.items()), lineage))
+            self._ancestors = {name: {key.upper() for key in lineage} for name, lineage in lineages.items()}
+            self._lineages = lineages
+
     # Answer if the type2 is a descendant (or identical) type as type1 based on CED hierarchy.
     #
     # Examples:
@@ -114,13 +233,21 @@ class TypeTree:
     #
     # Return: boolean
     def is_a(self, type1, type2):
-        self._notify_access()
-        found, lineage = self.lineage(type2)
-        if not found:
+        self._index()
+        ancestors = self._ancestors.get(type2.upper())
+        if ancestors is None:
             raise RuntimeError(type2 + " Not found in CED hierarchy.")
         else:
             # Be nice and do a case-insensitive comparison
-            return type1.upper() in map(lambda x:x.upper(), lineage)
+            return type1.upper() in ancestors
+
+    # Return the first of type_names of which type_name is a descendant (or identical) type, or None if there is none.
+    # The answer is remembered because elements of the same type are classified again and again.
+    def match(self, type_names: tuple, type_name: str):
+        key = (type_names, type_name.upper())
+        if key not in self._matches:
+            self._matches[key] = next((name for name in type_names if self.is_a(name, type_name)), None)
+        return self._matches[key]
 
     # Return the list of CED Types in the hierarchy to which the specified type belongs
     #   type_name is the name of the CED Type whose lineage is being retrieved
@@ -129,6 +256,12 @@ class TypeTree:
     #
     # Return (boolean, list)
     def lineage(self, type_name: str, branch: dict = None, parents: list = None):
+        # The entire tree is indexed
+        if branch is None and parents is None:
+            self._index()
+            lineage = self._lineages.get(type_name.upper())
+            return (True, lineage.copy()) if lineage is not None else (False, [])
+
         self._notify_access()
         # The default behavior is to search the entire tree
         if parents is None:
@@ -152,4 +285,3 @@ class TypeTree:
                 break
             lineage = parents.copy()  # reset for next iteration
         return found, lineage
-
@@ -0,0 +1,118 @@
+# Module for outputting all of the graph data sets of a run as a single columnar store rather than
+# a directory of .dat files for each timestamp.
+#
+# The store is a directory of numpy .npy files, each of which can be memory-mapped so that any slice of time
+# can be read without reading the rest, along with a json file that describes them:
+#   times.npy        int64 (T) epoch milliseconds of each timestamp
+#   features.npy     float64 (T, N, F) attribute values of each node at each timestamp, NaN where undefined.
+#                    Nodes with fewer than F attributes are padded with NaN.
+#   mask.npy         bool (N, F) of which of the F features of each node are attributes rather than padding
+#   globals.npy      float64 (T, G) global values at each timestamp, NaN where undefined
+#   edge_index.npy   int64 (2, E) node_id of the source and target of each edge
+#   edge_type.npy    int64 (E) type of each edge
+#   edge_weight.npy  float64 (E) weight of each edge
+#   dataset.json     the dates of the timestamps and the timezone they are in, the names of the globals, the nodes
+#                    (node_id, name, type, type_id, S and the names of their features) and the node types
+
+import os
+import json
+import numpy
+from numpy.lib.format import open_memmap
+import modules.mya as mya
+import modules.hgb as hgb
+import modules.node as node
+from modules.util import progressBar
+
+# The name of the store's directory within the output directory
+store_dir = 'columnar'
+
+# Bumped whenever the layout of the store changes
+version = 1
+
+
+# Write the store at path
+#   topology is the node.Topology of node_list
+#   times is the list of epoch milliseconds of the timestamps to write
+#   rows is a list for each timestamp of the row of each node's data at that time.  See Node.row.
+#   global_data is the list of the timestamped global data sets at the same times
+def write(path, config, node_list: list, topology, times: list, rows: list, global_data: list):
+    os.makedirs(path, exist_ok=True)
+    numpy.save(os.path.join(path, 'times.npy'), numpy.asarray(times, dtype=numpy.int64))
+    numpy.save(os.path.join(path, 'edge_index.npy'), topology.edge_index)
+    numpy.save(os.path.join(path, 'edge_type.npy'), topology.edge_type)
+    numpy.save(os.path.join(path, 'edge_weight.npy'), topology.edge_weight)
+
+    # Globals
+    global_names = []
+    global_values = []
+    for data in global_data:
+        values = {}
+        for item in data['values']:
+            values.update(item)
+        for name in values:
+            if name not in global_names:
+                global_names.append(name)
+        global_values.append(values)
+    globals_matrix = numpy.full((len(times), len(global_names)), numpy.nan)
+    for column, name in enumerate(global_names):
+        globals_matrix[:, column] = mya.to_float([values.get(name) for values in global_values])
+    numpy.save(os.path.join(path, 'globals.npy'), globals_matrix)
+
+    # Node features are gathered a node at a time for all timestamps at once
+    rows = numpy.asarray(rows, dtype=numpy.intp).reshape(len(times), len(node_list))
+    plans = [item.attribute_plan() for item in node_list]
+    widths = [len(ced_values) + len(columns) for samples, ced_values, columns, modified in plans]
+    width = max(widths, default=0)
+    mask = numpy.zeros((len(node_list), width), dtype=bool)
+    features = open_memmap(os.path.join(path, 'features.npy'), mode='w+', dtype=numpy.float64,
+                           shape=(len(times), len(node_list), width))
+    for position, (samples, ced_values, columns, modified) in enumerate(
+            progressBar(plans, prefix='Write to Disk:', suffix='', length=60)):
+        node_rows = rows[:, position]
+        values = numpy.full((len(times), width), numpy.nan)
+        values[:, :len(ced_values)] = mya.to_float(ced_values)
+        epics = values[:, len(ced_values):len(ced_values) + len(columns)]
+        epics[:] = samples.values[node_rows][:, columns]
+        for field, modified_values, integers in modified:
+            epics[:, field] = modified_values[node_rows]
+        features[:, position, :] = values
+        mask[position, :widths[position]] = True
+    features.flush()
+    del features
+    numpy.save(os.path.join(path, 'mask.npy'), mask)
+
+    # The description of it all
+    type_map = hgb.node_type_map(config, node_list)
+    description = {
+        'version': version,
+        'dates': [data['date'] for data in global_data],
+        'timezone': mya.timezone_name,
+        'globals': global_names,
+        'nodes': [{
+            'node_id': item.node_id,
+            'name': item.name(),
+            'type': item.type_name,
+            'type_id': type_map[item.type_name]['id'],
+            'S': s(item),
+            'features': item.attribute_names(),
+        } for item in node_list],
+        'types': node_types(config, node_list),
+    }
+    with open(os.path.join(path, 'dataset.json'), 'w') as f:
+        f.write(json.dumps(description, indent=2))
+
+
+# Return a node's S as a float or None if it has none
+def s(item):
+    value = mya.to_float([node.Topology.s(item)])[0]
+    return None if numpy.isnan(value) else float(value)
+
+
+# Return a list of the node types in order of their ids, each a dictionary of id, name, and attribute labels,
+# as they are written to info.dat
+def node_types(config, node_list: list) -> list:
+    if hgb.order_types_by == 'node':
+        return [{'id': item['id'], 'name': name, 'labels': item['labels']}
+                for name, item in node.List.type_map(node_list).items()]
+    return [{'id': id, 'name': name, 'labels': labels}
+            for id, (name, labels) in enumerate(node.TypeInfo(config).label_dict().items())]
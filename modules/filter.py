@@ -1,4 +1,9 @@
 import re
+import ast
+import copy
+import functools
+import numpy
+import modules.mya as mya
 
 # Custom exception class for errors encountered while evaluating filter expressions
 class FilterException(RuntimeError): pass
@@ -20,6 +25,14 @@ def macro_substitute(pv: str, value, expr: str) -> str:
     prepared = pattern.format(pv)
     return re.sub(prepared, str(value), expr)
 
+# The pattern of the EPICS macro syntax $(pv) by which expressions refer to PVs
+macro_pattern = re.compile(r"\$\(([^)]*)\)")
+
+# Return the compiled Expression for an expression string.  Each distinct string is only compiled once.
+@functools.lru_cache(maxsize=None)
+def compile_expression(expr: str):
+    return Expression(expr)
+
 # Factory method to return a Filter object
 def make(rule: str):
     return Filter(rule)
@@ -28,6 +41,11 @@ class Filter():
     """Class for evaluating string filter expressions """
     def __init__(self, rule: str):
         self.rule = rule
+        # The rule is compiled once.  One that cannot be is reported for each data set it is applied to.
+        try:
+            self.condition = Condition(rule)
+        except FilterException:
+            self.condition = None
 
     def make_expression(self, data:dict):
         expr = self.rule
@@ -37,9 +55,186 @@ class Filter():
         return expr
 
     def passes(self, data: dict):
-        expr = self.make_expression(data)
+        mask, errors = self.mask([data])
+        if errors:
+            raise errors[0]
+        return bool(mask[0])
+
+    # Evaluate the rule for a whole list of timestamped data sets at once.  Returns a tuple of the boolean array
+    # of whether each data set passes and a dictionary, keyed by position in the list, of a FilterException for
+    # each data set for which the rule could not be evaluated, such as because a PV it refers to was undefined
+    # or it divided by zero.
+    def mask(self, data_sets: list) -> tuple:
+        if self.condition is None:
+            undefined = numpy.ones(len(data_sets), dtype=bool)
+            mask = numpy.zeros(len(data_sets), dtype=bool)
+        else:
+            columns = {pv: [] for pv in self.condition.pvs}
+            for data in data_sets:
+                values = {}
+                for item in data['values']:
+                    values.update(item)
+                for pv, column in columns.items():
+                    column.append(values.get(pv))
+            columns = {pv: mya.to_float(column) for pv, column in columns.items()}
+            undefined = numpy.zeros(len(data_sets), dtype=bool)
+            for column in columns.values():
+                undefined |= numpy.isnan(column)
+            result = numpy.broadcast_to(self.condition.evaluate(columns), len(data_sets))
+            # A result that is not finite, such as that of a division by zero, is an error like an undefined PV
+            undefined |= ~numpy.isfinite(result)
+            mask = (result != 0) & ~undefined
+        errors = {}
+        for i in numpy.flatnonzero(undefined).tolist():
+            expr = self.make_expression(data_sets[i])
+            errors[i] = FilterException("The filter expression could not be evaluated: {}".format(expr))
+        return mask, errors
+
+
+class Expression():
+    """Class for evaluating an arithmetic expression of PVs over whole arrays of their values at once"""
+
+    # The syntax permitted in expressions.  Anything else, such as function calls or attribute access,
+    # is rejected when the expression is compiled so that evaluating it can do nothing but arithmetic.
+    nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load,
+             ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.UAdd, ast.USub)
+
+    # The functions available to the compiled expression, which are only called by syntax that rewrite introduces
+    functions = {}
+
+    # Compile an expression that uses EPICS macro syntax $(pv) to refer to PVs
+    def __init__(self, expr: str):
+        self.expr = expr
+        self.pvs = []       # The PVs to which the expression refers in order of first appearance
+        names = {}
+
+        def placeholder(match):
+            if match.group(1) not in names:
+                names[match.group(1)] = f'_pv{len(names)}'
+                self.pvs.append(match.group(1))
+            return names[match.group(1)]
+
         try:
-            result = eval(expr)
-            return result
-        except SyntaxError as err:
-            raise FilterException("The filter expression could not be evaluated: {}".format(expr))
\ No newline at end of file
+            self._tree = ast.parse(macro_pattern.sub(placeholder, expr).strip(), mode='eval')
+        except SyntaxError:
+            raise FilterException("The expression could not be compiled: {}".format(expr))
+        for node in ast.walk(self._tree):
+            if not isinstance(node, self.nodes) or (isinstance(node, ast.Name) and node.id not in names.values()) \
+                    or (isinstance(node, ast.Constant) and not isinstance(node.value, (int, float))):
+                raise FilterException("The expression is not permitted: {}".format(expr))
+        self._names = [names[pv] for pv in self.pvs]
+        self._code = compile(ast.fix_missing_locations(self.rewrite(self._tree)), '<expression>', 'eval')
+
+    # Return the syntax tree to compile in place of the one parsed from the expression
+    def rewrite(self, tree):
+        return tree
+
+    # Return the float64 array of the results of the expression given a dictionary of the array of values of each PV
+    # to which it refers.  Where any of those values is NaN, which stands for <undefined>, so is the result.
+    def evaluate(self, values: dict) -> numpy.ndarray:
+        arrays = [numpy.asarray(values[pv], dtype=numpy.float64) for pv in self.pvs]
+        shape = numpy.broadcast_shapes(*[array.shape for array in arrays])
+        with numpy.errstate(all='ignore'):
+            result = eval(self._code, dict(self.functions, __builtins__={}), dict(zip(self._names, arrays)))
+        result = numpy.array(numpy.broadcast_to(result, shape), dtype=numpy.float64)
+        for array in arrays:
+            result[numpy.isnan(array)] = numpy.nan
+        return result
+
+    # Answer whether, had the expression been evaluated by python with the PVs replaced by their values as text,
+    # the result would be an int rather than a float given whether the values were integers.
+    def is_integer(self, integers: bool) -> bool:
+        def integral(node) -> bool:
+            if isinstance(node, ast.Constant):
+                return isinstance(node.value, int)
+            if isinstance(node, ast.Name):
+                return integers
+            if isinstance(node, ast.UnaryOp):
+                return integral(node.operand)
+            if isinstance(node.op, ast.Div):
+                return False
+            if isinstance(node.op, ast.Pow) and isinstance(node.right, ast.UnaryOp) \
+                    and isinstance(node.right.op, ast.USub):
+                return False
+            return integral(node.left) and integral(node.right)
+        return integral(self._tree.body)
+
+
+# Return the values with those that are not finite, which python would have raised an error computing, as NaN
+def _finite(value):
+    value = numpy.asarray(value, dtype=numpy.float64)
+    return numpy.where(numpy.isfinite(value), value, numpy.nan)
+
+
+# Return the result of comparing left with right, which is NaN where either of them is
+def _compare(result, left, right):
+    return numpy.where(numpy.isnan(left) | numpy.isnan(right), numpy.nan, result)
+
+
+# Return the result of and (stop=False) or or (stop=True) applied to the values in turn as python would apply it,
+# stopping at the first value whose truth is stop.  The result is NaN where a value it reached is NaN.
+def _bool_op(stop: bool, values) -> numpy.ndarray:
+    values = [numpy.asarray(value, dtype=numpy.float64) for value in values]
+    result = numpy.full(numpy.broadcast_shapes(*[value.shape for value in values]), float(not stop))
+    decided = numpy.zeros(result.shape, dtype=bool)
+    for value in values:
+        undefined = numpy.isnan(value) & ~decided
+        stopped = ((value != 0) == stop) & ~numpy.isnan(value) & ~decided
+        result[undefined] = numpy.nan
+        result[stopped] = float(stop)
+        decided |= undefined | stopped
+    return result
+
+
+class Condition(Expression):
+    """Class for evaluating an expression of PVs that may also compare values and combine the comparisons"""
+
+    nodes = Expression.nodes + (ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+                                ast.BoolOp, ast.And, ast.Or, ast.Not)
+
+    # A result that python could not have computed is NaN, and so is anything computed from it that
+    # python would have evaluated, so that the condition cannot be met by accident of how NaN compares.
+    functions = {
+        '_finite': _finite,
+        '_all': lambda *values: _bool_op(False, values),
+        '_any': lambda *values: _bool_op(True, values),
+        '_not': lambda value: numpy.where(numpy.isnan(value), numpy.nan, numpy.asarray(value) == 0),
+        '_eq': lambda left, right: _compare(numpy.equal(left, right), left, right),
+        '_ne': lambda left, right: _compare(numpy.not_equal(left, right), left, right),
+        '_lt': lambda left, right: _compare(numpy.less(left, right), left, right),
+        '_le': lambda left, right: _compare(numpy.less_equal(left, right), left, right),
+        '_gt': lambda left, right: _compare(numpy.greater(left, right), left, right),
+        '_ge': lambda left, right: _compare(numpy.greater_equal(left, right), left, right),
+    }
+
+    comparisons = {ast.Eq: '_eq', ast.NotEq: '_ne', ast.Lt: '_lt', ast.LtE: '_le', ast.Gt: '_gt', ast.GtE: '_ge'}
+
+    class Rewriter(ast.NodeTransformer):
+        """Class to replace the syntax that cannot be applied to arrays with calls to the equivalent functions"""
+
+        @staticmethod
+        def call(name: str, args: list):
+            return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[])
+
+        def visit_BoolOp(self, node):
+            self.generic_visit(node)
+            return self.call('_all' if isinstance(node.op, ast.And) else '_any', node.values)
+
+        def visit_UnaryOp(self, node):
+            self.generic_visit(node)
+            return self.call('_not', [node.operand]) if isinstance(node.op, ast.Not) else node
+
+        def visit_BinOp(self, node):
+            self.generic_visit(node)
+            return self.call('_finite', [node])
+
+        # A chain such as a < b < c is a < b and b < c
+        def visit_Compare(self, node):
+            self.generic_visit(node)
+            operands = [node.left] + node.comparators
+            comparisons = [self.call(Condition.comparisons[type(op)], [left, right])
+                           for left, op, right in zip(operands, node.ops, operands[1:])]
+            return comparisons[0] if len(comparisons) == 1 else self.call('_all', comparisons)
+
+    def rewrite(self, tree):
+        return self.Rewriter().visit(copy.deepcopy(tree))
@@ -1,20 +1,74 @@
 # Module with classes and functions for outputting of graph data sets in the HBG format.
 # See https://www.biendata.xyz/hgb/#/about
 
+import io
 import os
+import gzip
+import json
+import shutil
+import multiprocessing
 import pandas
 import modules.node as node
+import modules.mya as mya
+
+# zstandard is optional.  It is only needed for output compressed with zstd.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 order_types_by = 'config'  # Choose config or node
 
+# The suffix added to the names of files compressed by each method of output.compression
+compression_suffixes = {'gzip': '.gz', 'zstd': '.zst'}
+
+# The compression level of each method used unless output.compression_level is given
+default_compression_levels = {'gzip': 6, 'zstd': 3}
+
+
+# Return the compression method specified by output, the output section of the config, or None if files
+# are not to be compressed.  An unknown or unavailable method raises a RuntimeError.
+def compression(output: dict = None):
+    method = (output or {}).get('compression')
+    if method in (None, 'none'):
+        return None
+    if method not in compression_suffixes:
+        raise RuntimeError(f'Unknown output compression {method}')
+    if method == 'zstd' and zstandard is None:
+        raise RuntimeError('The zstandard package is required for zstd output compression')
+    return method
+
+
+# Return the name of a file written to the output, which has the suffix of its compression if any.
+def output_file_name(file_name, output: dict = None) -> str:
+    method = compression(output)
+    return file_name + compression_suffixes[method] if method else file_name
+
+
+# Write text to the file named file_name at path, compressed as specified by output.
+def write_text(path, file_name, text: str, output: dict = None):
+    method = compression(output)
+    if method is None:
+        with open(os.path.join(path, file_name), 'w') as f:
+            f.write(text)
+        return
+    level = output.get('compression_level', default_compression_levels[method])
+    if method == 'gzip':
+        # Without a timestamp in the header, the same data is always compressed to the same bytes
+        data = gzip.compress(text.encode('utf-8'), compresslevel=level, mtime=0)
+    else:
+        data = zstandard.ZstdCompressor(level=level).compress(text.encode('utf-8'))
+    with open(os.path.join(path, output_file_name(file_name, output)), 'wb') as f:
+        f.write(data)
+
+
 # Write out an info.dat file at the specified path
 # Per https://www.biendata.xyz/hgb/#/about:
 #   info.dat: The information of node labels. Each line has (node_id, node_type_id, node_label).
 #   For multi-label setting, node_labels are split by comma.
 def write_info_dat(path, config, node_list):
-    file_name = os.path.join(path, 'info.dat')
-    f = open(file_name, 'w')
+    f = io.StringIO()
     print("\t".join(['TYPE', 'NAME', 'LABELS']), file=f)
     if order_types_by == 'node':
         for key, item in node.List.type_map(node_list).items():
@@ -25,49 +79,53 @@ def write_info_dat(path, config, node_list):
         for key in label_dict:
             print(id, "\t", key, ','.join(label_dict[key]), file=f)
             id = id + 1
-    f.close()
+    write_text(path, 'info.dat', f.getvalue(), config.get('output'))
 
 
-# Write out a node.dat file at the specified path using data from the specified array index
+# Write out a node.dat file at the specified path using data from the specified array index, which may be
+# a list of the index to use for each node in node_list.  If the type_map of node_list is already known,
+# it may be provided.  See node_type_map.
 # Per https://www.biendata.xyz/hgb/#/about:
 #   node.dat:The information of nodes. Each line has (node_id, node_name, node_type_id, node_feature).
 #   Node features are vectors split by comma.
-def write_node_dat(path, config, node_list, index):
+def write_node_dat(path, config, node_list, index, type_map=None):
+    rows = index if isinstance(index, list) else [index] * len(node_list)
+    if type_map is None:
+        type_map = node_type_map(config, node_list)
+
+    # The file is formatted in memory and written all at once
+    lines = ["\t".join(['NODE', 'NAME', 'TYPE', 'VALUES']) + "\n"]
+    for item, row in zip(node_list, rows):
+        lines.append(f"{item} \t {type_map[item.type_name]['id']} \t {','.join(item.attribute_values(row))}\n")
+    write_text(path, 'node.dat', ''.join(lines), config.get('output'))
+
+
+# Return the dictionary keyed by type name that provides the id of each type of node in node_list
+def node_type_map(config, node_list) -> dict:
     if order_types_by == 'node':
-        type_map = node.List.type_map(node_list)
+        return node.List.type_map(node_list)
     else:
-        type_map = node.TypeInfo(config).type_id_map()
+        return node.TypeInfo(config).type_id_map()
 
-    file_name = os.path.join(path, 'node.dat')
-    f = open(file_name, 'w')
-    print("\t".join(['NODE', 'NAME', 'TYPE', 'VALUES']), file=f)
-    for item in node_list:
-        print(item, "\t", type_map[item.type_name]['id'], "\t", ','.join(item.attribute_values(index)), file=f)
-    f.close()
 
-
-# Write out a link.dat file at the specified path using data from the specified array index
+# Write out a link.dat file at the specified path for the edges of a node.Topology
+# compressed as specified by output, the output section of the config
 # Per https://www.biendata.xyz/hgb/#/about:
 #   link.dat: The information of edges. Each line has (node_id_source, node_id_target, edge_type_id, edge_weight).
-# TODO implement node weighting
-def write_link_dat(path, node_list, distance=1):
-    file_name = os.path.join(path, 'link.dat')
-    f = open(file_name, 'w')
+def write_link_dat(path, topology, output: dict = None):
+    f = io.StringIO()
     print("\t".join(['START', 'END', 'LINK_TYPE', 'LINK_WEIGHT']), file=f)
-    for item in node_list:
-        if (isinstance(item, node.SetPointNode)):
-            for target in item.extended_links(distance):
-                # Hard-code type and weight for now
-                print(item.node_id, '\t', target.node_id, '\t', '0\t1', file=f)
-    f.close()
+    weights = [mya.format_value(weight) for weight in topology.edge_weight.tolist()]
+    for source, target, edge_type, weight in zip(*topology.edge_index.tolist(), topology.edge_type.tolist(), weights):
+        print(source, '\t', target, '\t', f'{edge_type}\t{weight}', file=f)
+    write_text(path, 'link.dat', f.getvalue(), output)
 
 
 # Write out a meta.dat file at the specified path
 # The file contains summary data such as the number of each type of node
 def write_meta_dat(path, config, node_list):
     type_map = node.List.type_map(node_list)
-    file_name = os.path.join(path, 'meta.dat')
-    f = open(file_name, 'w')
+    f = io.StringIO()
     print('Total Nodes:', "\t", len(node_list), file=f)
     if order_types_by == 'node':
         for type_name, data in type_map.items():
@@ -82,7 +140,151 @@ def write_meta_dat(path, config, node_list):
                 data = {'count' : 0}
             print(f"Node_Type_{id}:", "\t", data['count'], file=f)
             id = id + 1
-    f.close()
+    write_text(path, 'meta.dat', f.getvalue(), config.get('output'))
+
+
+# The files of a data set whose contents are the same for every timestamp
+static_files = ['meta.dat', 'info.dat', 'link.dat']
+
+
+# Write out the files of a data set that are the same for every timestamp at the specified path
+def write_static_files(path, config, node_list, topology):
+    write_meta_dat(path, config, node_list)
+    write_link_dat(path, topology, config.get('output'))
+    write_info_dat(path, config, node_list)
+
+
+# Give the data set at path the static files already written to source, either as hard links to them
+# or, if link is False or the filesystem cannot link them, as copies.
+#   output is the output section of the config, which names the files if they are compressed
+def share_static_files(source, path, link=False, output: dict = None):
+    for file_name in [output_file_name(file_name, output) for file_name in static_files]:
+        target = os.path.join(path, file_name)
+        if link:
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(os.path.join(source, file_name), target)
+                continue
+            except OSError:
+                pass
+        shutil.copyfile(os.path.join(source, file_name), target)
+
+
+# The name of the file at the top level of the output that records what a run wrote so that more data sets can
+# later be appended to it.  It holds the config of the run, the names of the nodes, the edges between them and
+# the dates and epoch millisecond times of the data sets written.
+manifest_file = 'manifest.json'
+
+
+# Write the manifest of the output at path for the data sets written at dates and times.  Those of a previous
+# manifest are kept unless they are written again.
+def write_manifest(path, config, node_list, topology, dates: list, times: list, previous: dict = None):
+    written = {}
+    if previous:
+        written.update(zip(previous['times'], previous['dates']))
+    written.update(zip((int(time) for time in times), dates))
+    manifest = {
+        'config': config,
+        'nodes': [item.name() for item in node_list],
+        'edge_index': topology.edge_index.tolist(),
+        'edge_type': topology.edge_type.tolist(),
+        'edge_weight': topology.edge_weight.tolist(),
+        'times': sorted(written),
+        'dates': [written[time] for time in sorted(written)],
+    }
+    with open(os.path.join(path, manifest_file), 'w') as f:
+        # Values json does not support, such as the dates yaml may read from a config file, are saved as strings.
+        json.dump(manifest, f, indent=2, default=str)
+
+
+# Return the manifest of the output at path or None if there is none
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, manifest_file), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# Return why node_list and topology differ from the graph of a manifest or None if they are the same
+def manifest_mismatch(manifest, node_list, topology):
+    names = [item.name() for item in node_list]
+    if names != manifest['nodes']:
+        added = [name for name in names if name not in manifest['nodes']]
+        removed = [name for name in manifest['nodes'] if name not in names]
+        if added or removed:
+            return f"the nodes have changed (added: {', '.join(added) or 'none'}; removed: {', '.join(removed) or 'none'})"
+        return 'the order of the nodes has changed'
+    if (topology.edge_index.tolist() != manifest['edge_index'] or topology.edge_type.tolist() != manifest['edge_type']
+            or topology.edge_weight.tolist() != manifest['edge_weight']):
+        return 'the edges between the nodes have changed'
+    return None
+
+
+# The Writer used by the processes of a pool.  See Writer.write_all.
+_writer = None
+
+
+def _set_writer(writer):
+    global _writer
+    _writer = writer
+
+
+def _write(task):
+    _writer.write(task)
+
+
+class Writer():
+    """Class to write the data sets of a run, in parallel if desired, given what is the same for all of them"""
+
+    # Instantiate the object
+    #   static_dir is where the static files have already been written.  See write_static_files.
+    #   link is whether data sets get hard links to the static files rather than copies.  See share_static_files.
+    def __init__(self, config, node_list, static_dir, link=False):
+        self.config = config
+        self.node_list = node_list
+        self.static_dir = static_dir
+        self.link = link
+        self.type_map = node_type_map(config, node_list)
+
+    # Write the data set described by a task, which is a tuple of the directory to write it to,
+    # the list of the row of each node's data to write and the global data at the same time.
+    def write(self, task):
+        directory, rows, data = task
+        os.makedirs(directory, exist_ok=True)
+        if directory != self.static_dir:
+            share_static_files(self.static_dir, directory, self.link, self.config.get('output'))
+        write_node_dat(directory, self.config, self.node_list, rows, self.type_map)
+        node.List.write_global_data_values(directory, data, self.config.get('output'))
+
+    # Write the data sets of a list of tasks, yielding as each is written so that progress can be reported.
+    # With more than one worker, the data sets are written concurrently by a pool of that many processes.
+    def write_all(self, tasks: list, workers: int = 1):
+        if workers <= 1 or len(tasks) < 2:
+            for task in tasks:
+                yield self.write(task)
+        else:
+            chunk_size = max(1, min(64, len(tasks) // (workers * 8)))
+            with multiprocessing.Pool(workers, initializer=_set_writer, initargs=(self,)) as pool:
+                yield from pool.imap(_write, tasks, chunk_size)
+
+
+# Return the list of the paths to which data sets for a list of dates are written, as described for path_from_date
+# and dir_from_date, according to output config.  The dates are parsed and formatted all at once.
+def paths_from_dates(base_path, dates: list, output: dict) -> list:
+    # For compatibility with older config files which didn't have it,
+    # we must check for existance of the structure key.  If it's missing we
+    # will default to the original tree-style output.
+    if output.get('structure') == 'directory':
+        format = '%Y%m%d_%H%M%S'
+    else:
+        format = os.path.join('%Y', '%m', '%d', '%H')
+        if output.get('minutes') or output.get('seconds'):
+            format = os.path.join(format, '%M')
+        if output.get('seconds'):
+            format = os.path.join(format, '%S')
+    return [os.path.join(base_path, name) for name in pandas.to_datetime(list(dates)).strftime(format)]
 
 
 # Return a path tree of Base/Year/Month/Day/Hour using the correct path separator for the current OS
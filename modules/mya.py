@@ -1,14 +1,24 @@
 import math
 import sys
+import time
 from datetime import datetime, timedelta, timezone
+import numpy
 import pandas
 import requests
 import os
 import csv
 import itertools
+import threading
+import json
+import codecs
+import collections
+import re
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.tz import gettz
 from types import SimpleNamespace
 from pprint import pprint
+import modules.util as util
+from modules.cache import consolidate
 
 # Module of classes for interacting with Mya Web API to fetch data.
 
@@ -18,7 +28,8 @@ from pprint import pprint
 url = "https://epicsweb.jlab.org/myquery/"
 
 # The archiver lives in the America/New_York timezone
-tz = gettz('America/New_York')
+timezone_name = 'America/New_York'
+tz = gettz(timezone_name)
 
 # The mya deployment in use (history | ops).
 # Most recent data in ops, older data in history
@@ -27,12 +38,158 @@ deployment = "history"
 # Limit the number of pvs be fetched at each server request.
 throttle = 10
 
+# The maximum number of requests that may be in flight to the Mya web server at once.
+workers = 4
+
+# The number of values (pvs x steps) to request from the server at once.  Long date spans are split into
+# chunks of consecutive steps that are fetched in parallel and stitched back together.  While fetching, the
+# budget shrinks when the server is slow or fails to answer and grows back when it answers quickly, but it
+# always stays between min_points_per_request and max_points_per_request.
+points_per_request = 250000
+min_points_per_request = 1000
+max_points_per_request = 2500000
+
+# The number of seconds a request for points_per_request values is expected to take.
+target_latency = 20
+
+# The number of seconds to wait on the server before abandoning a request.
+timeout = 300
+
+# The number of times to retry a request that failed for a transient reason such as a dropped connection,
+# and the number of seconds to wait before the first retry.  The wait doubles with every retry.
+retries = 4
+backoff = 2
+
+# The HTTP session shared by all requests so that connections to the server are kept alive
+# and reused rather than being renegotiated for every request.  Use session() to access it.
+_session = None
+_session_lock = threading.Lock()
+
+# How the values of setpoint pvs are fetched by default.  See Sampler.mode.
+setpoint_mode = 'auto'
+
+# In the auto mode, a pv is fetched as events only if it changes no more than this many times per step on average.
+events_ratio = 0.1
+
+# In the auto mode, a pv that changes no more than this many times during a span is fetched as events however
+# few steps the span has, since sampling it would take a request of its own just the same.
+min_events_limit = 10
+
+# Points in time among the dates that are fewer than this many interval steps apart are fetched together
+# as a single span that covers them, and their values are then looked up in its data.
+coalesce_steps = 300
+
+# Responses expected to hold at least this many values (pvs x steps) are decoded incrementally as they
+# arrive from the server rather than being read into memory in full before being parsed.
+stream_threshold = 100000
+
+# The number of bytes to read from the server at a time when decoding a response incrementally.
+stream_chunk_size = 256 * 1024
+
+# An optional cache.ArchiveCache in which sampled values are kept on disk between runs.
+# When set, only the samples missing from the cache are requested from the server.
+cache = None
+
+# An optional cache.Checkpoint in which the values sampled during a run are saved as they arrive.
+# Like the cache, samples already in the checkpoint are not requested again, so that an interrupted
+# run can be resumed without repeating the work it had completed.
+checkpoint = None
+
 # Custom exception class for errors encountered interacting with myaweb
 class MyaException(RuntimeError): pass
 
 # Custom exception class for errors related to date spans
 class DateSpanException(RuntimeError): pass
 
+# Custom exception class for failures of the server, such as timeouts, that asking for less data may avoid
+class MyaServerException(MyaException): pass
+
+# Custom exception class for failures, such as dropped connections, that may not recur if the request is repeated
+class MyaTransientException(MyaServerException): pass
+
+# Return the shared HTTP session, creating it upon first use.
+# The connection pool is sized to the number of workers so that no request has to wait for a connection.
+def session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+            # Set verify to False because of jlab MITM interference
+            _session.verify = False
+        return _session
+
+
+# Apply func to each of items using a pool of up to workers threads.
+# Results are yielded in the order of items regardless of the order in which the requests
+# complete so that data merged from them is deterministic.  Items may be a generator; it is only
+# advanced as results are consumed so that no more than twice workers items are pending at once.
+def pooled(func, items):
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # If the caller stopped early, the requests that have not started are cancelled.  Those already running
+            # are waited for, which is no more than workers of them, so that none is still writing to the cache or
+            # checkpoint after the caller has moved on.
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+# Fetch the data for several samplers at once by running their requests on the shared worker pool.
+# The pvs of all the samplers are packed together into as few requests as possible by a Planner.
+# Each sampler is yielded as a (sampler, error) tuple in the order provided as soon as all of its data
+# has been merged.  The error is None unless a MyaException was raised fetching data for the sampler,
+# in which case the exception is provided rather than raised so that the remaining samplers are unaffected.
+def fetch_all(samplers: list):
+    yield from Planner(samplers).fetch()
+
+
+# Convert a list of date strings as returned by the archiver (local time, ascending order) to an array of
+# epoch milliseconds.  During the "fall back" from DST the same wall-clock time occurs twice.  Because the
+# dates are in ascending order, such a time is taken to be in DST unless that would put it before the time
+# preceding it, in which case it is in standard time.  If the dates are known to begin no earlier than the epoch
+# milliseconds begin_ms, as those of a response for a span beginning in the repeated hour do, the first is
+# likewise in standard time if DST would put it before begin_ms.
+def to_epoch_ms(dates: list, begin_ms: int = None) -> numpy.ndarray:
+    index = pandas.DatetimeIndex(pandas.to_datetime(list(dates)))
+    dst, standard = [numpy.asarray((index.tz_localize(tz, ambiguous=numpy.full(len(index), is_dst),
+                                                      nonexistent='shift_forward')
+                                    - pandas.Timestamp(0, tz='UTC')) // pandas.Timedelta(milliseconds=1),
+                                   dtype=numpy.int64) for is_dst in (True, False)]
+    times = dst.copy()
+    for i in numpy.flatnonzero(dst != standard):
+        previous = times[i - 1] + 1 if i > 0 else begin_ms
+        if previous is not None and dst[i] < previous:
+            times[i] = standard[i]
+    return times
+
+
+# Convert a single local date to epoch milliseconds.  During the "fall back" from DST, when the same wall-clock
+# time occurs twice, fold selects the occurrence: 0 for the first (DST) and 1 for the second (standard time).
+def epoch_ms(date, fold: int = 0) -> int:
+    localized = pandas.Timestamp(date).tz_localize(tz, ambiguous=(fold == 0), nonexistent='shift_forward')
+    return (localized - pandas.Timestamp(0, tz='UTC')) // pandas.Timedelta(milliseconds=1)
+
+
+# Convert an array of epoch milliseconds to a list of local date strings in the format used by the archiver.
+def from_epoch_ms(times) -> list:
+    dates = pandas.to_datetime(numpy.asarray(times, dtype=numpy.int64), unit='ms', utc=True).tz_convert(tz)
+    return list(dates.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
 # Obtain a list of date ranges from a file that contains either a single
 # timestamp or comma-separated begin, end, interval triplet per line.
 def date_ranges_from_file(file):
@@ -71,9 +228,184 @@ def date_ranges(config: dict) -> list:
 
 
 
+# Convert a list of values as provided by the archiver to a float64 array.
+# Values that are undefined (None or '<undefined>') or not numeric become NaN.
+def to_float(values: list) -> numpy.ndarray:
+    try:
+        return numpy.array(values, dtype=numpy.float64)
+    except (ValueError, TypeError):
+        floats = numpy.full(len(values), numpy.nan)
+        for i, value in enumerate(values):
+            try:
+                floats[i] = float(value)
+            except (ValueError, TypeError):
+                pass
+        return floats
+
+
+# Convert the list of values the archiver provided for a pv to a float64 array like to_float, except that a value
+# which is not a number, such as the state of an enumerated pv, raises a MyaException rather than becoming NaN,
+# since it would otherwise be written as though the archiver had reported it as undefined.
+def archived_values(pv: str, values: list) -> numpy.ndarray:
+    floats = to_float(values)
+    for i in numpy.flatnonzero(numpy.isnan(floats)).tolist():
+        if values[i] is not None and values[i] != '<undefined>':
+            try:
+                float(values[i])
+            except (ValueError, TypeError):
+                raise MyaException(f'Mya returned the non-numeric value {values[i]!r} for {pv}') from None
+    return floats
+
+
+# Format a sampled value as text.  NaN, which stands for a value the archiver reported as undefined, is formatted
+# as <undefined>.  Otherwise the text is the shortest that reads back as the same float64, which may differ from
+# the text the archiver sent and that earlier versions wrote: whole numbers are formatted without a trailing .0 and
+# exponents in Python's form (1e-05 rather than 1.0E-5).
+def format_value(value) -> str:
+    if value != value:  # NaN, tested without the overhead of numpy.isnan on a scalar
+        return '<undefined>'
+    text = repr(float(value))
+    return text[:-2] if text.endswith('.0') else text
+
+
+class Samples:
+    """Class to hold sampled PV data as a time axis and a matrix of values with one column per PV"""
+
+    # Instantiate the object
+    #
+    #  times: array of epoch millisecond timestamps in ascending order
+    #  pvs: list of PV names corresponding to the columns of values
+    #  values: float64 matrix of shape (len(times), len(pvs)) in which NaN stands for <undefined>.
+    #          If omitted, every value is initially NaN.
+    #
+    def __init__(self, times=None, pvs: list = None, values=None):
+        self.times = numpy.asarray(times if times is not None else [], dtype=numpy.int64)
+        self.pvs = list(pvs) if pvs is not None else []
+        if values is None:
+            self.values = numpy.full((len(self.times), len(self.pvs)), numpy.nan)
+        else:
+            self.values = numpy.asarray(values, dtype=numpy.float64).reshape(len(self.times), len(self.pvs))
+        self.columns = {pv: i for i, pv in enumerate(self.pvs)}
+        self._dates = None
+        self._rows = None
+
+    def __len__(self):
+        return len(self.times)
+
+    # The local date strings corresponding to times
+    def dates(self) -> list:
+        if self._dates is None:
+            self._dates = from_epoch_ms(self.times)
+        return self._dates
+
+    def has(self, pv: str) -> bool:
+        return pv in self.columns
+
+    # The row index of the epoch millisecond timestamp time or None if there is no such row
+    def row(self, time: int):
+        if self._rows is None:
+            self._rows = {time: i for i, time in enumerate(self.times.tolist())}
+        return self._rows.get(time)
+
+    # The array of values of a pv, one per timestamp
+    def column(self, pv: str) -> numpy.ndarray:
+        return self.values[:, self.columns[pv]]
+
+    # The value of a pv at the specified row index
+    def value(self, index: int, pv: str) -> float:
+        return self.values[index, self.columns[pv]]
+
+    # The value of a pv at the specified row index formatted as text
+    def text(self, index: int, pv: str) -> str:
+        return format_value(self.value(index, pv))
+
+    # Return a new Samples with a row for each of the specified times, sorted ascending, taken from the
+    # row at or most recently before it.  Times before the first row are undefined.
+    def at(self, times):
+        times = numpy.asarray(times, dtype=numpy.int64)
+        positions = numpy.searchsorted(self.times, times, side='right') - 1
+        values = self.values[numpy.maximum(positions, 0)] if len(self.times) else numpy.empty((len(times), len(self.pvs)))
+        values[positions < 0] = numpy.nan
+        return Samples(times, self.pvs, values)
+
+    # Return a new Samples containing only the specified pvs
+    def select(self, pvs: list):
+        pvs = [pv for pv in pvs if pv in self.columns]
+        return Samples(self.times, pvs, self.values[:, [self.columns[pv] for pv in pvs]])
+
+    # Return the data in the list of dictionaries structure expected by other modules.
+    # The new myquery returns data per-channel rather than per-timestamp, but much of the application
+    # works best with the original per-timestamp format.  Here is structure we will return
+    #  [
+    #    {date: scalar, values:[{pv: value}, ...]},
+    #    {date: scalar, values:[{pv: value}, ...]}
+    #  ]
+    def structured(self) -> list:
+        data = []
+        for date, row in zip(self.dates(), self.values):
+            data.append({
+                'date': date,
+                'values': [{pv: format_value(value)} for pv, value in zip(self.pvs, row)]
+            })
+        return data
+
+    # Combine a list of Samples into one whose times and pvs are the union of theirs.
+    # Where more than one provides a value for the same pv and time, the last one wins.
+    @staticmethod
+    def combine(parts: list):
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return Samples()
+        times = numpy.unique(numpy.concatenate([part.times for part in parts]))
+        pvs = list(dict.fromkeys(pv for part in parts for pv in part.pvs))
+        combined = Samples(times, pvs)
+        for part in parts:
+            cells = numpy.ix_(numpy.searchsorted(times, part.times), [combined.columns[pv] for pv in part.pvs])
+            block = combined.values[cells]
+            numpy.copyto(block, part.values, where=~numpy.isnan(part.values))
+            combined.values[cells] = block
+        return combined
+
+    # Make Samples from a dictionary of (dates, values) tuples keyed by pv where dates is a list of
+    # local date strings in ascending order and values is the corresponding list of values.
+    # If known, begin_ms is the earliest the dates can be, as described for to_epoch_ms.
+    @staticmethod
+    def from_columns(columns: dict, begin_ms: int = None):
+        parts = []
+        times = {}  # Usually every pv has the same dates, which need only be converted once
+        for pv, (dates, values) in columns.items():
+            key = tuple(dates)
+            if key not in times:
+                times[key] = to_epoch_ms(dates, begin_ms)
+            parts.append(Samples(times[key], [pv], archived_values(pv, values)))
+        return Samples.combine(parts)
+
+    # Make Samples from data in the list of dictionaries structure returned by structured() or
+    # from a dictionary of such values lists keyed by date, as read from json files of older versions.
+    @staticmethod
+    def from_structured(data):
+        if isinstance(data, dict):
+            data = [{'date': date, 'values': values} for date, values in data.items()]
+        columns = {}
+        for item in data:
+            if not isinstance(item, dict):
+                continue
+            for value in item['values']:
+                for pv in value.keys():
+                    columns.setdefault(pv, ([], []))
+                    columns[pv][0].append(item['date'])
+                    columns[pv][1].append(value[pv])
+        return Samples.from_columns(columns)
+
+
 class Sampler:
     """Class to query the Mya Web API and retrieve values for a list of PVs"""
 
+    # The URL for fetching the changes to a pv's value over time.
+    # It must be made from the base URL before url is rebound below.
+    interval_url = url + 'interval'
+
     # The base URL for the API
     # url = url + 'mySampler/data'
     url = url + 'mysampler'
@@ -85,6 +417,14 @@ class Sampler:
     # see https://github.com/JeffersonLab/myquery/wiki/API-Reference#mysampler
     strategy = "n"
 
+    # How to fetch the values of pvs
+    #   sample: the server samples the value of every pv at each step (mysampler)
+    #   events: the changes to each pv's value are fetched (interval) and sampled locally.  Best for values
+    #           like setpoints that change rarely compared to the interval between steps.
+    #   auto: events for each pv that changes no more often than events_ratio times per step (or min_events_limit
+    #         times per span), otherwise sample.
+    mode = "sample"
+
     # Instantiate the object
     #
     #  dates: a list of date range objects with the fields
@@ -100,7 +440,8 @@ class Sampler:
         if pv_list is None:
             pv_list = []
         self.pv_list = pv_list
-        self._data = None
+        self._samples = None        # Columnar data
+        self._structured = None     # Lazily built list of dictionaries view of the data
 
     # Raise a DateException if span is not valid otherwise return true.
     def assert_span_is_valid(self, span):
@@ -112,8 +453,42 @@ class Sampler:
 
     # Get the number of interval-size steps between begin and end dates of the span
     def total_steps(self, span):
+        # Spans made by sub_span() know exactly how many steps they contain
+        if getattr(span, 'steps', None):
+            return span.steps
         return self.steps_between(span.begin_date, span.end_date, span.interval)
 
+    # Return the epoch millisecond timestamp of the first sample of the span.  Spans made by sub_span() and date
+    # ranges made by dates_at() know it, which matters if they begin during the hour repeated as DST ends.
+    @staticmethod
+    def begin_ms(span) -> int:
+        known = getattr(span, 'begin_ms', None)
+        return known if known is not None else epoch_ms(span.begin_date)
+
+    # Return the array of epoch millisecond timestamps at which the span will be sampled
+    def grid(self, span) -> numpy.ndarray:
+        steps = numpy.arange(self.total_steps(span), dtype=numpy.int64)
+        return self.begin_ms(span) + steps * self.to_milliseconds(span.interval)
+
+    # Return a span of steps number of samples within span beginning at the epoch milliseconds begin_ms
+    def sub_span(self, span, begin_ms: int, steps: int):
+        begin_date = pandas.Timestamp(from_epoch_ms([begin_ms])[0])
+        interval = pandas.to_timedelta(span.interval)
+        return SimpleNamespace(begin=str(begin_date), end=str(begin_date + steps * interval), interval=span.interval,
+                               begin_date=begin_date, end_date=begin_date + steps * interval, steps=steps,
+                               begin_ms=int(begin_ms))
+
+    # Split span into consecutive spans of no more than steps samples each.
+    # A span that need not be split is returned as is.
+    def split(self, span, steps: int) -> list:
+        total = self.total_steps(span)
+        if total <= steps:
+            return [span]
+        begin_ms = self.begin_ms(span)
+        interval_ms = self.to_milliseconds(span.interval)
+        return [self.sub_span(span, begin_ms + done * interval_ms, min(steps, total - done))
+                for done in range(0, total, steps)]
+
     # Get the number of interval-size steps between the specified begin and end dates
     @staticmethod
     def steps_between(begin_date, end_date, interval):
@@ -137,7 +512,8 @@ class Sampler:
         return remaining_steps if remaining_steps <= max_steps else max_steps
 
     # Convert string time intervals such as '1h' to integer milliseconds
-    def to_milliseconds(self, interval: str) -> int :
+    @staticmethod
+    def to_milliseconds(interval: str) -> int :
         return int(pandas.to_timedelta(interval).total_seconds() * 1000)
 
     # Return a dictionary containing the query parameters to be used when making API call.
@@ -180,50 +556,117 @@ class Sampler:
     # Throws if server response is not a "success" status code.
     #
     def data(self, with_spin=False) -> list:
-        # Fetch the pv_data if it hasn't already been retrieved.
-        if not self._data:
+        self.samples(with_spin)
+        return self.structured_data()
 
-            # Must have a list of pvs to fetch
-            if not self.pv_list:
-                raise RuntimeError("No channels to fetch")
+    # Return the data as Samples, fetching it first if it hasn't already been retrieved.
+    def samples(self, with_spin=False):
+        if self._samples is None:
+            for sampler, error in Planner([self]).fetch(with_spin=with_spin):
+                if error:
+                    raise error
+        return self._samples
 
-            spinner = itertools.cycle(['-', '/', '|', '\\'])
-
-            # Accumulate data for sets of PVS limited in number by the throttle parameter
-            # tp avoid server timeouts from requesting too much at once.
-            self._data = {}
-            items = self.pv_list.copy()     # Preserve original list. We will shift items off a copy
-            while items:
-                pvs = items[0:throttle]     # Get throttle number of pvs from front of list
-                items = items[throttle:]    # Remove those items from the list
-                for date_range in self.dates:
-                    span = self.date_span(date_range)
-                    if with_spin:
-                        self.spin(spinner)
-                    self.append_to_data(self.get_data_for_pvs(pvs, span))
-        return self.structured_data()
+    # Return the row index of the data at the epoch millisecond timestamp time, or None if there is no such row.
+    # Times are unambiguous even when the local time is not, as during the "fall back" from DST.
+    # See epoch_ms and to_epoch_ms.
+    def row(self, time: int):
+        return self.samples().row(time)
 
-    # Return data in the structure expected by other modules.
-    # The new myquery returns data per-channel rather than per-timestamp, but the application
-    # works best with the original per-timestamp format.  After all, we are going to be writing
-    # out a set of .dat files per-timestamp.
-    #
-    # Here is structure we will return
-    #  [
-    #    {date: scalar, values:[]},
-    #    {date: scalar, values:[]}
-    #  ]
+    # Answer whether data has been retrieved or set
+    def has_data(self) -> bool:
+        return self._samples is not None
+
+    # Return data in the list of dictionaries structure expected by other modules.
+    # See Samples.structured().  The structure is only built upon request.
     def structured_data(self):
-        if (isinstance(self._data, list)):
-            return self._data
-        else:
-            data = []
-            for key in self._data.keys():
-                data.append({
-                    'date':key,
-                    'values': self._data[key]
-                })
+        if self._structured is None:
+            self._structured = self._samples.structured()
+        return self._structured
+
+    # Return the list of spans to fetch for the sampler's dates.  Date ranges are fetched as they are,
+    # but points in time (those whose begin and end are the same) are coalesced into spans that cover
+    # the nearby ones, as described for coalesce_steps.
+    def spans(self) -> list:
+        spans = []
+        instants = {}
+        for date_range in self.dates:
+            if date_range['begin'] == date_range['end']:
+                instants.setdefault(date_range['interval'], []).append(date_range)
+            else:
+                spans.append(self.date_span(date_range))
+        for interval, date_ranges in instants.items():
+            interval_ms = self.to_milliseconds(interval)
+            times = numpy.unique(self.instant_times(date_ranges))
+            breaks = numpy.flatnonzero(numpy.diff(times) >= coalesce_steps * interval_ms) + 1
+            for run in numpy.split(times, breaks):
+                steps = int((run[-1] - run[0]) // interval_ms) + 1
+                spans.append(self.sub_span(SimpleNamespace(interval=interval), int(run[0]), steps))
+        return spans
+
+    # Return the sorted array of epoch millisecond times of the points in time among the sampler's dates
+    def instants(self) -> numpy.ndarray:
+        date_ranges = [date_range for date_range in self.dates if date_range['begin'] == date_range['end']]
+        return numpy.unique(self.instant_times(date_ranges))
+
+    # Return the epoch millisecond time of each of a list of points in time, in the order given.  A point that knows
+    # the epoch milliseconds at which it begins is at that time.  The dates of the rest are resolved in time order,
+    # as described for to_epoch_ms, so that the first of two that are the same as DST ends is the earlier.
+    @staticmethod
+    def instant_times(date_ranges: list) -> numpy.ndarray:
+        times = numpy.zeros(len(date_ranges), dtype=numpy.int64)
+        unknown = []
+        for i, date_range in enumerate(date_ranges):
+            if 'begin_ms' in date_range:
+                times[i] = date_range['begin_ms']
+            else:
+                unknown.append(i)
+        if unknown:
+            dates = pandas.to_datetime([date_ranges[i]['begin'] for i in unknown])
+            order = numpy.argsort(dates.values, kind='stable')
+            times[numpy.asarray(unknown)[order]] = to_epoch_ms(dates[order])
+        return times
+
+    # Return only those rows of data fetched for the sampler's spans that it wants, with the pvs in the order of
+    # its pv_list.  When the dates include points in time, the rows of the spans that were fetched to cover them
+    # are replaced by rows for the points.
+    def pick(self, data):
+        if data.pvs != self.pv_list:
+            data = data.select(self.pv_list)
+        instants = self.instants()
+        if not len(instants):
             return data
+        grids = [self.grid(self.date_span(date_range)) for date_range in self.dates
+                 if date_range['begin'] != date_range['end']]
+        return data.at(numpy.unique(numpy.concatenate(grids + [instants])))
+
+    # Return a list of date ranges for only those of the epoch millisecond times at which the sampler's dates are
+    # sampled.  Consecutive steps of a date range that remain are coalesced into a range of their own, which knows
+    # its number of steps and the epoch milliseconds at which it begins, and points in time that remain are kept
+    # along with the epoch milliseconds at which they are.
+    def dates_at(self, times) -> list:
+        times = numpy.asarray(times, dtype=numpy.int64)
+        dates = []
+        instants = []
+        for date_range in self.dates:
+            if date_range['begin'] == date_range['end']:
+                instants.append(date_range)
+                continue
+            grid = self.grid(self.date_span(date_range))
+            kept = grid[numpy.isin(grid, times)]
+            if not len(kept):
+                continue
+            interval_ms = self.to_milliseconds(date_range['interval'])
+            for run in numpy.split(kept, numpy.flatnonzero(numpy.diff(kept) != interval_ms) + 1):
+                begin, end = from_epoch_ms([run[0], run[-1] + interval_ms])
+                dates.append({'begin': begin, 'end': end, 'interval': date_range['interval'], 'steps': len(run),
+                              'begin_ms': int(run[0])})
+        if instants:
+            instant_times = self.instant_times(instants)
+            kept = numpy.isin(instant_times, times)
+            dates.extend(dict(date_range, begin_ms=int(time)) for date_range, time, keep
+                         in zip(instants, instant_times.tolist(), kept) if keep)
+        return dates
 
     # Make a SimpleNamespace object that contains begin_date, end_date, interval
     # from a dictionary containing begin, end, interval where begin_date and end_date
@@ -239,48 +682,632 @@ class Sampler:
     # fetching it from the archiver which may not be available in the test environment.
     #@data.setter
     def set_data(self, val):
-        # For newly fetched data we'll use a dict, but data from older versions
-        # read from disk might be a list.
-        if not (isinstance(val, dict) or isinstance(val, list)):
-             raise TypeError("Expected: dict or list")
-        self._data = val
+        # Newly fetched data will be Samples, but data read from json files will be a list
+        # or, from older versions, a dict.
+        self._structured = None
+        if isinstance(val, Samples):
+            self._samples = val
+        elif isinstance(val, dict) or isinstance(val, list):
+            self._samples = Samples.from_structured(val)
+            if isinstance(val, list):
+                self._structured = val
+        else:
+            raise TypeError("Expected: Samples, dict or list")
 
-    # Fetch data for a list of pvs
+    # Fetch data for a list of pvs and return it as Samples.
+    # Requests that fail for transient reasons are repeated as described for util.retry.
     def get_data_for_pvs(self, pv_list: list, span):
+        return util.retry(lambda: self.request_data(pv_list, span), retries, backoff, (MyaTransientException,))
+
+    # Make a single request for the data of a list of pvs and return it as Samples
+    def request_data(self, pv_list: list, span):
         # The queryParams method returns by default parameters to fetch the entire data set
         # so here we override the necessary keys so that we can fetch desired subset
         params = self.queryParams(span)
         params['c'] = ",".join(pv_list)
 
-        # Set verify to False because of jlab MITM interference
-        response = requests.get(self.url, params, verify=False)
-        # print(response.url)
-        if response.status_code != requests.codes.ok:
-            print(response.url)  # Useful for debugging -- what URL actually used?
-            if 'error' in response.json():
-                message = response.json()['error']
+        # Large responses are decoded as they arrive
+        begin_ms = self.begin_ms(span)
+        if self.total_steps(span) * len(pv_list) >= stream_threshold:
+            read = lambda response: ResponseDecoder(begin_ms).decode(response.iter_content(chunk_size=stream_chunk_size))
+            return self.request(self.url, params, read, stream=True)
+        return self.request(self.url, params, lambda response: samples_from_response(response.json(), begin_ms))
+
+    # Fetch the changes to the value of a pv during span and return its value at each step of the span as Samples.
+    # The value at a step is the most recent one at or before it, as the server would have sampled it.
+    # If limit is provided and the pv changed more than limit times during span, None is returned instead.
+    # The value the pv already had at the beginning of span is not counted as a change.
+    # Requests that fail for transient reasons are repeated as described for util.retry.
+    def get_events(self, pv: str, span, limit: int = None):
+        grid = self.grid(span)
+        params = {
+            'c': pv,
+            'b': datetime.strftime(span.begin_date, '%Y-%m-%d %X'),
+            'e': from_epoch_ms([grid[-1] + 1000])[0].replace('T', ' '),     # Inclusive of the last step
+            'm': deployment,
+            'p': 'on',  # Include the value prior to the begin date
+            'u': 'on',  # Timestamps as epoch milliseconds
+        }
+        if limit is not None:
+            params['l'] = limit + 1     # Room for the prior value as well
+        body = util.retry(lambda: self.request(self.interval_url, params, lambda response: response.json()),
+                          retries, backoff, (MyaTransientException,))
+        times, values = events_from_response(body, pv)
+        if limit is not None and (body.get('sampled') or numpy.count_nonzero(times >= grid[0]) > limit):
+            return None
+        return Samples(grid, [pv], forward_fill(times, values, grid))
+
+    # Make a request to the Mya Web API and return the result of calling read with the response.
+    # Failures are raised as a MyaException or, where asking again or asking for less might succeed,
+    # as a MyaServerException or MyaTransientException.
+    def request(self, url: str, params: dict, read, stream: bool = False):
+        # The shared session keeps the connection alive between requests
+        try:
+            response = session().get(url, params=params, stream=stream, timeout=timeout)
+        except requests.exceptions.ConnectionError as err:
+            raise MyaTransientException(f'Unable to connect to Mya web server: {err}') from err
+        except requests.exceptions.Timeout as err:
+            raise MyaServerException(f'Mya web server did not respond: {err}') from err
+        try:
+            # print(response.url)
+            if response.status_code != requests.codes.ok:
+                print(response.url)  # Useful for debugging -- what URL actually used?
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {}   # An overloaded server or proxy may not answer with json
+                if 'error' in body:
+                    message = body['error']
+                else:
+                    message = f'Mya web server returned error status code {response.status_code}'
+                if response.status_code in util.transient_status:
+                    raise MyaTransientException(message)
+                if response.status_code >= 500:
+                    raise MyaServerException(message)
+                raise MyaException(message)
+            return read(response)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.JSONDecodeError) as err:
+            raise MyaTransientException(f'Mya web server response was interrupted: {err}') from err
+        except requests.exceptions.Timeout as err:
+            raise MyaServerException(f'Mya web server response was interrupted: {err}') from err
+        finally:
+            response.close()
+
+
+# Return a (times, values) tuple of the changes in a parsed myquery interval response, where times is an array
+# of epoch milliseconds and values the corresponding float64 array of the values of pv.  An event without a v,
+# such as a disconnection, makes the value undefined.
+def events_from_response(body: dict, pv: str) -> tuple:
+    data = body['data']
+    dates = [datum['d'] for datum in data]
+    if dates and isinstance(dates[0], str):
+        times = to_epoch_ms(dates)
+    else:
+        times = numpy.asarray(dates, dtype=numpy.int64)
+    return times, archived_values(pv, [datum.get('v') for datum in data])
+
+
+# Return the values at each of the grid's epoch millisecond timestamps given the times at which the values changed.
+# Each step takes the most recent value at or before it.  Steps before the first change are undefined (NaN).
+def forward_fill(times, values, grid) -> numpy.ndarray:
+    positions = numpy.searchsorted(times, grid, side='right') - 1
+    filled = numpy.full(len(grid), numpy.nan)
+    known = positions >= 0
+    filled[known] = numpy.asarray(values, dtype=numpy.float64)[positions[known]]
+    return filled
+
+
+# Return the channels of a parsed mysampler response as Samples.
+# A datum without a v is an undefined value.  If known, begin_ms is the epoch milliseconds of the first sample
+# requested, which resolves its date if it is ambiguous.  See to_epoch_ms.
+def samples_from_response(body: dict, begin_ms: int = None):
+    columns = {}
+    channels = body['channels']
+    for channel in channels.keys():
+        data = channels[channel]['data']
+        columns[channel] = ([datum['d'] for datum in data], [datum.get('v') for datum in data])
+    return Samples.from_columns(columns, begin_ms)
+
+
+class ResponseDecoder:
+    """Class to decode a mysampler response incrementally as it arrives rather than parsing it all at once"""
+
+    whitespace = re.compile(r'[ \t\r\n]*')
+
+    # Instantiate the object
+    #
+    # Only a small window of the response body is held in memory at any time.  The data array of each
+    # channel is decoded one datum at a time straight into lists of dates and values for the channel,
+    # so the full JSON document never has to exist as a python data structure.
+    #
+    #  begin_ms: the epoch milliseconds of the first sample requested, if known.  See samples_from_response.
+    #
+    def __init__(self, begin_ms: int = None):
+        self.begin_ms = begin_ms
+        self._json = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._chunks = iter([])
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self.columns = {}     # (dates, values) tuples keyed by channel name
+
+    # Decode a response body provided as an iterable of bytes or str chunks and return it as Samples
+    def decode(self, chunks):
+        self._chunks = iter(chunks)
+        for key in self._object():
+            if key == 'channels':
+                for channel in self._object():
+                    self._channel(channel)
             else:
-                message = f'Mya web server returned error status code {response.status_code}'
-            raise MyaException(message)
-
-        data = {}
-        for channel in response.json()['channels'].keys():
-          for datum in response.json()['channels'][channel]['data']:
-            if datum['d'] not in data.keys():
-                data[datum['d']] = []
-            if 'v' not in datum:
-                data[datum['d']].append({channel: '<undefined>'})
+                self._value()
+        return Samples.from_columns(self.columns, self.begin_ms)
+
+    # Decode a channel object whose data array is decoded into the columns dictionary
+    def _channel(self, channel: str):
+        dates, values = self.columns.setdefault(channel, ([], []))
+        for key in self._object():
+            if key == 'data':
+                self._data(dates, values)
             else:
-                data[datum['d']].append({channel: datum['v']})
-        return data
+                self._value()
 
-    def append_to_data(self, from_data:dict):
-        for key in from_data.keys():
-            if key in self._data.keys():
-                self._data[key].extend(from_data[key])
+    # Decode a data array into lists of dates and values.  Whatever run of complete datums is already
+    # in the buffer is decoded in one go, which is much faster than decoding them one at a time.
+    def _data(self, dates: list, values: list):
+        self._expect('[')
+        while self._peek() != ']':
+            if self._buffer[self._pos] == ',':
+                self._pos += 1
+                continue
+            # Datums are flat objects, so the data ends at the first ] and the last complete datum
+            # in the buffer before that ends with the last }
+            close = self._buffer.find(']', self._pos)
+            end = self._buffer.rfind('}', self._pos, close if close >= 0 else len(self._buffer)) + 1
+            try:
+                if end <= self._pos:
+                    raise ValueError('No complete datum in buffer')
+                run = json.loads('[' + self._buffer[self._pos:end] + ']')
+                self._pos = end
+            except ValueError:
+                # Fall back to a single datum, which will read more of the response if necessary
+                run = [self._value()]
+            for datum in run:
+                dates.append(datum['d'])
+                values.append(datum.get('v'))
+        self._pos += 1
+
+    # Read the next chunk into the buffer, discarding what has already been decoded.
+    # Returns False if there is nothing more to read.
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            chunk = self._text.decode(b'', final=True)
+        elif isinstance(chunk, bytes):
+            chunk = self._text.decode(chunk)
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    # Return the next character that is not whitespace without consuming it
+    def _peek(self) -> str:
+        while True:
+            self._pos = self.whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise MyaException("Incomplete JSON response from Mya web server")
+
+    # Consume the next character that is not whitespace, which must be char
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise MyaException(f"Invalid JSON response from Mya web server near: {self._buffer[self._pos:self._pos + 40]}")
+        self._pos += 1
+
+    # Decode and return the next complete JSON value
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+                # A value that runs to the end of the buffer, such as a number, might continue in the next chunk
+                if end < len(self._buffer) or not self._fill():
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+
+    # Generate the keys of an object, leaving the position at each key's value for the caller to decode
+    def _object(self):
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._peek() == ',':
+                self._pos += 1
             else:
-                self._data[key] = from_data[key]
-        return self._data
+                self._expect('}')
+                return
+
+
+class Budget:
+    """Class to adapt the number of values asked of the Mya Web API at once to how well the server copes"""
+
+    # Instantiate the object
+    #
+    #  points: the initial number of values (pvs x steps) per request (default: points_per_request)
+    #
+    def __init__(self, points: int = None):
+        self.points = points if points is not None else points_per_request
+        self.ceiling = max_points_per_request   # Kept below the smallest request the server failed to answer
+        self._lock = threading.Lock()
+
+    # The number of steps of pv_count pvs that fit within the budget
+    def steps(self, pv_count: int) -> int:
+        return max(1, self.points // max(pv_count, 1))
+
+    # Adjust the budget after the server took seconds to answer a request for points values.
+    # Slow requests shrink the budget in proportion to how slow they were.  Requests that made full use
+    # of the budget and answered well within the target latency let it grow.
+    def succeeded(self, points: int, seconds: float):
+        with self._lock:
+            if seconds > target_latency:
+                self.points = int(self.points * target_latency / seconds)
+            elif seconds < target_latency / 4 and points >= self.points:
+                self.points = min(self.points * 2, self.ceiling)
+            self.points = max(self.points, min_points_per_request)
+
+    # Halve the budget after the server failed to answer a request for points values.
+    def failed(self, points: int):
+        with self._lock:
+            self.ceiling = max(min(self.ceiling, points - 1), min_points_per_request)
+            self.points = max(min(self.points, points) // 2, min_points_per_request)
+
+
+class Planner:
+    """Class to pack the PVs of many Samplers into shared requests to the Mya Web API"""
+
+    # Instantiate the object
+    #
+    #  samplers: the list of Sampler objects whose data is to be fetched.
+    #  budget: the Budget that sizes the chunks of long spans (default: a new Budget)
+    #
+    # Rather than each sampler making its own requests, the pvs of all samplers that share the
+    # same strategy and dates are combined so that every request carries up to throttle channels.
+    # Requests for long date spans are further split into chunks of time that fit within the budget.
+    # The data returned for each request is then sliced back out to the samplers that asked for it.
+    def __init__(self, samplers: list, budget: Budget = None):
+        self.samplers = samplers
+        self.budget = budget if budget is not None else Budget()
+        self.stats = SimpleNamespace(references=0, pvs=0, requests=0, chunks=0)
+        self._stored = {}   # The samples of pvs loaded from the stores, along with those stored since.  See load.
+        self._stored_lock = threading.Lock()
+
+    # Return lists of sampler indexes that can share requests because they have the same dates.
+    def groups(self) -> list:
+        groups = {}
+        for index, sampler in enumerate(self.samplers):
+            groups.setdefault(repr(sampler.dates), []).append(index)
+        return list(groups.values())
+
+    # Return the distinct pvs wanted by the samplers of a group as a dictionary of pv lists keyed by the index of
+    # the sampler that will fetch them.  Each pv is fetched once, by the first sampler that wants it, no matter
+    # how many samplers, such as the nodes of every cavity in a zone or the global sampler, share it.
+    # Samplers whose strategy and mode match those of an earlier sampler leave the fetching to that one.
+    def registry(self, group: list) -> dict:
+        fetchers = {}   # The index of the sampler fetching for each (strategy, mode)
+        registry = {}
+        seen = set()
+        for index in group:
+            sampler = self.samplers[index]
+            fetcher = fetchers.setdefault((sampler.strategy, sampler.mode), index)
+            for pv in sampler.pv_list:
+                self.stats.references += 1
+                if pv not in seen:
+                    seen.add(pv)
+                    registry.setdefault(fetcher, []).append(pv)
+        self.stats.pvs += len(seen)
+        return registry
+
+    # Return the list of planned requests.  Each request is a SimpleNamespace with the fields
+    #   pvs: the list of no more than throttle pvs to fetch, or with a mode other than sample, a single pv.
+    #        In auto mode, the pvs found to have too many events are later sampled together.  See repack.
+    #   span: the date span to fetch
+    #   owners: a dictionary of the pvs belonging to each sampler, keyed by sampler index
+    #   fetcher: the index of the sampler whose strategy and mode are used to fetch the pvs
+    #   mode: how to fetch the pvs (see Sampler.mode)
+    def requests(self) -> list:
+        requests_list = []
+        self.stats = SimpleNamespace(references=0, pvs=0, requests=0, chunks=0)
+        for group in self.groups():
+            pv_sets = {index: set(self.samplers[index].pv_list) for index in group}
+            spans = self.samplers[group[0]].spans()
+            for fetcher, pvs in self.registry(group).items():
+                sampler = self.samplers[fetcher]
+                for span in spans:
+                    for span, span_pvs in self.missing(sampler, span, pvs):
+                        size = throttle if sampler.mode == 'sample' else 1
+                        for i in range(0, len(span_pvs), size):
+                            chunk = span_pvs[i:i + size]
+                            owners = {}
+                            for index in group:
+                                owned = [pv for pv in chunk if pv in pv_sets[index]]
+                                if owned:
+                                    owners[index] = owned
+                            requests_list.append(SimpleNamespace(pvs=chunk, span=span, owners=owners,
+                                                                 fetcher=fetcher, mode=sampler.mode))
+        self.stats.requests = len(requests_list)
+        return requests_list
+
+    # Return the sample requests that fetch the pvs of auto mode requests that proved to have too many events to be
+    # fetched that way.  Like the pvs of any other sample requests, those of the same fetcher and span are packed
+    # into requests of up to throttle pvs rather than being sampled one at a time.
+    @staticmethod
+    def repack(deferred: list) -> list:
+        batches = {}
+        for request in deferred:
+            span = request.span
+            key = (request.fetcher, span.begin, span.end, span.interval, getattr(span, 'steps', None))
+            batches.setdefault(key, (span, []))[1].append(request)
+        requests_list = []
+        for (fetcher, *_), (span, batch) in batches.items():
+            for i in range(0, len(batch), throttle):
+                chunk = batch[i:i + throttle]
+                owners = {}
+                for request in chunk:
+                    for index, pvs in request.owners.items():
+                        owners.setdefault(index, []).extend(pvs)
+                requests_list.append(SimpleNamespace(pvs=[request.pvs[0] for request in chunk], span=span,
+                                                     owners=dict(sorted(owners.items())), fetcher=fetcher,
+                                                     mode='sample'))
+        return requests_list
+
+    # Return a summary of the statistics of the most recent fetch
+    def report(self) -> str:
+        return (f"Fetched {self.stats.pvs} distinct PVs for {self.stats.references} references "
+                f"({self.stats.references - self.stats.pvs} duplicates avoided) "
+                f"with {self.stats.requests} requests in {self.stats.chunks} chunks")
+
+    # Return the list of places, the cache and the checkpoint, in which fetched samples are kept
+    @staticmethod
+    def stores() -> list:
+        return [store for store in (cache, checkpoint) if store is not None]
+
+    # Return a (times, values) tuple of the samples of a pv in store as described for cache.ArchiveCache.load.
+    # The samples of each pv are read from the store only once by a Planner, which keeps track of those it
+    # stores itself rather than reading them back.
+    def load(self, store, pv: str, interval_ms: int) -> tuple:
+        key = (id(store), pv, interval_ms)
+        with self._stored_lock:
+            parts = self._stored.get(key)
+            if parts is None:
+                parts = self._stored[key] = [store.load(pv, deployment, interval_ms)]
+            elif len(parts) > 1:
+                parts[:] = [consolidate(parts)]
+            return parts[0]
+
+    # Return a list of (span, pvs) tuples covering the data for pvs within span that must be fetched from the server.
+    # Without a cache or checkpoint that is simply the entire span for every pv.  Otherwise, each pv needs only its
+    # runs of consecutive samples that are not already stored.  Pvs missing identical runs are listed together so
+    # that they can share requests.
+    def missing(self, sampler, span, pvs: list) -> list:
+        stores = Planner.stores()
+        if not stores:
+            return [(span, pvs)]
+        grid = sampler.grid(span)
+        interval_ms = sampler.to_milliseconds(span.interval)
+        runs = {}
+        for pv in pvs:
+            absent = numpy.ones(len(grid), dtype=bool)
+            for store in stores:
+                times, values = self.load(store, pv, interval_ms)
+                absent &= ~numpy.isin(grid, times)
+            if not absent.any():
+                continue
+            # Find the first index and the length of each run of absent samples
+            edges = numpy.diff(numpy.concatenate([[0], absent.astype(numpy.int8), [0]]))
+            starts = numpy.flatnonzero(edges == 1)
+            lengths = numpy.flatnonzero(edges == -1) - starts
+            key = tuple(zip(grid[starts].tolist(), lengths.tolist()))
+            runs.setdefault(key, []).append(pv)
+        missing = []
+        for key, run_pvs in runs.items():
+            for begin_ms, steps in key:
+                if steps == len(grid):
+                    missing.append((span, run_pvs))     # Nothing was cached
+                else:
+                    missing.append((sampler.sub_span(span, begin_ms, steps), run_pvs))
+        return missing
+
+    # Save the data returned for a request to the cache and the checkpoint
+    def store(self, span, data):
+        interval_ms = Sampler.to_milliseconds(span.interval)
+        for store in Planner.stores():
+            for pv in data.pvs:
+                column = data.column(pv).copy()
+                store.merge(pv, deployment, interval_ms, data.times, column)
+                with self._stored_lock:
+                    parts = self._stored.get((id(store), pv, interval_ms))
+                    if parts is not None:
+                        parts.append((data.times, column))
+
+    # Return the data for a sampler assembled from the cache and the checkpoint as Samples
+    def cached_data(self, sampler):
+        parts = []
+        for span in sampler.spans():
+            grid = sampler.grid(span)
+            interval_ms = sampler.to_milliseconds(span.interval)
+            part = Samples(grid, sampler.pv_list)
+            for pv in sampler.pv_list:
+                for store in Planner.stores():
+                    times, values = self.load(store, pv, interval_ms)
+                    positions = numpy.minimum(numpy.searchsorted(times, grid), max(len(times) - 1, 0))
+                    found = times[positions] == grid if len(times) else numpy.zeros(len(grid), dtype=bool)
+                    part.column(pv)[found] = values[positions[found]]
+            parts.append(part)
+        return Samples.combine(parts)
+
+    # Return the subset of data from a request that belongs to the given pvs
+    @staticmethod
+    def slice(data, pvs: list):
+        return data.select(pvs)
+
+    # Yield the chunks of the planned requests in order.  Each chunk is a SimpleNamespace with the fields
+    #   request: the planned request to which the chunk belongs
+    #   span: the part of the request's span to fetch
+    #   last: whether it is the final chunk of the request
+    # Chunks are sized by the budget as they are generated so that those yet to be sent benefit from
+    # what has been learned from the ones already answered.  Events are fetched in a single chunk because
+    # there are far fewer of them than there are steps.
+    def chunks(self, requests_list: list):
+        for request in requests_list:
+            if request.mode != 'sample':
+                yield SimpleNamespace(request=request, span=request.span, last=True)
+                continue
+            sampler = self.samplers[request.fetcher]
+            steps = sampler.total_steps(request.span)
+            begin_ms = None
+            done = 0
+            while done < steps:
+                size = min(self.budget.steps(len(request.pvs)), steps - done)
+                if size == steps:
+                    span = request.span
+                else:
+                    if begin_ms is None:
+                        begin_ms = sampler.begin_ms(request.span)
+                    span = sampler.sub_span(request.span, begin_ms + done * sampler.to_milliseconds(request.span.interval), size)
+                done += size
+                yield SimpleNamespace(request=request, span=span, last=done >= steps)
+
+    # Fetch the data for pvs within span.  If the server fails to answer, the span is split in two and each half
+    # is tried in turn, until the failing span is a single step.  The outcome of sampling is reported to the budget.
+    # With a mode other than sample, the single pv is fetched as events.  In auto mode, None is returned instead if
+    # it proves to have too many events, so that it can be sampled along with others.  See repack.
+    def get(self, sampler, pvs: list, span, mode: str = 'sample'):
+        steps = sampler.total_steps(span)
+        started = time.monotonic()
+        try:
+            if mode != 'sample':
+                limit = max(min_events_limit, int(steps * events_ratio)) if mode == 'auto' else None
+                return sampler.get_events(pvs[0], span, limit)
+            data = sampler.get_data_for_pvs(pvs, span)
+        except MyaServerException:
+            self.budget.failed(steps * len(pvs))
+            if steps <= 1:
+                raise
+            halves = [self.get(sampler, pvs, half, mode) for half in sampler.split(span, (steps + 1) // 2)]
+            return None if None in halves else Samples.combine(halves)
+        self.budget.succeeded(steps * len(pvs), time.monotonic() - started)
+        return data
+
+    # Make a request and return a dictionary of its data sliced for each owner, keyed by sampler index.
+    # If the server rejects the combined request, the pvs of each owner are re-requested separately so that
+    # only the sampler(s) with problematic pvs receive a MyaException in place of data.
+    # None is returned for an auto mode request whose pv has too many events to be fetched that way.
+    def run(self, request, span=None):
+        span = span if span is not None else request.span
+        try:
+            data = self.get(self.samplers[request.fetcher], request.pvs, span, request.mode)
+            if data is None:
+                return None
+            self.store(span, data)
+            return {index: self.slice(data, pvs) for index, pvs in request.owners.items()}
+        except MyaException:
+            if len(request.owners) == 1:
+                raise
+        results = {}
+        for index, pvs in request.owners.items():
+            try:
+                results[index] = self.get(self.samplers[index], pvs, span, request.mode)
+                if results[index] is None:
+                    return None
+                self.store(span, results[index])
+            except MyaException as err:
+                results[index] = err
+        return results
+
+    # Fetch the chunks of the planned requests on the worker pool and merge their results into each sampler.
+    # Yields (sampler, error) tuples in sampler order as described for fetch_all.
+    # When data is cached or checkpointed, each sampler's data is assembled from there once its requests are complete.
+    # The pvs of auto mode requests that have too many events are sampled once all the planned requests are done.
+    def fetch(self, with_spin=False):
+        for sampler in self.samplers:
+            if not sampler.pv_list:
+                raise RuntimeError("No channels to fetch")
+
+        requests_list = self.requests()
+        remaining = [0] * len(self.samplers)
+        for request in requests_list:
+            for index in request.owners:
+                remaining[index] += 1
+
+        def run(chunk):
+            try:
+                return chunk, self.run(chunk.request, chunk.span)
+            except MyaException as err:
+                return chunk, {index: err for index in chunk.request.owners}
+
+        def complete(index):
+            if index not in errors:
+                sampler = self.samplers[index]
+                if self.stores():
+                    sampler.set_data(sampler.pick(self.cached_data(sampler)))
+                else:
+                    sampler.set_data(sampler.pick(Samples.combine(parts[index])))
+            return self.samplers[index], errors.get(index)
+
+        def merge(requests_list):
+            nonlocal next_index
+            for chunk, results in pooled(run, self.chunks(requests_list)):
+                self.stats.chunks += 1
+                if with_spin:
+                    self.samplers[0].spin(spinner)
+                if results is None:
+                    deferred.append(chunk.request)    # Still counted as remaining until it is repacked
+                    continue
+                for index, result in results.items():
+                    if isinstance(result, MyaException):
+                        errors.setdefault(index, result)
+                    elif index not in errors and not self.stores():
+                        parts[index].append(result)
+                    if chunk.last:
+                        remaining[index] -= 1
+                while next_index < len(self.samplers) and remaining[next_index] == 0:
+                    yield complete(next_index)
+                    next_index += 1
+
+        spinner = itertools.cycle(['-', '/', '|', '\\'])
+        parts = [[] for sampler in self.samplers]   # The Samples returned for each sampler
+        errors = {}
+        deferred = []   # Auto mode requests whose pvs have too many events
+        next_index = 0  # The next sampler to be yielded
+        yield from merge(requests_list)
+        if deferred:
+            packed = self.repack(deferred)
+            for request in deferred:
+                for index in request.owners:
+                    remaining[index] -= 1
+            for request in packed:
+                for index in request.owners:
+                    remaining[index] += 1
+            self.stats.requests += len(packed)
+            yield from merge(packed)
+        # Samplers with no requests at all (i.e. no dates or entirely cached) have nothing to wait for
+        while next_index < len(self.samplers):
+            yield complete(next_index)
+            next_index += 1
+        if cache is not None:
+            cache.evict()
+
 
 # Utility function for extracting a value from a list containing key:value dictionaries,
 # such as the myaweb server returns for the PV values.
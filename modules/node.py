@@ -5,15 +5,18 @@ import yaml
 import re
 import json
 import pandas
+import numpy
 import os
 import logging
 import datetime
+import collections
 from modules import ced
 from modules import mya
 import modules.util as util
 import modules.hgb as hgb
+import modules.columnar as columnar
 
-from modules.filter import macro_substitute
+from modules.filter import compile_expression
 from modules.filter import make as makeFilter
 from modules.filter import FilterException
 
@@ -29,6 +32,10 @@ default_attributes = {
 # An empty list signifies a master node does not exist.
 master = []
 
+# When edges are weighted, nodes closer together along the beamline than this, in the units of S (meters),
+# such as two elements at the same S, are weighted as though they were this far apart.
+min_weight_spacing = 0.01
+
 def has_master():
     return len(master) > 0
 
@@ -45,10 +52,11 @@ class Node():
         if modifiers is None:
             modifiers = {}
         self.modifiers = modifiers
-        self.data = []  # Stores array of timestamped data sets from mya
+        self.data = None  # May be assigned a list of timestamped data sets to use instead of the sampler's
         self.links = []  # Stores links to downstream nodes to use when building graph edges
         self.node_id = None
         self.type_name = None
+        self._plan = None  # See attribute_plan
 
     # Get the name used to construct EPICS PVs.
     def epics_name(self):
@@ -90,29 +98,49 @@ class Node():
         else:
             return f'{epics_name}{field}'
 
-    # Retrieve PV values using the available data sampler
-    # TODO stash the data keyed by timestamp for most efficient retrieval
+    # Make the sampler ready to fetch data for the node's PVs
+    def prepare_sampler(self):
+        self.sampler.pv_list = self.pv_list()
+        # Try to optimize data fetching
+        if (isinstance(self, SetPointNode)):
+            self.sampler.strategy = 's'
+            self.sampler.mode = mya.setpoint_mode
+        else:
+            self.sampler.strategy = 'n'
+
+    # Retrieve PV values using the available data sampler as a list of timestamped data sets
     def pv_data(self):
+        if self.data is not None:
+            return self.data
+        self.samples()
+        return self.sampler.structured_data()
+
+    # Retrieve PV values using the available data sampler as columnar mya.Samples
+    def samples(self) -> mya.Samples:
         # If data not already retrieved, do that first
-        if not self.data:
-            self.sampler.pv_list = self.pv_list()
-            # Try to optimize data fetching
-            if (isinstance(self, SetPointNode)):
-                self.sampler.strategy = 's'
-            else:
-                self.sampler.strategy = 'n'
-            self.data = self.sampler.data()
-        # And then give it to the user
-        return self.data
+        if not self.sampler.has_data():
+            self.prepare_sampler()
+        return self.sampler.samples()
 
     # Retrieve the pv values for a given date and time
-    # Note that this method has a problem in that the MyaWeb server sends back string dates
-    # which means that during DST "fall back" the 01:00 timestamp is ambiguous.
-    def pv_data_at_datetime(self, desired_date):
-        for item in self.pv_data():
-            if pandas.to_datetime(item['date']) == pandas.to_datetime(desired_date):
-                return item['values']
-        return None
+    # Because the MyaWeb server sends back string dates, the 01:00 hour during the DST "fall back" occurs twice.
+    # The data is indexed by epoch time, in which the first is in DST and the second in standard time, and fold
+    # selects which is desired as described for mya.epoch_ms.
+    def pv_data_at_datetime(self, desired_date, fold: int = 0):
+        data = self.pv_data()
+        if self.data is not None:
+            # Data that was assigned rather than fetched must be indexed separately
+            if getattr(self, '_data_rows', (None,))[0] is not data:
+                times = mya.to_epoch_ms([item['date'] for item in data])
+                self._data_rows = (data, {time: i for i, time in enumerate(times.tolist())})
+            row = self._data_rows[1].get(mya.epoch_ms(desired_date, fold))
+        else:
+            row = self.sampler.row(mya.epoch_ms(desired_date, fold))
+        return data[row]['values'] if row is not None else None
+
+    # Return the row index of the data at the epoch millisecond timestamp time or None if there is none
+    def row(self, time: int):
+        return self.samples().row(time)
 
     # Retrieve the pv values for the specified index position in the data array
     def pv_data_at_index(self, index):
@@ -143,31 +171,63 @@ class Node():
             attribute_values.append(self.element['properties'][attribute_name])
         return attribute_values
 
+    # Return the plan by which attributes are extracted from the node's samples as a tuple of
+    #   the samples to which the plan applies
+    #   the list of CED attribute values, which are the same at every timestamp
+    #   the array of the column index in the samples of each epics field for which there are samples
+    #   a list of (position, values, integers) for each of those fields whose PV has a modifier, where values
+    #     is the array of its modified values and integers is as described for modified_epics_values
+    # The plan is compiled when first needed after data has been fetched or set, so that the PV names and
+    # their columns need not be looked up, nor modifiers calculated, again for each timestamp.
+    def attribute_plan(self):
+        samples = self.samples()
+        if self._plan is None or self._plan[0] is not samples:
+            pv_names = [self.pv_name(self.epics_name(), field) for field in self.epics_fields]
+            pv_names = [pv_name for pv_name in pv_names if samples.has(pv_name)]
+            columns = numpy.array([samples.columns[pv_name] for pv_name in pv_names], dtype=numpy.intp)
+            modified = []
+            for position, pv_name in enumerate(pv_names):
+                if pv_name in self.modifiers:
+                    modified.append((position,) + self.modified_epics_values(pv_name, samples.column(pv_name)))
+            self._plan = (samples, self.ced_attribute_values(), columns, modified)
+        return self._plan
+
     # Return epics-based node attributes for the specified array index
     # The function will apply any applicable calculations from the modifiers
     # dictionary to the returned values
     def epics_attribute_values(self, index):
-        attribute_values = []
-        for field in self.epics_fields:
-            for value in self.pv_data_at_index(index):
-                pv_name = list(value.keys())[0]
-                if pv_name == self.pv_name(self.epics_name(), field):
-                    attribute_values.append(self.modified_epics_value(pv_name, value[pv_name]))
+        samples, ced_values, columns, modified = self.attribute_plan()
+        attribute_values = [mya.format_value(value) for value in samples.values[index].take(columns).tolist()]
+        for position, values, integers in modified:
+            value = values[index]
+            if value != value:
+                attribute_values[position] = mya.format_value(value)
+            elif integers[index]:
+                attribute_values[position] = str(int(value))
+            else:
+                attribute_values[position] = repr(float(value))
         return attribute_values
 
-    # If necessary, apply calculations from the modifiers dictionary to the provided pv_value
-    def modified_epics_value(self, pv_name, pv_value):
-        if pv_name in self.modifiers.keys() and pv_value != '<undefined>':
-            expr = macro_substitute(pv_name, pv_value, self.modifiers[pv_name])
-            return str(eval(expr))
-        else:
-            return str(pv_value)
+    # Apply the calculation from the modifiers dictionary for pv_name to the array of its values, returning a tuple
+    # of the array of results and an array of whether each is an integer.  The results are formatted as if the
+    # modifier had been evaluated by python with the value in place of the PV, in which an integer value may give
+    # an int result, formatted without a trailing .0, where any other gives a float.  Undefined values stay so.
+    def modified_epics_values(self, pv_name, values: numpy.ndarray) -> tuple:
+        try:
+            expression = compile_expression(self.modifiers[pv_name])
+        except FilterException as err:
+            raise RuntimeError(f'Invalid modifier for {pv_name}: {err.args[0]}')
+        if expression.pvs != [pv_name]:
+            raise RuntimeError(f'The modifier for {pv_name} may only refer to $({pv_name})')
+        whole = (values == numpy.floor(values)) & (numpy.abs(values) < 1e16)
+        integers = numpy.where(whole, expression.is_integer(True), expression.is_integer(False))
+        return expression.evaluate({pv_name: values}), integers
 
     # Return the node's attributes
     # The attributes include ced attributes which are single-valued and the
     # epics data attributes which come from an array of values at the specified index.
     def attribute_values(self, index):
-        return self.ced_attribute_values() + self.epics_attribute_values(index)
+        return self.attribute_plan()[1] + self.epics_attribute_values(index)
     # TODO replace with TypeInfo invocation
     def attribute_names(self):
         attribute_names = self.ced_attribute_names()
@@ -213,7 +273,6 @@ class MasterNode(SetPointNode):
             "properties": [],
         }
         super().__init__(element,master,sampler)
-        self.data = sampler.data()
         self.type_name = 'MasterNode'
 
     # The node's name
@@ -325,22 +384,23 @@ class List():
         # Attempt to match the type of the element to the types specified in the
         # config to determine whether to instantiate as ReadBack or SetPoint node variety
         # Important: we will only assign the fields of the first matched type.
+        # The tree remembers the match for each element type, so elements of the same type are classified once.
         if 'setpoints' in config['nodes']:
-            for type_name, fields in config['nodes']['setpoints'].items():
-                if not node and tree.is_a(type_name, element['type']):
-                    node = SetPointNode(element, fields, sampler, modifiers)
-                    node.type_name = type_name  # Assign type name that matched
-                    break
-        if 'readbacks' in config['nodes']:
-            for type_name, fields in config['nodes']['readbacks'].items():
-                if not node and tree.is_a(type_name, element['type']):
-                    node = ReadBackNode(element, fields, sampler, modifiers)
-                    node.type_name = type_name  # Assign type name that matched
-                    break
+            setpoints = config['nodes']['setpoints']
+            type_name = tree.match(tuple(setpoints), element['type'])
+            if type_name is not None:
+                node = SetPointNode(element, setpoints[type_name], sampler, modifiers)
+                node.type_name = type_name  # Assign type name that matched
+        if 'readbacks' in config['nodes'] and not node:
+            readbacks = config['nodes']['readbacks']
+            type_name = tree.match(tuple(readbacks), element['type'])
+            if type_name is not None:
+                node = ReadBackNode(element, readbacks[type_name], sampler, modifiers)
+                node.type_name = type_name  # Assign type name that matched
 
         return node
 
-        # Link downstream nodes to each ReadbackNode within node_list.
+    # Link downstream nodes to each ReadbackNode within node_list.
 
     # The connectivity built here is just up to and including the next ReadBackNode.
     # Later when writing out edge files, the connectivity can be extended by simply
@@ -349,8 +409,8 @@ class List():
     @staticmethod
     def populate_links(node_list):
         # Begin with a copy of the original list whose elements we can pop fron the front
-        working_list = node_list.copy()
-        current_node = working_list.pop(0)
+        working_list = collections.deque(node_list)
+        current_node = working_list.popleft()
         current_node.links = []
         # The while loop below fills the links list of every SetPoint node with references
         # to all the ensuing nodes up to and including the next SetPoint Node.
@@ -358,11 +418,11 @@ class List():
             # The master node is special and must be linked to all ensuing setpoint nodes
             if isinstance(current_node, MasterNode):
                 current_node.links = list(filter(lambda x: isinstance(x, SetPointNode), working_list))
-                current_node = working_list.pop(0)
+                current_node = working_list.popleft()
                 current_node.links = []
                 continue  # Do not fall through to regular SetPointNode processing
             # For regular nodes, we need the next node as well as the current one
-            next_node = working_list.pop(0)
+            next_node = working_list.popleft()
             if isinstance(current_node, SetPointNode):
                 current_node.links.append(next_node)    # Node following a set point is always linked
             if isinstance(next_node, SetPointNode):
@@ -371,43 +431,81 @@ class List():
             if len(working_list) < 1:
                 break
 
+    # Return the Topology of the edges between the nodes of node_list as configured
+    @staticmethod
+    def topology(node_list, config):
+        return Topology(node_list, config['edges']['connectivity'], config['edges'].get('weighted', False))
+
     # Write out the node.dat, link.dat, meta.dat, and info.dat for each sampled timestamp
+    #   filtered is the result of applying the filter to global_data as returned by Filter.mask if it is already known
+    # Returns the sorted list of the indexes of the global_data whose data sets were written.
     @staticmethod
-    def write_data_sets(global_data: list, node_list: list, config: dict, output_dir):
-        i = 0
-        valid_indexes = []
-        filter = makeFilter(config['nodes']['filter'])
-        # We expect that the global data was sampled at the same intervals as the node data,
-        # so when we find a row we want to keep while looping through the global data, we will
-        # have nodes data for the same time period at the at the identical array index.
-        # for data in global_data:
-        for data in util.progressBar(global_data, prefix='Write to Disk:', suffix='', length=60):
-            try:
-                if filter.passes(data):
-                    # For compatibility with older config files which didn't have it,
-                    # we must check for existance of the structure key.  If it's missing we
-                    # will default to the original tree-style output.
-                    if 'structure' in config['output'] and config['output']['structure'] == 'directory':
-                        directory = hgb.dir_from_date(output_dir, data['date'])
-                    else:
-                        directory = hgb.path_from_date(output_dir, data['date'],
-                                                       minutes=config['output']['minutes'],
-                                                       seconds=config['output']['seconds'])
-                    if not os.path.exists(directory):
-                        os.makedirs(directory)
-                    hgb.write_meta_dat(directory, config, node_list)
-                    hgb.write_node_dat(directory, config, node_list, i)
-                    hgb.write_link_dat(directory, node_list, config['edges']['connectivity'])
-                    hgb.write_info_dat(directory, config, node_list)
-                    List.write_global_data_values(directory, data)   # data is global_data at current date
-            except FilterException as err:
+    def write_data_sets(global_data: list, node_list: list, config: dict, output_dir, filtered: tuple = None):
+        if filtered is None:
+            filtered = makeFilter(config['nodes']['filter']).mask(global_data)
+        mask, errors = filtered
+        # We expect that the global data was sampled at the same intervals as the node data, but rather than rely
+        # on the rows of each being at identical array indexes, the row of each node is looked up by the epoch
+        # time of the global data row.  Should any node lack data for that time, the data set is not written.
+        times = mya.to_epoch_ms([data['date'] for data in global_data])
+        columnar_output = config['output'].get('structure') == 'columnar'
+        if not columnar_output:
+            directories = hgb.paths_from_dates(output_dir, [data['date'] for data in global_data], config['output'])
+        selected = []
+        tasks = {}
+        written = {}
+        for i, data in enumerate(global_data):
+            if i in errors:
                 # The details of RuntimeErrors are stored in the args attribute, which is a list.
-                logging.info(data['date'] + ' ' + err.args[0])
-            i += 1
-
-    # Write out a globals.json file at the specified path
+                logging.info(data['date'] + ' ' + errors[i].args[0])
+                continue
+            if not mask[i]:
+                continue
+            rows = [item.row(times[i]) for item in node_list]
+            if None in rows:
+                missing = [item.name() for item, row in zip(node_list, rows) if row is None]
+                logging.warning(data['date'] + ' skipped because data is missing for ' + ', '.join(missing))
+                continue
+            if columnar_output:
+                selected.append((i, rows))
+                continue
+            # Where several timestamps share a directory, as they do if the tree structure is not as fine as
+            # the interval, the last of them is the one written.
+            tasks.pop(directories[i], None)
+            tasks[directories[i]] = (directories[i], rows, data)
+            written[directories[i]] = i
+        tasks = list(tasks.values())
+        if not tasks and not selected:
+            return []
+
+        # The links between nodes are the same for every data set
+        topology = List.topology(node_list, config)
+        if columnar_output:
+            columnar.write(os.path.join(output_dir, columnar.store_dir), config, node_list, topology,
+                           [times[i] for i, rows in selected], [rows for i, rows in selected],
+                           [global_data[i] for i, rows in selected])
+            return [i for i, rows in selected]
+
+        # So are the files that describe the links and the node types.  They are written once, to the first data
+        # set or, if they are to be linked, to output_dir, and then linked or copied from there into every other.
+        link = config['output'].get('static_files', 'copy') == 'link'
+        static_dir = output_dir if link else tasks[0][0]
+        os.makedirs(static_dir, exist_ok=True)
+        hgb.write_static_files(static_dir, config, node_list, topology)
+
+        # The attribute plans of the nodes are compiled beforehand so that writer processes need not each do so
+        for item in node_list:
+            item.attribute_plan()
+        writer = hgb.Writer(config, node_list, static_dir, link)
+        for _ in util.progressBar(writer.write_all(tasks, config['output'].get('workers', 1)),
+                                  prefix='Write to Disk:', suffix='', length=60, total=len(tasks)):
+            pass
+        return sorted(written.values())
+
+    # Write out a globals.json file at the specified path, compressed as specified by output,
+    # the output section of the config
     @staticmethod
-    def write_global_data_values(path, global_data):
+    def write_global_data_values(path, global_data, output: dict = None):
 
         # First we simplify the data structure
         global_dict = {}
@@ -415,10 +513,55 @@ class List():
             for key in item.keys():
                 global_dict[key] = item[key]
         # Then we write simplified version to a file
-        file_name = os.path.join(path, 'globals.json')
-        f = open(file_name, 'w')
-        json.dump(global_dict, f, indent=2)
-        f.close()
+        hgb.write_text(path, 'globals.json', json.dumps(global_dict, indent=2), output)
+
+class Topology():
+    """Class to hold the edges among a list of nodes as arrays, built once from the links of the nodes"""
+
+    # Instantiate the object
+    #   node_list is a list of nodes whose links have been populated.  See List.populate_links.
+    #   distance is the number of SetPointNodes away to which each SetPointNode is linked.  See Node.extended_links.
+    #   weighted is whether each edge is weighted by the inverse of the distance between its nodes along the beamline,
+    #            1/|S[target]-S[source]|, which is the same whether the target is downstream or upstream of the source.
+    #            A distance less than min_weight_spacing counts as min_weight_spacing.  Edges of a node without an S,
+    #            such as the master node, are given the same weight of 1 as all edges are when they are not weighted.
+    #
+    # The edges are held as
+    #   edge_index: a (2, E) integer array of the node_id of the source and target of each edge
+    #   edge_type: an integer array of the type of each edge.  For now all are of type 0.
+    #   edge_weight: a float array of the weight of each edge
+    def __init__(self, node_list: list, distance: int = 1, weighted: bool = False):
+        sources = []
+        targets = []
+        for position, item in enumerate(node_list):
+            if isinstance(item, SetPointNode):
+                links = item.extended_links(distance)
+                sources.extend([position] * len(links))
+                targets.extend(links)
+        positions = {id(item): position for position, item in enumerate(node_list)}
+        sources = numpy.array(sources, dtype=numpy.int64)
+        targets = numpy.array([positions[id(target)] for target in targets], dtype=numpy.int64)
+        node_ids = numpy.array([item.node_id if item.node_id is not None else -1 for item in node_list],
+                               dtype=numpy.int64)
+        self.edge_index = numpy.stack([node_ids[sources], node_ids[targets]]).reshape(2, len(sources))
+        self.edge_type = numpy.zeros(len(sources), dtype=numpy.int64)
+        self.edge_weight = numpy.ones(len(sources), dtype=numpy.float64)
+        if weighted and len(sources):
+            s = mya.to_float([Topology.s(item) for item in node_list])
+            with numpy.errstate(all='ignore'):
+                weights = 1 / numpy.maximum(numpy.abs(s[targets] - s[sources]), min_weight_spacing)
+            finite = numpy.isfinite(weights)
+            self.edge_weight[finite] = weights[finite]
+
+    # The S property of a node's CED element, its distance along the beamline, or None if it has none
+    @staticmethod
+    def s(item):
+        properties = item.element.get('properties')
+        return properties.get('S') if isinstance(properties, dict) else None
+
+    def __len__(self):
+        return self.edge_index.shape[1]
+
 
 class ListEncoder(json.JSONEncoder):
     """Helper class for exporting json-encoded node lists"""
@@ -430,7 +573,7 @@ class ListEncoder(json.JSONEncoder):
             return {
                 'dates': obj.dates,
                 'pv_list': obj.pv_list,
-                'data': obj._data,
+                'data': obj.structured_data() if obj.has_data() else None,
             }
         if isinstance(obj, Node):
             return {
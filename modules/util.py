@@ -1,10 +1,29 @@
 # -*- coding: utf-8 -*-
 # General purpose helper code
 
+import time
+import random
+
+# HTTP status codes with which an overloaded server or proxy says to try again later.
+transient_status = (429, 502, 503, 504)
+
+
+# Return the result of calling func, calling it again if it raises one of the transient exception types.
+# Up to retries further attempts are made, pausing before each for backoff seconds doubled after every failure.
+# The pauses are randomized by up to half so that concurrent callers don't all retry at the same moment.
+def retry(func, retries: int, backoff: float, transient: tuple):
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except transient:
+            if attempt >= retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
 # Define a progressbar
 # This function has been shamelessly borrowed from the forum posting cited below -- many thanks to its author.
 # @see https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
-def progressBar(iterable, prefix = '', suffix = '', decimals = 1, length = 80, fill = '#', printEnd = "\r"):
+def progressBar(iterable, prefix = '', suffix = '', decimals = 1, length = 80, fill = '#', printEnd = "\r", total = None):
     """
     Call in a loop to create terminal progress bar
     @params:
@@ -15,8 +34,10 @@ def progressBar(iterable, prefix = '', suffix = '', decimals = 1, length = 80, f
         length      - Optional  : character length of bar (Int)
         fill        - Optional  : bar fill character (Str)
         printEnd    - Optional  : end character (e.g. "\r", "\r\n") (Str)
+        total       - Optional  : number of items when iterable has no len(), such as a generator (Int)
     """
-    total = len(iterable)
+    if total is None:
+        total = len(iterable)
     # Progress Bar Printing Function
     def printProgressBar (iteration):
         percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
@@ -0,0 +1,86 @@
+# File containing some tests of the cache module.
+
+import os
+import time
+import numpy
+import modules.cache as cache
+
+
+# Least recently used files are evicted first once the store grows beyond its maximum size
+def test_evicts_least_recently_used(tmp_path):
+    store = cache.Store(str(tmp_path), size=1)     # 1 MB
+    block = b'x' * 400 * 1024
+    for name in ['a', 'b', 'c']:
+        store.write((name,), block)
+        # Make the modification times distinct and ordered a, b, c
+        os.utime(store.path((name,)), (time.time() - 100, time.time() - 100 + ord(name)))
+    store.read(('a',))      # 'a' is now the most recently used
+    store.evict()
+    assert store.read(('a',)) == block
+    assert store.read(('b',)) is None
+    assert store.read(('c',)) == block
+
+
+# Merged samples replace cached samples at the same times and are kept in time order
+def test_archive_cache_merge(tmp_path):
+    archive = cache.ArchiveCache(str(tmp_path))
+    archive.merge('IBC0L02Current', 'history', 3600000, [3600000, 7200000], [1.5, 2.5])
+    archive.merge('IBC0L02Current', 'history', 3600000, [0, 7200000], [0.5, float('nan')])
+    times, values = archive.load('IBC0L02Current', 'history', 3600000)
+    assert list(times) == [0, 3600000, 7200000]
+    assert list(values[:2]) == [0.5, 1.5]
+    assert numpy.isnan(values[2])
+    # Other deployments are cached separately
+    times, values = archive.load('IBC0L02Current', 'ops', 3600000)
+    assert len(times) == 0
+
+
+# Each merge adds a segment of its own until there are too many and they are compacted into one
+def test_archive_cache_compacts_segments(tmp_path):
+    archive = cache.ArchiveCache(str(tmp_path))
+    for i in range(archive.max_segments):
+        archive.merge('IBC0L02Current', 'history', 1000, [i * 1000, (i + 1) * 1000], [i, i])
+    assert len(archive.segments('IBC0L02Current', 'history', 1000)) == archive.max_segments
+    times, values = archive.load('IBC0L02Current', 'history', 1000)
+    assert list(values) == list(range(archive.max_segments)) + [archive.max_segments - 1]
+
+    archive.merge('IBC0L02Current', 'history', 1000, [0], [-1])
+    assert len(archive.segments('IBC0L02Current', 'history', 1000)) == 1
+    times, values = archive.load('IBC0L02Current', 'history', 1000)
+    assert list(times) == [i * 1000 for i in range(archive.max_segments + 1)]
+    assert list(values) == [-1] + list(range(1, archive.max_segments)) + [archive.max_segments - 1]
+
+
+# Samples saved to a checkpoint are there for the next attempt at a run
+def test_checkpoint_reloads_saved_samples(tmp_path):
+    checkpoint = cache.Checkpoint(str(tmp_path))
+    checkpoint.merge('IBC0L02Current', 'history', 3600000, [7200000, 10800000], [2.5, 3.5])
+    checkpoint.merge('IBC0L02Current', 'history', 3600000, [0, 3600000], [0.5, 1.5])
+    checkpoint.save_json('config.json', {'mya': {'throttle': 10}})
+
+    # Where batches overlap, the latest samples are kept
+    checkpoint.merge('IBC0L02Current', 'history', 3600000, [3600000, 7200000], [1.75, 2.75])
+
+    resumed = cache.Checkpoint(str(tmp_path))
+    times, values = resumed.load('IBC0L02Current', 'history', 3600000)
+    assert list(times) == [0, 3600000, 7200000, 10800000]
+    assert list(values) == [0.5, 1.75, 2.75, 3.5]
+    assert list(checkpoint.load('IBC0L02Current', 'history', 3600000)[1]) == [0.5, 1.75, 2.75, 3.5]
+    assert resumed.load_json('config.json') == {'mya': {'throttle': 10}}
+    assert resumed.load_json('missing.json') is None
+
+
+# Cached CED responses expire after the ttl unless none is given
+def test_ced_cache_ttl(tmp_path):
+    store = cache.CedCache(str(tmp_path))
+    key = store.key('https://ced.acc.jlab.org/inventory', 'Injector')
+    store.save(key, [{'name': 'MQD0R05'}])
+    assert store.load(key, 60) == [{'name': 'MQD0R05'}]
+    assert store.load(key) == [{'name': 'MQD0R05'}]
+    assert store.load(key, -1) is None
+    assert store.load(store.key('https://ced.acc.jlab.org/inventory', 'North Linac')) is None
+    # An expired entry is still available, with its validators, to ask the server whether it has changed
+    store.save(key, [{'name': 'MQD0R05'}], {'ETag': '"v1"'})
+    assert store.load(key, -1) is None
+    assert store.entry(key)['validators'] == {'ETag': '"v1"'}
+    assert store.entry(store.key('https://ced.acc.jlab.org/inventory', 'North Linac')) is None
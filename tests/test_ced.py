@@ -3,6 +3,7 @@
 from modules.ced import *
 from modules.mya import Sampler
 import json
+from types import SimpleNamespace
 
 # Test ability to identify whether an element type is a sub-type of another
 from modules.node import Node
@@ -20,6 +21,13 @@ def test_is_a():
     assert tree.is_a('Magnet','Quad')
     assert not tree.is_a('IOC', 'Dipole')
 
+    # The lineage comes from an index of the tree rather than a search of it
+    found, lineage = tree.lineage('qb')
+    assert found and lineage[-1] == 'QB' and 'Quad' in lineage
+    assert tree.lineage('QB') == tree.lineage('QB', tree.tree, [])
+    assert tree.match(('BPM', 'Magnet', 'Quad'), 'QB') == 'Magnet'
+    assert tree.match(('BPM', 'IOC'), 'QB') is None
+
 # Test Node ability to extract correct data for a timestamp
 def test_pv_data_at():
     # Even though it won't use it in this test, we need a sampler object
@@ -49,3 +57,71 @@ def test_inventory():
     assert 'EPICSName' in inventory.properties
     # And 3 properties total (i.e. no duplicates from redundant S in constructor)
     assert len(inventory.properties) == 3
+
+
+# The inventory of a history workspace is only fetched from CED if it isn't already cached
+def test_inventory_cache(tmp_path, monkeypatch):
+    import modules.ced as ced
+    import modules.cache as cache
+    fetched = []
+
+    def get(url, params=None, **kwargs):
+        fetched.append(url)
+        return SimpleNamespace(status_code=200, url=url, headers={}, json=lambda: {
+            'stat': 'ok', 'Inventory': {'elements': [{'name': 'MQD0R05', 'type': 'QD'}]}})
+
+    monkeypatch.setattr(ced.requests, 'get', get)
+    monkeypatch.setattr(ced, 'cache', cache.CedCache(str(tmp_path)))
+    monkeypatch.setattr(ced, 'history', True)
+    monkeypatch.setattr(ced, 'workspace', '2021-09-10')
+    for i in range(2):
+        assert Inventory('Injector', ['Quad']).elements() == [{'name': 'MQD0R05', 'type': 'QD'}]
+    assert len(fetched) == 1
+    # Another workspace is another inventory
+    monkeypatch.setattr(ced, 'workspace', '2021-09-11')
+    Inventory('Injector', ['Quad']).elements()
+    assert len(fetched) == 2
+
+
+# The type tree is requested again when the server says to try again later, like the inventory
+def test_type_tree_retry(monkeypatch):
+    import modules.ced as ced
+    import requests
+    statuses = [503, 200]
+
+    def get(url, headers=None, **kwargs):
+        status = statuses.pop(0)
+        def raise_for_status():
+            raise requests.exceptions.HTTPError(status)
+        return SimpleNamespace(status_code=status, url=url, headers={}, raise_for_status=raise_for_status,
+                               json=lambda: {'Elem': {'QB': 'QB'}})
+
+    monkeypatch.setattr(ced.requests, 'get', get)
+    monkeypatch.setattr(ced, 'cache', None)
+    monkeypatch.setattr(ced, 'backoff', 0)
+    tree = TypeTree()
+    assert tree.lineage('QB')[0]
+    assert tree.tree == {'Elem': {'QB': 'QB'}}
+    assert not statuses
+
+
+# An expired cached response is used again if the server says it has not changed since its ETag
+def test_expired_cache_revalidation(tmp_path, monkeypatch):
+    import modules.ced as ced
+    import modules.cache as cache
+    requested = []
+
+    def get(url, params=None, headers=None, **kwargs):
+        requested.append(headers)
+        if headers and headers.get('If-None-Match') == '"v1"':
+            return SimpleNamespace(status_code=304, url=url, headers={'ETag': '"v1"'})
+        return SimpleNamespace(status_code=200, url=url, headers={'ETag': '"v1"'}, json=lambda: {
+            'stat': 'ok', 'Inventory': {'elements': [{'name': 'MQD0R05', 'type': 'QD'}]}})
+
+    monkeypatch.setattr(ced.requests, 'get', get)
+    monkeypatch.setattr(ced, 'cache', cache.CedCache(str(tmp_path)))
+    monkeypatch.setattr(ced, 'history', False)
+    monkeypatch.setattr(ced, 'ttl', -1)    # Every cached response has expired
+    for i in range(2):
+        assert Inventory('Injector', ['Quad']).elements() == [{'name': 'MQD0R05', 'type': 'QD'}]
+    assert requested == [{}, {'If-None-Match': '"v1"'}]
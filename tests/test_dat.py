@@ -0,0 +1,140 @@
+# File containing some tests of the data_loader's parsing of data sets.
+
+import gzip
+import json
+from datetime import datetime
+import numpy
+import pytest
+from data_loader.dat import NodeData, read_node_dat, edge_order
+from data_loader.columnar import CEBAFColumnarLoader
+
+
+# The nodes of a node.dat file, compressed or not, are read into arrays
+def test_read_node_dat(tmp_path):
+    text = "NODE\tNAME\tTYPE\tVALUES\n0\tMasterNode \t 0 \t 1.5\n1\tMQB1 \t 2 \t 3,<undefined>,-0.25\n"
+    (tmp_path / 'node.dat.gz').write_bytes(gzip.compress(text.encode('utf-8')))
+    nodes = read_node_dat(str(tmp_path / 'node.dat'))
+    assert nodes.node_id.tolist() == [0, 1]
+    assert nodes.name == ['MasterNode', 'MQB1']
+    assert nodes.node_type.tolist() == [0, 2]
+    assert nodes.offsets.tolist() == [0, 1, 4]
+    attributes = nodes.attributes()
+    assert attributes[0] == [1.5] and attributes[1][0] == 3 and attributes[1][1] != attributes[1][1]
+    assert nodes.padded().shape == (2, 3)
+
+
+# Edges are ordered as networkx lists them, by source and then by the order in which they were added
+def test_edge_order():
+    node_id = numpy.array([0, 1, 2, 3])
+    edge_index = numpy.array([[0, 0, 1, 1], [1, 3, 2, 3]])
+    positions, edges = edge_order(edge_index, node_id, directed=True)
+    assert positions.tolist() == edge_index.tolist()
+    assert edges.tolist() == [0, 1, 2, 3]
+    # Undirected edges are listed in both directions
+    positions, edges = edge_order(edge_index, node_id)
+    assert positions.tolist() == [[0, 0, 1, 1, 1, 2, 3, 3], [1, 3, 0, 2, 3, 1, 0, 1]]
+    assert edges.tolist() == [0, 1, 0, 2, 3, 2, 1, 3]
+    # Node ids need not be the positions of the nodes
+    positions, edges = edge_order(numpy.array([[7, 5]]).T, numpy.array([5, 7]), directed=True)
+    assert positions.tolist() == [[1], [0]]
+    # An edge added again stays in its first place, with the attributes of the last one added
+    edge_index = numpy.array([[0, 1, 0, 2], [1, 2, 1, 1]])
+    positions, edges = edge_order(edge_index, node_id, directed=True)
+    assert positions.tolist() == [[0, 1, 2], [1, 2, 1]]
+    assert edges.tolist() == [2, 1, 3]
+    positions, edges = edge_order(edge_index, node_id)
+    assert positions.tolist() == [[0, 1, 1, 2], [1, 0, 2, 1]]
+    assert edges.tolist() == [2, 2, 3, 3]
+
+
+def test_set_attributes():
+    nodes = NodeData(numpy.array([0, 1, 2]), ['A', 'B', 'C'], numpy.array([0, 1, 1]),
+                     numpy.array([1.0, 2.0, 3.0, 4.0]), numpy.array([0, 1, 3, 4]))
+    nodes.set_attributes(1, [5.0, 6.0, 7.0])
+    assert nodes.attributes() == [[1.0], [5.0, 6.0, 7.0], [4.0]]
+    assert nodes.padded().shape == (3, 3)
+
+
+# A slice of a columnar store between local dates is found by time even across the hour repeated as DST ends
+def test_columnar_time_slice_during_fall_back(tmp_path):
+    dates = ['2021-11-07T00:00:00', '2021-11-07T01:00:00', '2021-11-07T01:00:00', '2021-11-07T02:00:00',
+             '2021-11-07T03:00:00']
+    times = numpy.array([1636257600000, 1636261200000, 1636264800000, 1636268400000, 1636272000000])
+    arrays = {'times': times, 'features': numpy.zeros((5, 1, 1)), 'mask': numpy.ones((1, 1), dtype=bool),
+              'globals': numpy.zeros((5, 0)), 'edge_index': numpy.zeros((2, 0), dtype=numpy.int64),
+              'edge_type': numpy.zeros(0, dtype=numpy.int64), 'edge_weight': numpy.zeros(0)}
+    for name, array in arrays.items():
+        numpy.save(str(tmp_path / (name + '.npy')), array)
+    (tmp_path / 'dataset.json').write_text(json.dumps({'version': 1, 'dates': dates, 'timezone': 'America/New_York'}))
+    loader = CEBAFColumnarLoader(str(tmp_path))
+    # Both of the 01:00 data sets are from 01:00 and to 01:00
+    assert loader.time_slice('2021-11-07 01:00', '2021-11-07 01:00') == slice(1, 3)
+    assert loader.time_slice('2021-11-07 01:30', '2021-11-07 03:00') == slice(2, 5)
+    assert loader.time_slice(None, '2021-11-07 01:59') == slice(0, 3)
+    assert loader.time_slice(int(times[2]), int(times[3])) == slice(2, 4)
+
+
+# The Data of a graph built the way data_utils built it before it parsed the files into arrays
+def baseline_pyg(node, link, directed):
+    import networkx
+    import pandas
+    import torch
+    from torch_geometric.utils.convert import from_networkx
+    g = networkx.DiGraph() if directed else networkx.Graph()
+    for _, row in pandas.read_csv(node, sep='\t').iterrows():
+        attr = []
+        for v in row['VALUES'].strip().split(','):
+            try:
+                attr.append(eval(v))
+            except Exception:
+                attr.append(numpy.nan)
+        g.add_node(row['NODE'], name=row['NAME'].strip(), node_type=row['TYPE'], attr=attr)
+    for _, row in pandas.read_csv(link, sep='\t').iterrows():
+        g.add_edge(row['START'], row['END'], edge_type=row['LINK_TYPE'], weight=row['LINK_WEIGHT'])
+    data = from_networkx(g)
+    for i in range(len(data.attr)):
+        data.attr[i] = torch.nan_to_num(torch.tensor(data.attr[i]))
+    return data
+
+
+# The Data built straight from the arrays of a graph is the one built by way of networkx, down to the dtypes
+@pytest.mark.parametrize('values, weights', [
+    # Nodes with different numbers of features and weights that are not all integers
+    (['0.368723', '6.6565725,243.994,<undefined>', '7.3768604,60.619,0.747', '7.2314509996126,0'],
+     ['1', '0.5', '2', '0.25', '4']),
+    # Features that are all integers for some nodes, and integer weights
+    (['3', '1,-2,0', '0.0,1,2', '5,<undefined>'], ['1', '1', '1', '1', '1']),
+    # Nodes that all have the same number of features, integers
+    (['1,2', '3,4', '-5,0', '6,7'], ['1', '1', '2', '1', '1']),
+    (['1,2', '3,4.5', '-5,<undefined>', '6,7'], ['1', '1', '2', '1', '1']),
+])
+def test_to_pyg_matches_from_networkx(tmp_path, values, weights):
+    torch = pytest.importorskip('torch')
+    pytest.importorskip('torch_geometric')
+    data_utils = pytest.importorskip('data_loader.data_utils')
+    names = ['MasterNode', 'MFA0I03', 'MFD0I04', 'VIP0I03']
+    types = [0, 1, 1, 2]
+    # The edge from 0 to 1 is given twice and the one between 1 and 2 both ways round
+    edges = [(0, 1, 0), (1, 2, 0), (0, 1, 0), (2, 1, 0), (1, 3, 1)]
+    files = {
+        'meta.dat': 'Total Nodes: \t 4\nNode_Type_0: \t 1\nNode_Type_1: \t 2\nNode_Type_2: \t 1\n',
+        'info.dat': 'TYPE\tNAME\tLABELS\n0 \t MasterNode IBC0L02Current\n1 \t Solenoid S,.BDL,.S\n2 \t IonPump S,.VAL\n',
+        'node.dat': 'NODE\tNAME\tTYPE\tVALUES\n' + ''.join(f'{i}\t{name} \t {node_type} \t {value}\n' for i, (name, node_type, value)
+                                                       in enumerate(zip(names, types, values))),
+        'link.dat': 'START\tEND\tLINK_TYPE\tLINK_WEIGHT\n' + ''.join(f'{start} \t {end} \t {edge_type}\t{weight}\n'
+                                                                 for (start, end, edge_type), weight in zip(edges, weights)),
+    }
+    for name, text in files.items():
+        (tmp_path / name).write_text(text)
+    paths = [str(tmp_path / name) for name in ['node.dat', 'link.dat', 'info.dat', 'meta.dat']]
+    for directed in [True, False]:
+        data = data_utils.CEBAFGraph(*paths, datetime(2021, 10, 1), directed=directed)._to_pyg()
+        expected = baseline_pyg(paths[0], paths[1], directed)
+        assert sorted(data.keys()) == sorted(expected.keys())
+        for key in ['edge_index', 'edge_type', 'weight', 'node_type']:
+            assert data[key].dtype == expected[key].dtype and torch.equal(data[key], expected[key])
+        assert data.name == expected.name
+        assert data.num_nodes == expected.num_nodes
+        assert type(data.attr) == type(expected.attr) and len(data.attr) == len(expected.attr)
+        for attr, original in zip(data.attr, expected.attr):
+            assert attr.dtype == original.dtype and torch.equal(attr, original)
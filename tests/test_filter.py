@@ -1,3 +1,4 @@
+import numpy
 import modules.filter as filter
 
 def test_macro_substitution():
@@ -36,4 +37,55 @@ def test_filter_exception():
         result = f.passes(data)
         assert True == False        # We should never reach this line, but generate an error if we do
     except filter.FilterException as err:
-        assert True
\ No newline at end of file
+        assert True
+
+def test_expression_evaluates_arrays():
+    expr = filter.compile_expression('0.066 * $(VIP0L08) * 0.000001 *((5600/5000)/11)')
+    assert expr is filter.compile_expression('0.066 * $(VIP0L08) * 0.000001 *((5600/5000)/11)')
+    assert expr.pvs == ['VIP0L08']
+    result = expr.evaluate({'VIP0L08': numpy.array([3.0, numpy.nan, 0.0])})
+    assert result[0] == 0.066 * 3.0 * 0.000001 * ((5600 / 5000) / 11)
+    assert numpy.isnan(result[1]) and result[2] == 0
+    assert not expr.is_integer(True)
+    assert filter.compile_expression('$(X) * 2 - 1').is_integer(True)
+    assert not filter.compile_expression('$(X) * 2 - 1').is_integer(False)
+
+
+def test_expression_rejects_other_syntax():
+    for rule in ["__import__('os').system('ls')", "$(X).real", "'a' * $(X)", "$(X) * y", "$(X) *"]:
+        try:
+            filter.compile_expression(rule)
+            assert True == False
+        except filter.FilterException as err:
+            assert True
+
+
+def test_filter_mask():
+    data_sets = [{'date': 'a', 'values': [{'IBC0L02Current': '0.3'}, {'X': '2'}]},
+                 {'date': 'b', 'values': [{'IBC0L02Current': '<undefined>'}, {'X': '2'}]},
+                 {'date': 'c', 'values': [{'IBC0L02Current': '7'}, {'X': '2'}]},
+                 {'date': 'd', 'values': [{'IBC0L02Current': '0.05'}, {'X': '0'}]}]
+    f = filter.make("0.1 < $(IBC0L02Current) < 5 or not $(X)")
+    mask, errors = f.mask(data_sets)
+    assert list(mask) == [True, False, False, True]
+    assert list(errors.keys()) == [1]
+    assert errors[1].args[0] == "The filter expression could not be evaluated: 0.1 < <undefined> < 5 or not 2"
+
+
+# A result that python could not have computed, such as that of a division by zero, is an error for that data set
+# unless python would not have evaluated it
+def test_filter_mask_division_by_zero():
+    data_sets = [{'date': 'a', 'values': [{'X': '0'}, {'Y': '0'}]},
+                 {'date': 'b', 'values': [{'X': '2'}, {'Y': '1'}]},
+                 {'date': 'c', 'values': [{'X': '1'}, {'Y': '0'}]}]
+    mask, errors = filter.make("$(X) / $(Y)").mask(data_sets)
+    assert list(mask) == [False, True, False]
+    assert list(errors.keys()) == [0, 2]
+    assert errors[0].args[0] == "The filter expression could not be evaluated: 0 / 0"
+    mask, errors = filter.make("$(X) / $(Y) > 1 or not $(X) == 0").mask(data_sets)
+    assert list(mask) == [False, True, False] and list(errors.keys()) == [0, 2]
+    # The division is not reached where the first comparison is already true
+    mask, errors = filter.make("$(Y) == 0 or $(X) / $(Y) > 1").mask(data_sets)
+    assert list(mask) == [True, True, True] and not errors
+    mask, errors = filter.make("$(Y) != 0 and $(X) / $(Y) > 1").mask(data_sets)
+    assert list(mask) == [False, True, False] and not errors
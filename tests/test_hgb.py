@@ -1,5 +1,6 @@
 # File containing some tests of the hgb module.
 
+import os
 import modules.hgb as hgb
 
 def test_it_returns_path_from_date():
@@ -19,4 +20,71 @@ def test_it_returns_path_from_date_with_seconds():
 def test_it_returns_dir_from_date():
     assert hgb.dir_from_date('foo', '2001-11-01') == 'foo/20011101_000000'
     assert hgb.dir_from_date('foo', '2001-11-1') == 'foo/20011101_000000'
-    assert hgb.dir_from_date('foo', '2001-11-01 23:15') == 'foo/20011101_231500'
\ No newline at end of file
+    assert hgb.dir_from_date('foo', '2001-11-01 23:15') == 'foo/20011101_231500'
+
+
+def test_share_static_files(tmp_path):
+    source = tmp_path / 'static'
+    source.mkdir()
+    for file_name in hgb.static_files:
+        (source / file_name).write_text(file_name)
+    for name, link in [('linked', True), ('copied', False)]:
+        path = tmp_path / name
+        path.mkdir()
+        hgb.share_static_files(str(source), str(path), link)
+        hgb.share_static_files(str(source), str(path), link)     # Files that already exist are replaced
+        for file_name in hgb.static_files:
+            assert (path / file_name).read_text() == file_name
+            assert os.path.samefile(path / file_name, source / file_name) == link
+
+
+def test_paths_from_dates():
+    dates = ['2021-09-05T00:00:00', '2021-11-07T01:30:15']
+    assert hgb.paths_from_dates('out', dates, {'structure': 'directory'}) == \
+           [hgb.dir_from_date('out', date) for date in dates]
+    assert hgb.paths_from_dates('out', dates, {'minutes': True, 'seconds': False}) == \
+           [hgb.path_from_date('out', date, minutes=True) for date in dates]
+
+
+def test_manifest(tmp_path):
+    from modules.mya import Sampler
+    import modules.node as node
+    nodes = [node.MasterNode(Sampler('2021-11-01', '2021-11-02'))]
+    for name, s in [('SP1', '1.0'), ('RB1', '3.0')]:
+        node_class = node.SetPointNode if name.startswith('SP') else node.ReadBackNode
+        nodes.append(node_class({'name': name, 'properties': {'S': s}}, [], Sampler('2021-11-01', '2021-11-02')))
+    for node_id, item in enumerate(nodes):
+        item.node_id = node_id
+    node.List.populate_links(nodes)
+    topology = node.Topology(nodes, 1)
+    assert hgb.read_manifest(str(tmp_path)) is None
+
+    config = {'mya': {'dates': {'begin': '2021-11-01', 'end': '2021-11-02', 'interval': '1h'}}}
+    hgb.write_manifest(str(tmp_path), config, nodes, topology, ['2021-11-01T01:00:00', '2021-11-01T00:00:00'],
+                       [1635742800000, 1635739200000])
+    manifest = hgb.read_manifest(str(tmp_path))
+    assert manifest['config'] == config
+    assert manifest['dates'] == ['2021-11-01T00:00:00', '2021-11-01T01:00:00']
+    assert hgb.manifest_mismatch(manifest, nodes, topology) is None
+
+    # Appended data sets are added to those already written
+    hgb.write_manifest(str(tmp_path), config, nodes, topology, ['2021-11-01T02:00:00'], [1635746400000], manifest)
+    assert hgb.read_manifest(str(tmp_path))['times'] == [1635739200000, 1635742800000, 1635746400000]
+
+    assert 'removed: RB1' in hgb.manifest_mismatch(manifest, nodes[:2], topology)
+    assert hgb.manifest_mismatch(manifest, nodes, node.Topology(nodes, 1, weighted=True)) == \
+           'the edges between the nodes have changed'
+
+
+def test_write_text(tmp_path):
+    import gzip
+    import pytest
+    hgb.write_text(str(tmp_path), 'node.dat', 'plain\n', {})
+    assert (tmp_path / 'node.dat').read_text() == 'plain\n'
+    output = {'compression': 'gzip', 'compression_level': 1}
+    hgb.write_text(str(tmp_path), 'link.dat', 'compressed\n', output)
+    assert gzip.decompress((tmp_path / 'link.dat.gz').read_bytes()) == b'compressed\n'
+    assert hgb.output_file_name('link.dat', output) == 'link.dat.gz'
+    assert hgb.output_file_name('link.dat', {'compression': 'none'}) == 'link.dat'
+    with pytest.raises(RuntimeError):
+        hgb.compression({'compression': 'lzma'})
@@ -1,5 +1,8 @@
 # File containing some tests of the mya module.
 
+import json
+from types import SimpleNamespace
+import numpy
 import modules.mya as mya
 
 # Test that Sampler correctly computes number of steps in a date range
@@ -30,17 +33,438 @@ def test_steps_between():
     assert mya.Sampler.steps_between('2021-11-07', '2021-11-08', '1h') == 25
 
 
-def test_steps_per_chunk():
+def test_steps_per_chunk(monkeypatch):
     # First test is simple case with just one PV in the list
     span = {'begin_date': '2021-10-01', 'end_date': '2021-10-02', 'interval': '1h'}
     dates = [span]
     sampler = mya.Sampler(dates, ['IBC0R08CRCUR1'])
-    mya.throttle = 5
+    monkeypatch.setattr(mya, 'throttle', 5)
     assert sampler.steps_per_chunk('2021-10-01', span['end_date'], span['interval']) == 5 # floor(Throttle/PVCount=1)
     assert sampler.steps_per_chunk('2021-10-01 22:00', span['end_date'], span['interval']) == 2 # Limited to remaining hours
 
     # Now when the PV list is > 1
     sampler = mya.Sampler(dates, ['IBC0R08CRCUR1','IBC0R08CRCUR2','IBC0R08CRCUR3'])
-    mya.throttle = 5
+    monkeypatch.setattr(mya, 'throttle', 5)
     assert sampler.steps_per_chunk('2021-10-01', span['end_date'], span['interval']) == 1  # floor(Throttle/PVCount=3)
-    assert sampler.steps_per_chunk('2021-10-01 22:00', span['end_date'], span['interval']) == 1  # Limited by PV size not remaining hours
\ No newline at end of file
+    assert sampler.steps_per_chunk('2021-10-01 22:00', span['end_date'], span['interval']) == 1  # Limited by PV size not remaining hours
+
+# A Sampler that answers requests locally rather than from the archiver with a single sample
+# at the beginning of the span whose values are the positions of the pvs in the request
+class FakeSampler(mya.Sampler):
+    def get_data_for_pvs(self, pv_list: list, span):
+        if 'BAD' in pv_list:
+            raise mya.MyaException('Unknown channel BAD')
+        return mya.Samples(self.grid(span)[:1], pv_list, [range(len(pv_list))])
+
+
+# Results of the worker pool are delivered in submission order even if they finish out of order
+def test_pooled_preserves_order(monkeypatch):
+    import time
+    monkeypatch.setattr(mya, 'workers', 4)
+    results = list(mya.pooled(lambda x: time.sleep((5 - x) / 100) or x, [1, 2, 3, 4]))
+    assert results == [1, 2, 3, 4]
+
+
+def test_fetch_all(monkeypatch):
+    monkeypatch.setattr(mya, 'throttle', 2)
+    monkeypatch.setattr(mya, 'workers', 3)
+    dates = [{'begin': '2021-10-01', 'end': '2021-10-02', 'interval': '1h'},
+             {'begin': '2021-10-03', 'end': '2021-10-04', 'interval': '1h'}]
+    good = FakeSampler(dates, ['A', 'B', 'C'])
+    bad = FakeSampler(dates, ['BAD'])
+    other = FakeSampler(dates, ['D'])
+    assert len(mya.Planner([good]).requests()) == 4   # two pv groups times two date ranges
+
+    results = list(mya.fetch_all([good, bad, other]))
+    assert [sampler for sampler, error in results] == [good, bad, other]
+    assert results[0][1] is None
+    assert isinstance(results[1][1], mya.MyaException)
+    # Data from separate requests is merged in time order
+    data = good.structured_data()
+    assert [item['date'] for item in data] == ['2021-10-01T00:00:00', '2021-10-03T00:00:00']
+    assert [list(value.keys())[0] for value in data[0]['values']] == ['A', 'B', 'C']
+
+
+# The planner packs pvs from many samplers into shared requests grouped by strategy
+def test_planner_packs_requests(monkeypatch):
+    monkeypatch.setattr(mya, 'throttle', 4)
+    dates = [{'begin': '2021-10-01', 'end': '2021-10-02', 'interval': '1h'}]
+    readbacks = [FakeSampler(dates, [f'RB{i}.X', f'RB{i}.Y']) for i in range(5)]
+    setpoint = FakeSampler(dates, ['SP1.BDL', 'SP1.S'])
+    setpoint.strategy = 's'
+    planner = mya.Planner(readbacks + [setpoint])
+    requests = planner.requests()
+    # 10 readback pvs need 3 requests, the setpoint pvs 1 more, rather than one request per sampler
+    assert [len(request.pvs) for request in requests] == [4, 4, 2, 2]
+    assert requests[0].owners == {0: ['RB0.X', 'RB0.Y'], 1: ['RB1.X', 'RB1.Y']}
+
+    # And each sampler receives only its own slice of the data
+    for sampler, error in planner.fetch():
+        assert error is None
+    assert readbacks[3].samples().pvs == ['RB3.X', 'RB3.Y']
+    assert setpoint.samples().pvs == ['SP1.BDL', 'SP1.S']
+
+
+# A Sampler that answers with a sample at every step of the span and remembers what it was asked for.
+# Every value is the hour of day of its timestamp.
+class GridSampler(mya.Sampler):
+    asked = []
+
+    def get_data_for_pvs(self, pv_list: list, span):
+        self.asked.append((pv_list, span.begin, self.total_steps(span)))
+        grid = self.grid(span)
+        hours = [[int(date[11:13])] * len(pv_list) for date in mya.from_epoch_ms(grid)]
+        return mya.Samples(grid, pv_list, hours)
+
+
+# Overlapping date ranges fetch only the samples that are not already in the cache
+def test_cache_fetches_only_missing_samples(tmp_path, monkeypatch):
+    import modules.cache as cache
+    monkeypatch.setattr(mya, 'throttle', 10)
+    monkeypatch.setattr(mya, 'cache', cache.ArchiveCache(str(tmp_path)))
+    GridSampler.asked = []
+    first = GridSampler([{'begin': '2021-10-01', 'end': '2021-10-02', 'interval': '1h'}], ['A', 'B'])
+    first.data()
+    assert GridSampler.asked == [(['A', 'B'], '2021-10-01', 24)]
+
+    GridSampler.asked = []
+    loaded = []
+    load = mya.cache.load
+    monkeypatch.setattr(mya.cache, 'load', lambda pv, *args: loaded.append(pv) or load(pv, *args))
+    second = GridSampler([{'begin': '2021-10-01 12:00', 'end': '2021-10-03', 'interval': '1h'}], ['A', 'B', 'C'])
+    data = second.data()
+    assert GridSampler.asked == [(['A', 'B'], '2021-10-02 00:00:00', 24), (['C'], '2021-10-01 12:00', 36)]
+    # Each pv's samples are read from the cache just once, even though more were stored and then assembled
+    assert loaded == ['A', 'B', 'C']
+    assert len(data) == 36
+    assert data[0] == {'date': '2021-10-01T12:00:00', 'values': [{'A': '12'}, {'B': '12'}, {'C': '12'}]}
+    assert data[-1] == {'date': '2021-10-02T23:00:00', 'values': [{'A': '23'}, {'B': '23'}, {'C': '23'}]}
+
+
+# A GridSampler whose server fails to answer requests for more than limit values
+class LimitedSampler(GridSampler):
+    limit = 48
+
+    def get_data_for_pvs(self, pv_list: list, span):
+        if self.total_steps(span) * len(pv_list) > self.limit:
+            raise mya.MyaServerException('Timed out')
+        return super().get_data_for_pvs(pv_list, span)
+
+
+# Long spans are fetched in chunks sized by the budget and stitched back together seamlessly
+def test_planner_splits_long_spans(monkeypatch):
+    monkeypatch.setattr(mya, 'throttle', 10)
+    monkeypatch.setattr(mya, 'workers', 1)
+    monkeypatch.setattr(mya, 'min_points_per_request', 1)
+    GridSampler.asked = []
+    sampler = LimitedSampler([{'begin': '2021-10-01', 'end': '2021-10-06', 'interval': '1h'}], ['A', 'B'])
+    budget = mya.Budget(100)
+    for sampler, error in mya.Planner([sampler], budget).fetch():
+        assert error is None
+    # The first 50 step chunk was too big so its quarters were fetched instead and later chunks shrank to suit
+    assert [steps for pvs, begin, steps in GridSampler.asked] == [13, 12, 13, 12, 24, 24, 22]
+    assert budget.points == 49
+    samples = sampler.samples()
+    assert numpy.array_equal(samples.times, sampler.grid(sampler.date_span(sampler.dates[0])))
+    assert samples.column('A').tolist() == [hour % 24 for hour in range(120)]
+
+
+# Slow answers shrink the budget while quick ones that use all of it let it grow
+def test_budget_adapts_to_latency(monkeypatch):
+    monkeypatch.setattr(mya, 'target_latency', 20)
+    budget = mya.Budget(100000)
+    budget.succeeded(100000, 40)
+    assert budget.points == 50000
+    budget.succeeded(1000, 1)
+    assert budget.points == 50000
+    budget.succeeded(50000, 1)
+    assert budget.points == 100000
+    assert budget.steps(7) == 14285
+    budget.failed(10000)
+    assert budget.points == 5000
+
+
+# A stand-in for the responses of the Mya web server
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.url = mya.Sampler.url
+
+    def json(self):
+        return self.body
+
+    def close(self):
+        pass
+
+
+# Requests that fail for transient reasons are repeated while other failures are raised immediately
+def test_get_data_for_pvs_retries_transient_errors(monkeypatch):
+    import requests
+    answers = [requests.exceptions.ConnectionError('reset'),
+               FakeResponse(503, {}),
+               FakeResponse(200, {'channels': {'A': {'data': [{'d': '2021-10-01T00:00:00', 'v': 1.5}]}}}),
+               FakeResponse(400, {'error': 'Unknown channel'})]
+
+    def get(url, params=None, **kwargs):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(mya, 'session', lambda: SimpleNamespace(get=get))
+    monkeypatch.setattr(mya, 'backoff', 0)
+    sampler = mya.Sampler([{'begin': '2021-10-01', 'end': '2021-10-02', 'interval': '1h'}], ['A'])
+    span = sampler.date_span(sampler.dates[0])
+    assert sampler.get_data_for_pvs(['A'], span).column('A').tolist() == [1.5]
+    try:
+        sampler.get_data_for_pvs(['A'], span)
+        assert False        # We should never reach this line
+    except mya.MyaException as err:
+        assert not isinstance(err, mya.MyaServerException)
+        assert answers == []
+
+
+# A GridSampler that is unable to fetch the pv named BAD
+class FlakySampler(GridSampler):
+    def get_data_for_pvs(self, pv_list: list, span):
+        if 'BAD' in pv_list:
+            raise mya.MyaException('Unknown channel BAD')
+        return super().get_data_for_pvs(pv_list, span)
+
+
+# Samples saved to the checkpoint by an interrupted run are not fetched again when it is resumed
+def test_checkpoint_resumes_interrupted_fetch(tmp_path, monkeypatch):
+    import modules.cache as cache
+    monkeypatch.setattr(mya, 'throttle', 10)
+    monkeypatch.setattr(mya, 'workers', 1)
+    dates = [{'begin': '2021-10-01', 'end': '2021-10-02', 'interval': '1h'}]
+    monkeypatch.setattr(mya, 'checkpoint', cache.Checkpoint(str(tmp_path)))
+    good, bad = FlakySampler(dates, ['A', 'B']), FlakySampler(dates, ['BAD'])
+    errors = [error for sampler, error in mya.fetch_all([good, bad])]
+    assert errors[0] is None and isinstance(errors[1], mya.MyaException)
+
+    # BAD has since been repaired
+    GridSampler.asked = []
+    monkeypatch.setattr(mya, 'checkpoint', cache.Checkpoint(str(tmp_path)))
+    good, repaired = GridSampler(dates, ['A', 'B']), GridSampler(dates, ['BAD'])
+    for sampler, error in mya.fetch_all([good, repaired]):
+        assert error is None
+    assert GridSampler.asked == [(['BAD'], '2021-10-01', 24)]
+    assert good.samples().column('B').tolist() == list(range(24))
+
+
+# Each step takes the most recent value at or before it
+def test_forward_fill():
+    filled = mya.forward_fill(numpy.array([100, 300]), [1.0, float('nan')], numpy.array([0, 100, 200, 300, 400]))
+    assert numpy.isnan(filled[0]) and numpy.isnan(filled[3]) and numpy.isnan(filled[4])
+    assert filled[1:3].tolist() == [1.0, 1.0]
+
+
+# Changes fetched as events are sampled locally at each step, unless there are too many of them
+def test_get_events(monkeypatch):
+    begin = int(mya.to_epoch_ms(['2021-10-01T00:00:00'])[0])
+    hour = 3600000
+    events = {'data': [{'d': begin - 5 * hour, 'v': 1.5},
+                       {'d': begin + 2 * hour + 1000, 'v': 2.5},
+                       {'d': begin + 4 * hour, 't': 'DISCONNECTION'}]}
+    asked = []
+
+    def get(url, params=None, **kwargs):
+        asked.append((url, params))
+        return FakeResponse(200, events)
+
+    monkeypatch.setattr(mya, 'session', lambda: SimpleNamespace(get=get))
+    sampler = mya.Sampler([{'begin': '2021-10-01', 'end': '2021-10-01 06:00', 'interval': '1h'}], ['SP.BDL'])
+    span = sampler.date_span(sampler.dates[0])
+    samples = sampler.get_events('SP.BDL', span)
+    # Events come from the interval endpoint, not the mysampler one
+    assert asked[0][0] == mya.url + 'interval'
+    assert asked[0][1]['b'] == '2021-10-01 00:00:00' and asked[0][1]['e'] == '2021-10-01 05:00:01'
+    assert [samples.text(i, 'SP.BDL') for i in range(len(samples))] == \
+        ['1.5', '1.5', '1.5', '2.5', '<undefined>', '<undefined>']
+    # The value prior to the span is not one of its two events, which are too many for a limit of one
+    assert sampler.get_events('SP.BDL', span, 2) is not None
+    assert asked[-1][1]['l'] == 3
+    assert sampler.get_events('SP.BDL', span, 1) is None
+
+
+# A Sampler that reports pvs named DENSE to have too many events to fetch that way
+class EventSampler(GridSampler):
+    mode = 'auto'
+
+    def get_events(self, pv: str, span, limit: int = None):
+        self.asked.append(('events', pv, limit))
+        if pv.startswith('DENSE'):
+            return None
+        return mya.Samples(self.grid(span), [pv], numpy.ones(self.total_steps(span)))
+
+
+# In auto mode each pv is fetched as events and sampled by the server only if it has too many of them,
+# in which case those pvs are sampled together rather than one at a time
+def test_planner_auto_mode(monkeypatch):
+    monkeypatch.setattr(mya, 'throttle', 10)
+    monkeypatch.setattr(mya, 'workers', 1)
+    monkeypatch.setattr(mya, 'events_ratio', 0.5)
+    GridSampler.asked = []
+    dates = [{'begin': '2021-10-01', 'end': '2021-10-02', 'interval': '1h'}]
+    first = EventSampler(dates, ['SP1.BDL', 'DENSE1.S'])
+    second = EventSampler(dates, ['SP2.BDL', 'DENSE2.S'])
+    for sampler, error in mya.Planner([first, second]).fetch():
+        assert error is None
+    assert GridSampler.asked == [('events', 'SP1.BDL', 12), ('events', 'DENSE1.S', 12),
+                                 ('events', 'SP2.BDL', 12), ('events', 'DENSE2.S', 12),
+                                 (['DENSE1.S', 'DENSE2.S'], '2021-10-01', 24)]
+    assert first.samples().column('SP1.BDL').tolist() == [1.0] * 24
+    assert second.samples().pvs == ['SP2.BDL', 'DENSE2.S']
+    assert second.samples().column('DENSE2.S').tolist() == list(range(24))
+
+    # However few steps a span has, a pv that changes only a handful of times during it is fetched as events
+    GridSampler.asked = []
+    EventSampler([{'begin': '2021-10-01', 'end': '2021-10-01 02:00', 'interval': '1h'}], ['SP1.BDL']).samples()
+    assert GridSampler.asked == [('events', 'SP1.BDL', mya.min_events_limit)]
+
+
+# Nearby points in time are fetched as a few spans covering them rather than one request apiece
+def test_planner_coalesces_timestamps(monkeypatch):
+    monkeypatch.setattr(mya, 'throttle', 10)
+    monkeypatch.setattr(mya, 'workers', 1)
+    monkeypatch.setattr(mya, 'coalesce_steps', 300)
+    GridSampler.asked = []
+    dates = mya.date_ranges_from_file('timestamps.csv')
+    sampler = GridSampler(dates, ['A', 'B'])
+    requests = mya.Planner([sampler]).requests()
+    assert len(requests) < len(dates) / 10
+    samples = sampler.samples()
+    assert samples.dates()[0] == '2022-01-09T18:43:45'
+    assert samples.column('A')[0] == 18
+    # The values are looked up for the timestamps themselves, not the steps of the spans covering them
+    unique = sorted(set(date['begin'] for date in dates))
+    assert samples.times.tolist() == mya.to_epoch_ms(unique).tolist()
+
+
+# A pv shared by several samplers, even ones fetched differently, is fetched only once
+def test_planner_fetches_shared_pvs_once(monkeypatch):
+    monkeypatch.setattr(mya, 'throttle', 10)
+    monkeypatch.setattr(mya, 'workers', 1)
+    GridSampler.asked = []
+    dates = [{'begin': '2021-10-01', 'end': '2021-10-02', 'interval': '1h'}]
+    global_sampler = GridSampler(dates, ['IBC0L02Current', 'IBC0R08CRCUR1'])
+    cavities = [GridSampler(dates, [f'R1M{i}GSET', 'R1MXPSET8']) for i in range(1, 4)]
+    bcm = GridSampler(dates, ['IBC0L02Current'])
+    for sampler in cavities:
+        sampler.strategy = 's'
+    planner = mya.Planner([global_sampler] + cavities + [bcm])
+    for sampler, error in planner.fetch():
+        assert error is None
+    assert GridSampler.asked == [(['IBC0L02Current', 'IBC0R08CRCUR1'], '2021-10-01', 24),
+                                 (['R1M1GSET', 'R1MXPSET8', 'R1M2GSET', 'R1M3GSET'], '2021-10-01', 24)]
+    assert (planner.stats.references, planner.stats.pvs) == (9, 6)
+    assert '3 duplicates avoided' in planner.report()
+    assert bcm.samples().column('IBC0L02Current').tolist() == list(range(24))
+    assert cavities[2].samples().pvs == ['R1M3GSET', 'R1MXPSET8']
+
+
+# Sampled data is kept as a time axis and a float matrix, with the list of dictionaries built on request
+def test_samples_from_structured():
+    with open('MQD0R05.json', 'r') as datafile:
+        data = json.loads(datafile.read())
+    data[2]['values'][1]['MQD0R05.S'] = '<undefined>'
+    samples = mya.Samples.from_structured(data)
+    assert samples.pvs == ['MQD0R05.BDL', 'MQD0R05.S']
+    assert samples.values.shape == (len(data), 2)
+    assert samples.times.dtype == numpy.int64
+    assert samples.value(7, 'MQD0R05.BDL') == 1133.0
+    assert numpy.isnan(samples.value(2, 'MQD0R05.S'))
+    assert samples.structured()[7] == {'date': '2021-10-01T07:00:00',
+                                       'values': [{'MQD0R05.BDL': '1133'}, {'MQD0R05.S': '3.49325'}]}
+    assert samples.structured()[2]['values'][1] == {'MQD0R05.S': '<undefined>'}
+
+
+# Values are kept as float64 and written as the shortest text for the same number, not as the archiver's text
+def test_value_formatting():
+    values = mya.archived_values('IGL1I00POTcurrent', ['60.619', '0.7470', '1133', '1.0', '1.0E-5', '-2.5e20', None,
+                                                       '<undefined>'])
+    assert [mya.format_value(value) for value in values] == \
+        ['60.619', '0.747', '1133', '1', '1e-05', '-2.5e+20', '<undefined>', '<undefined>']
+
+
+# A value the archiver gives as text that is not a number is an error rather than an undefined value
+def test_non_numeric_values():
+    body = {'channels': {'MMSHLAPOS': {'data': [{'d': '2021-10-01T00:00:00', 'v': '1'},
+                                                {'d': '2021-10-01T01:00:00', 'v': 'ON'}]}}}
+    for parse in [lambda: mya.samples_from_response(body),
+                  lambda: mya.events_from_response({'data': [{'d': 1633060800000, 'v': 'OFF'}]}, 'MMSHLAPOS')]:
+        try:
+            parse()
+            assert False        # We should never reach this line
+        except mya.MyaException as err:
+            assert 'MMSHLAPOS' in str(err)
+
+
+# The same wall-clock hour occurs twice when DST ends and each occurrence gets its own timestamp
+def test_to_epoch_ms_during_fall_back():
+    times = mya.to_epoch_ms(['2021-11-07T00:00:00', '2021-11-07T01:00:00', '2021-11-07T01:00:00',
+                             '2021-11-07T02:00:00'])
+    assert list(numpy.diff(times)) == [3600000, 3600000, 3600000]
+    assert mya.from_epoch_ms(times) == ['2021-11-07T00:00:00', '2021-11-07T01:00:00', '2021-11-07T01:00:00',
+                                        '2021-11-07T02:00:00']
+    # Dates known to begin with the second occurrence, like those of a chunk beginning there, are not put before it
+    assert list(mya.to_epoch_ms(['2021-11-07T01:00:00', '2021-11-07T02:00:00'], times[2])) == list(times[2:])
+    assert list(mya.to_epoch_ms(['2021-11-07T01:00:00', '2021-11-07T01:00:00'], times[1])) == list(times[1:3])
+
+
+# Decoding a response incrementally, however it is split into chunks, gives the same data as parsing it whole
+def test_response_decoder_matches_parsed_response():
+    with open('mysampler.json', 'rb') as datafile:
+        body = datafile.read()
+    expected = mya.samples_from_response(json.loads(body))
+    assert numpy.isnan(expected.value(0, 'R011GSET'))
+    for size in [1, 7, 4096, len(body)]:
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        samples = mya.ResponseDecoder().decode(chunks)
+        assert samples.pvs == expected.pvs
+        assert numpy.array_equal(samples.times, expected.times)
+        assert numpy.array_equal(samples.values, expected.values, equal_nan=True)
+
+
+def test_response_decoder_rejects_truncated_response():
+    with open('mysampler.json', 'rb') as datafile:
+        body = datafile.read()
+    try:
+        mya.ResponseDecoder().decode([body[:len(body) // 2]])
+        assert False        # We should never reach this line
+    except (mya.MyaException, ValueError):
+        assert True
+
+
+# Only the times that remain are kept, with consecutive steps coalesced into ranges
+def test_dates_at():
+    sampler = mya.Sampler([{'begin': '2021-11-06 22:00', 'end': '2021-11-07 04:00', 'interval': '1h'},
+                           {'begin': '2021-11-08 01:00', 'end': '2021-11-08 01:00', 'interval': '1s'},
+                           {'begin': '2021-11-09 01:00', 'end': '2021-11-09 01:00', 'interval': '1s'}])
+    grid = sampler.grid(sampler.date_span(sampler.dates[0]))
+    # The second range begins with the second of the two 01:00 steps as DST ends
+    times = list(grid[[0, 1, 4, 5]]) + [mya.epoch_ms('2021-11-08 01:00')]
+    dates = sampler.dates_at(times)
+    assert dates == [{'begin': '2021-11-06T22:00:00', 'end': '2021-11-07T00:00:00', 'interval': '1h', 'steps': 2,
+                      'begin_ms': grid[0]},
+                     {'begin': '2021-11-07T01:00:00', 'end': '2021-11-07T03:00:00', 'interval': '1h', 'steps': 2,
+                      'begin_ms': grid[4]},
+                     dict(sampler.dates[1], begin_ms=times[-1])]
+    restricted = mya.Sampler(dates)
+    assert list(numpy.concatenate([restricted.grid(span) for span in restricted.spans()])) == times
+
+
+# Points in time that are not in order are resolved in time order as DST ends, as they were when fetched
+def test_dates_at_during_fall_back():
+    dates = ['2021-11-07 02:00', '2021-11-07 01:30', '2021-11-07 00:30', '2021-11-07 01:30', '2021-11-07 01:15']
+    sampler = mya.Sampler([{'begin': date, 'end': date, 'interval': '1s'} for date in dates])
+    times = sampler.instants()
+    assert list(numpy.diff(times) // 60000) == [45, 15, 60, 30]
+    assert mya.from_epoch_ms(times) == ['2021-11-07T00:30:00', '2021-11-07T01:15:00', '2021-11-07T01:30:00',
+                                        '2021-11-07T01:30:00', '2021-11-07T02:00:00']
+    # Each point that remains knows which of the two 01:30s it is
+    for kept in [times, times[[0, 2, 4]], times[[3]]]:
+        restricted = mya.Sampler(sampler.dates_at(kept))
+        assert list(restricted.instants()) == list(kept)
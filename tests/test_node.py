@@ -128,3 +128,99 @@ def test_node_info():
 
     assert('.XPOS' in label_dict['BPM'])
     assert('WireSum' in label_dict['BPM'])
+
+# Node rows are matched to global rows by time, and a data set is skipped rather than misaligned
+# when a node lacks data for its time.
+def test_write_data_sets_aligns_rows_by_time(tmp_path, monkeypatch):
+    dates = ['2021-11-07T00:00:00', '2021-11-07T01:00:00', '2021-11-07T01:00:00', '2021-11-07T02:00:00']
+    global_data = [{'date': date, 'values': [{'IBC0L02Current': str(i)}]} for i, date in enumerate(dates)]
+    first = node.SetPointNode({"name": "SP1", "properties": {}}, [], Sampler('2021-11-07', '2021-11-08'))
+    first.sampler.set_data([{'date': date, 'values': [{'SP1': str(i)}]} for i, date in enumerate(dates)])
+    second = node.SetPointNode({"name": "SP2", "properties": {}}, [], Sampler('2021-11-07', '2021-11-08'))
+    second.sampler.set_data([{'date': date, 'values': [{'SP2': str(i)}]} for i, date in enumerate(dates[1:])])
+
+    written = []
+    monkeypatch.setattr(node.hgb, 'write_static_files', lambda *args: None)
+    monkeypatch.setattr(node.hgb, 'share_static_files', lambda *args: None)
+    monkeypatch.setattr(node.hgb, 'node_type_map', lambda *args: None)
+    monkeypatch.setattr(node.hgb, 'write_node_dat', lambda path, config, node_list, rows, type_map: written.append(rows))
+    config = {'nodes': {'filter': 'True'}, 'edges': {'connectivity': 1},
+              'output': {'structure': 'directory'}}
+    indexes = node.List.write_data_sets(global_data, [first, second], config, str(tmp_path))
+
+    # The first time is missing from the second node, which also has its rows at other indexes.
+    # Both occurrences of 01:00 go to the same directory, so only the last of them is written.
+    assert written == [[2, 1], [3, 2]]
+    assert indexes == [2, 3]
+    assert first.pv_data_at_datetime('2021-11-07 01:00') == [{'SP1': '1'}]
+    assert first.pv_data_at_datetime('2021-11-07 01:00', fold=1) == [{'SP1': '2'}]
+
+# Attributes are extracted by a plan that is compiled again whenever the node's data changes
+def test_attribute_plan():
+    element = {'type': 'QB', 'name': 'MQB1', 'properties': {'EPICSName': 'MQB1', 'S': '1.5'}}
+    item = node.SetPointNode(element, ['.S', '.BDL'], Sampler('2021-11-01', '2021-11-02'),
+                             {'MQB1.BDL': '$(MQB1.BDL) * 2'})
+    item.sampler.set_data([{'date': '2021-11-01T00:00:00', 'values': [{'MQB1.BDL': '2'}, {'MQB1.S': '3.5'}]},
+                           {'date': '2021-11-01T01:00:00', 'values': [{'MQB1.BDL': '<undefined>'}, {'MQB1.S': '4'}]}])
+    assert item.attribute_values(0) == ['1.5', '4', '3.5']
+    assert item.attribute_values(1) == ['1.5', '<undefined>', '4']
+    # Modified values are formatted as python would format the result of evaluating the modifier
+    item.modifiers = {'MQB1.BDL': '$(MQB1.BDL) / 2'}
+    item.sampler.set_data([{'date': '2021-11-01T00:00:00', 'values': [{'MQB1.BDL': '2'}, {'MQB1.S': '3.5'}]}])
+    assert item.attribute_values(0) == ['1.5', '1.0', '3.5']
+    item.sampler.set_data([{'date': '2021-11-01T00:00:00', 'values': [{'MQB1.S': '5'}]}])
+    assert item.attribute_values(0) == ['1.5', '5']
+
+# The edges are built once as arrays, optionally weighted by the inverse of the distance between nodes
+def test_topology():
+    nodes = [node.MasterNode(Sampler('2021-11-01', '2021-11-02'))]
+    for name, s in [('SP1', '1.0'), ('RB1', '1.5'), ('SP2', '3.0'), ('RB2', '3.0')]:
+        element = {'name': name, 'properties': {'S': s}}
+        node_class = node.SetPointNode if name.startswith('SP') else node.ReadBackNode
+        nodes.append(node_class(element, [], Sampler('2021-11-01', '2021-11-02')))
+    for node_id, item in enumerate(nodes):
+        item.node_id = node_id
+    node.List.populate_links(nodes)
+
+    topology = node.Topology(nodes, 1)
+    assert topology.edge_index.tolist() == [[0, 0, 1, 1, 3], [1, 3, 2, 3, 4]]
+    assert topology.edge_weight.tolist() == [1, 1, 1, 1, 1]
+    topology = node.Topology(nodes, 1, weighted=True)
+    # SP2 and RB2 are at the same S, so their edge is weighted as though they were min_weight_spacing apart
+    assert topology.edge_weight.tolist() == [1, 1, 2, 0.5, 1 / node.min_weight_spacing]
+    assert len(node.Topology(nodes, 2)) == 6
+    # An edge to a node upstream of its source is weighted by the distance between them just the same
+    nodes[4].element['properties']['S'] = '2.5'
+    assert node.Topology(nodes, 1, weighted=True).edge_weight.tolist() == [1, 1, 2, 0.5, 2]
+
+# All data sets can be written to a single columnar store of arrays that is read back memory-mapped
+def test_write_data_sets_columnar(tmp_path):
+    from data_loader.columnar import CEBAFColumnarLoader
+    dates = ['2021-11-01T00:00:00', '2021-11-01T01:00:00', '2021-11-01T02:00:00']
+    global_data = [{'date': date, 'values': [{'IBC0L02Current': str(i)}]} for i, date in enumerate(dates)]
+    first = node.SetPointNode({"name": "SP1", "type": "QB", "properties": {"S": "1.0"}}, ['.BDL'],
+                              Sampler('2021-11-01', '2021-11-02'))
+    first.sampler.set_data([{'date': date, 'values': [{'SP1.BDL': str(i)}]} for i, date in enumerate(dates)])
+    second = node.ReadBackNode({"name": "RB1", "type": "IPM", "properties": {"S": "2.0"}}, ['.BDL'],
+                               Sampler('2021-11-01', '2021-11-02'))
+    second.sampler.set_data([{'date': date, 'values': [{'RB1.BDL': '<undefined>'}]} for date in dates])
+    for node_id, (item, type_name) in enumerate([(first, 'QB'), (second, 'IPM')]):
+        item.node_id = node_id
+        item.type_name = type_name
+    node.List.populate_links([first, second])
+    config = {'nodes': {'filter': 'True', 'setpoints': {'QB': []}, 'readbacks': {'IPM': []}},
+              'edges': {'connectivity': 1}, 'output': {'structure': 'columnar'}}
+    node.List.write_data_sets(global_data, [first, second], config, str(tmp_path))
+
+    loader = CEBAFColumnarLoader(str(tmp_path))
+    assert len(loader) == 3
+    assert loader.features.shape == (3, 2, 2)
+    assert loader[1].tolist()[0] == [1.0, 1.0]
+    assert loader.features[:, 1, 0].tolist() == [2.0, 2.0, 2.0]
+    assert all(value != value for value in loader.features[:, 1, 1])
+    assert loader.globals[:, 0].tolist() == [0.0, 1.0, 2.0]
+    assert loader.edge_index.tolist() == [[0], [1]]
+    assert [item['name'] for item in loader.nodes] == ['SP1', 'RB1']
+    assert loader.nodes[0]['features'] == ['S', '.BDL']
+    assert loader.time_slice('2021-11-01 01:00', '2021-11-01 02:00') == slice(1, 3)
+    assert loader.time_slice(int(loader.times[1])) == slice(1, 3)